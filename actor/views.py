@@ -22,10 +22,12 @@ from common import api
 from common import clean
 from common import decorator
 from common import exception
+from common import futures
 from common import models
 from common import user
 from common import util
 from common import validate
+from common import dataloader
 from common import display
 from common import views as common_views
 
@@ -77,14 +79,8 @@ def actor_history(request, nick=None, format='html'):
   if handled:
     return handled
 
-  privacy = 'public'
-  if request.user and request.user.is_authenticated():
-    if view.nick == request.user.nick:
-      privacy = 'private'
-    # ROOT because we care whether or not request.user is a contact of
-    # the view user's, not whether the request.user can see the contacts
-    elif api.actor_has_contact(api.ROOT, view.nick, request.user.nick):
-      privacy = 'contacts'
+  viewer = api.viewer_context(request.user, view)
+  privacy = viewer.privacy
 
   # we're going to hide a bunch of stuff if this user is private and we
   # aren't allowed to see
@@ -95,47 +91,54 @@ def actor_history(request, nick=None, format='html'):
   per_page = ENTRIES_PER_PAGE
   offset, prev = util.page_offset(request)
 
+  # start all the queries for the page before waiting on any of them
   if privacy == 'public':
     if user_is_private:
-      inbox = []
+      inbox_async = futures.Future(value=[])
     else:
-      inbox = api.inbox_get_actor_public(request.user, view.nick,
-                                         limit=(per_page + 1), offset=offset)
+      inbox_async = api.inbox_get_actor_public_async(
+          request.user, view.nick, limit=(per_page + 1), offset=offset)
   elif privacy == 'contacts':
-    inbox = api.inbox_get_actor_contacts(request.user, view.nick,
-                                         limit=(per_page + 1), offset=offset)
+    inbox_async = api.inbox_get_actor_contacts_async(
+        request.user, view.nick, limit=(per_page + 1), offset=offset)
   elif privacy == 'private':
-    inbox = api.inbox_get_actor_private(request.user, view.nick,
-                                        limit=(per_page + 1), offset=offset)
+    inbox_async = api.inbox_get_actor_private_async(
+        request.user, view.nick, limit=(per_page + 1), offset=offset)
 
-  actor_streams = api.stream_get_actor_safe(request.user, view.nick)
+  actor_streams_async = api.stream_get_actor_safe_async(request.user,
+                                                        view.nick)
+  sidebar_async = _get_sidebar_nicks_async(request, view)
+  try:
+    last_entry_async = api.entry_get_last_async(
+        request.user, models.Stream.key_from(owner=view.nick, slug='presence'))
+  except exception.ApiException:
+    last_entry_async = None
 
-  entries, more = _get_inbox_entries(request, inbox)
+  actor_streams = actor_streams_async.get_result()
+  entries, more = _get_inbox_entries(request, inbox_async.get_result())
   contacts, channels, streams, entries = _assemble_inbox_data(request,
                                                               entries,
                                                               actor_streams,
-                                                              view)
+                                                              view,
+                                                              sidebar_async)
 
   # If not logged in, cannot write
-  is_owner = request.user and request.user.is_authenticated() and view.nick == request.user.nick
+  is_owner = viewer.is_owner
 
   try:
     presence = api.presence_get(request.user, view.nick)
     presence_stream = api.stream_get_presence(request.user, view.nick)
-    last_entry = api.entry_get_last(request.user, presence_stream.keyname())
-    view.last_entry = last_entry
+    if last_entry_async is not None:
+      last_entry = last_entry_async.get_result()
+      view.last_entry = last_entry
   except exception.ApiException:
     pass
 
 
   # for add/remove contact
-  if request.user and request.user.is_authenticated():
-    user_is_contact = api.actor_has_contact(request.user,
-                                            request.user.nick,
-                                            view.nick)
+  user_is_contact = viewer.follows
+  if not viewer.anonymous:
     view.my_contact = user_is_contact
-  else:
-    user_is_contact = False
 
   # for sidebar streams
   view_streams = _get_sidebar_streams(actor_streams, streams, request.user)
@@ -234,21 +237,27 @@ def actor_overview(request, nick, format='html'):
   per_page = ENTRIES_PER_PAGE
   offset, prev = util.page_offset(request)
 
-  inbox = api.inbox_get_actor_overview(request.user,  
-                                       view.nick,
-                                       limit=(per_page + 1), 
-                                       offset=offset)
-
-  actor_streams = api.stream_get_actor(request.user, view.nick)
-  entries, more = _get_inbox_entries(request, inbox,
+  # start all the queries for the page before waiting on any of them
+  inbox_async = api.inbox_get_actor_overview_async(request.user,
+                                                   view.nick,
+                                                   limit=(per_page + 1),
+                                                   offset=offset)
+  actor_streams_async = api.stream_get_actor_async(request.user, view.nick)
+  sidebar_async = _get_sidebar_nicks_async(request, view)
+  unconfirmeds_async = api.activation_get_actor_email_async(request.user,
+                                                            view.nick)
+
+  actor_streams = actor_streams_async.get_result()
+  entries, more = _get_inbox_entries(request, inbox_async.get_result(),
                                      view.extra.get('comments_hide', 0))
   contacts, channels, streams, entries = _assemble_inbox_data(request,
                                                               entries,
                                                               actor_streams,
-                                                              view)
+                                                              view,
+                                                              sidebar_async)
 
   # Check for unconfirmed emails
-  unconfirmeds = api.activation_get_actor_email(request.user, view.nick)
+  unconfirmeds = unconfirmeds_async.get_result()
   if unconfirmeds:
     unconfirmed_email = unconfirmeds[0].content
 
@@ -767,30 +776,36 @@ def actor_settings_redirect(request):
   view = api.actor_lookup_nick(request.user, nick)
   return http.HttpResponseRedirect(view.url() + request.get_full_path())
 
-def _assemble_inbox_data(request, entries, actor_streams, inbox_owner_ref):
+def _get_sidebar_nicks_async(request, inbox_owner_ref):
+  """starts fetching the contacts and channels for the sidebar"""
+  contacts = api.actor_get_contacts_safe_async(request.user,
+                                               inbox_owner_ref.nick,
+                                               limit=CONTACTS_PER_PAGE)
+  channels = api.actor_get_channels_member_safe_async(request.user,
+                                                      inbox_owner_ref.nick,
+                                                      limit=CHANNELS_PER_PAGE)
+  return contacts, channels
+
+def _assemble_inbox_data(request, entries, actor_streams, inbox_owner_ref,
+                         sidebar_async=None):
   stream_keys = [e.stream for e in entries]
   stream_keys += [s.key().name() for s in actor_streams]
-  streams = api.stream_get_streams(request.user, stream_keys)
-
-  contact_nicks = api.actor_get_contacts_safe(request.user,
-                                              inbox_owner_ref.nick,
-                                              limit=CONTACTS_PER_PAGE)
-  channel_nicks = api.actor_get_channels_member_safe(request.user,
-                                                     inbox_owner_ref.nick,
-                                                     limit=CHANNELS_PER_PAGE)
-  actor_nicks = (contact_nicks +
-                 channel_nicks +
-                 [inbox_owner_ref.nick] +
-                 [s.owner for s in streams.values()] +
-                 [e.owner for e in entries] +
-                 [e.actor for e in entries])
-  actors = api.actor_get_actors(request.user, actor_nicks)
+
+  if sidebar_async is None:
+    sidebar_async = _get_sidebar_nicks_async(request, inbox_owner_ref)
+  contact_nicks, channel_nicks = futures.wait_all(sidebar_async)
+
+  # register everything first so that it is all fetched in one go
+  data = dataloader.for_user(request.user)
+  data.want_streams(stream_keys)
+  data.want_entries(entries)
+  data.want_actors(contact_nicks + channel_nicks + [inbox_owner_ref.nick])
 
   # here comes lots of munging data into shape
-  contacts = [actors[x] for x in contact_nicks if actors[x]]
-  channels = [actors[x] for x in channel_nicks if actors[x]]
-  streams = display.prep_stream_dict(streams, actors)
-  entries = display.prep_entry_list(entries, streams, actors)
+  contacts = data.actor_list(contact_nicks)
+  channels = data.actor_list(channel_nicks)
+  streams = data.prep_streams(stream_keys)
+  entries = data.prep_entries(entries)
 
   return (contacts, channels, streams, entries)
 
@@ -398,18 +398,20 @@ def api_vendor_xmpp_receive(request):
   return http.HttpResponse(rv)
 
 def api_vendor_queue_process(request):
-  """ process a queue item, redirect to self if there were more """
+  """ process queue items in batches for as long as the time budget allows
+  and list the ones that were processed """
   secret = request.REQUEST.get('secret')
   if secret != settings.QUEUE_VENDOR_SECRET:
     raise exception.ApiException(0x00, "Invalid secret")
   
   try:
-    rv = api.task_process_any(api.ROOT)
-    if rv:
-      return http.HttpResponseRedirect(request.get_full_path())
+    rv = api.task_process_any(api.ROOT,
+                              work_count=settings.QUEUE_BATCH_SIZE,
+                              time_budget=settings.QUEUE_TIME_BUDGET)
   except exception.ApiNoTasks:
-    pass
-  return http.HttpResponse('')
+    rv = []
+  logging.info('Processed %d tasks', len(rv))
+  return http.HttpResponse('\n'.join(rv), content_type='text/plain')
 
 
 def _model_to_dict(rv):
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import getpass
+import logging
+import os
+import optparse
+import sys
+
+sys.path.append(".")
+sys.path.append("./vendor")
+
+from appengine_django import InstallAppengineHelperForDjango
+InstallAppengineHelperForDjango()
+
+from google.appengine.ext.remote_api import remote_api_stub
+from google.appengine.ext import db
+
+from common import api
+from common import models
+
+class SubscriptionDeliveryBackfiller(object):
+  """Backfills Subscription.delivery for the subscriptions of all actors.
+
+  Subscriptions made before delivery was recorded have it empty. Once this
+  has run set SUBSCRIPTION_DELIVERY_SYNCED = True in settings so that the
+  notifications only read the subscriptions that asked for them.
+
+  This script should be idempotent - running it again would merely overwrite the
+  previous result.
+
+  Make sure to run it from the top jaikuengine directory. The following command
+  would execute the script against a local testing instance:
+  './bin/backfill_subscription_delivery.py -w 1 -s localhost:8080'
+  """
+
+  def __init__(self, do_write):
+    self._do_write = do_write
+
+  def get_actor_query(self):
+    q = models.Actor.all()
+    q.order("__key__")
+    return q
+
+  def run(self, batch_size=100):
+    """Copies every actor's notification settings onto their subscriptions."""
+    actor_refs = self.get_actor_query().fetch(batch_size)
+    actors_processed = 0
+    while actor_refs:
+      for actor_ref in actor_refs:
+        if self._do_write:
+          api._subscriptions_sync_delivery(actor_ref)
+        else:
+          logging.info("Would have set delivery to %s for %s",
+                       api._actor_delivery(actor_ref),
+                       actor_ref.nick)
+
+      actors_processed += len(actor_refs)
+      logging.info("Processed %d actors...", actors_processed)
+      q = self.get_actor_query()
+      q.filter("__key__ >", actor_refs[-1].key())
+      actor_refs = q.fetch(batch_size)
+
+
+def auth_function():
+  return (raw_input("Username: "), getpass.getpass("Password:"))
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option("-b", "--actor_batch_size", dest="actor_batch_size",
+                    default=100,
+                    help="number of actors to fetch in a single query")
+  parser.add_option("-w", "--write", dest="write", action="store_true",
+                    default=False, help="write results back to data store")
+  parser.add_option("-a", "--app_id", dest="app_id",
+                    help="the app_id of your app, as declared in app.yaml")
+  parser.add_option("-s", "--servername", dest="servername",
+                    help="the hostname your app is deployed on. Defaults to"
+                         "<app_id>.appspot.com")
+  (options, args) = parser.parse_args()
+  remote_api_stub.ConfigureRemoteDatastore(app_id=options.app_id,
+                                           path='/remote_api',
+                                           auth_func=auth_function,
+                                           servername=options.servername)
+
+  SubscriptionDeliveryBackfiller(options.write).run(int(options.actor_batch_size))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import getpass
+import logging
+import os
+import optparse
+import sys
+
+sys.path.append(".")
+sys.path.append("./vendor")
+
+from appengine_django import InstallAppengineHelperForDjango
+InstallAppengineHelperForDjango()
+
+from google.appengine.ext.remote_api import remote_api_stub
+from google.appengine.ext import db
+
+from common import api
+from common import models
+
+class TaskLaneBackfiller(object):
+  """Backfills Task.lane and Task.priority for the tasks in the queue.
+
+  Tasks made before the queue had lanes have neither stored, so the lane
+  queries in api._task_lease never see them and they are only leased once
+  both lanes are empty, which under steady load is never. This puts every
+  task back with the lane its progress calls for.
+
+  This script should be idempotent - running it again would merely overwrite the
+  previous result.
+
+  Make sure to run it from the top jaikuengine directory. The following command
+  would execute the script against a local testing instance:
+  './bin/backfill_task_lane.py -w 1 -s localhost:8080'
+  """
+
+  def __init__(self, do_write):
+    self._do_write = do_write
+
+  def get_task_query(self):
+    q = models.Task.all()
+    q.order("__key__")
+    return q
+
+  def run(self, batch_size=100):
+    """Sets the lane and priority of every task from its progress."""
+    task_refs = self.get_task_query().fetch(batch_size)
+    tasks_processed = 0
+    while task_refs:
+      for task_ref in task_refs:
+        task_ref.lane = api._task_lane(task_ref.action, task_ref.progress)
+        task_ref.priority = task_ref.priority or 0
+        if not self._do_write:
+          logging.info("Would have set lane to %s for %s",
+                       task_ref.lane,
+                       task_ref.key().name())
+      if self._do_write:
+        db.put(task_refs)
+
+      tasks_processed += len(task_refs)
+      logging.info("Processed %d tasks...", tasks_processed)
+      q = self.get_task_query()
+      q.filter("__key__ >", task_refs[-1].key())
+      task_refs = q.fetch(batch_size)
+
+
+def auth_function():
+  return (raw_input("Username: "), getpass.getpass("Password:"))
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option("-b", "--task_batch_size", dest="task_batch_size",
+                    default=100,
+                    help="number of tasks to fetch in a single query")
+  parser.add_option("-w", "--write", dest="write", action="store_true",
+                    default=False, help="write results back to data store")
+  parser.add_option("-a", "--app_id", dest="app_id",
+                    help="the app_id of your app, as declared in app.yaml")
+  parser.add_option("-s", "--servername", dest="servername",
+                    help="the hostname your app is deployed on. Defaults to"
+                         "<app_id>.appspot.com")
+  (options, args) = parser.parse_args()
+  remote_api_stub.ConfigureRemoteDatastore(app_id=options.app_id,
+                                           path='/remote_api',
+                                           auth_func=auth_function,
+                                           servername=options.servername)
+
+  TaskLaneBackfiller(options.write).run(int(options.task_batch_size))
+
+if __name__ == "__main__":
+  main()
@@ -19,9 +19,11 @@ from django.template import loader
 
 from common import api
 from common import clean
+from common import dataloader
 from common import decorator
 from common import display
 from common import exception
+from common import futures
 from common import normalize
 from common import user
 from common import util
@@ -143,9 +145,6 @@ def channel_history(request, nick, format='html'):
   if not view:
     return http.HttpResponseRedirect('/channel/create?channel=%s' % nick)
 
-  admins = api.channel_get_admins(request.user, channel=view.nick)
-  members = api.channel_get_members(request.user, channel=view.nick)
-
   handled = common_views.handle_view_action(
       request,
       {'channel_join': request.path,
@@ -161,42 +160,44 @@ def channel_history(request, nick, format='html'):
   if handled:
     return handled
 
-  privacy = 'public'
-
-  user_can_post = False
-  user_is_admin = False
-  if not request.user or request.user.is_anonymous():
-    pass
-  elif api.channel_has_admin(request.user, view.nick, request.user.nick):
-    privacy = 'private'
-    user_can_post = True
-    user_is_admin = True
-  elif api.channel_has_member(request.user, view.nick, request.user.nick):
-    privacy = 'contacts'
-    user_can_post = True
+  viewer = api.viewer_context(request.user, view)
+  privacy = viewer.privacy
+  user_can_post = viewer.is_admin or viewer.is_member
+  user_is_admin = viewer.is_admin
 
   per_page = CHANNEL_HISTORY_PER_PAGE
   offset, prev = util.page_offset(request)
 
+  # start all the queries for the page before waiting on any of them
+  admins_async = api.channel_get_admins_async(request.user, channel=view.nick)
+  members_async = api.channel_get_members_async(request.user,
+                                                channel=view.nick)
+
   if privacy == 'public':
-    inbox = api.inbox_get_actor_public(
+    inbox_async = api.inbox_get_actor_public_async(
         request.user,
         view.nick,
         limit=(per_page + 1),
         offset=offset)
   elif privacy == 'contacts':
-    inbox = api.inbox_get_actor_contacts(
+    inbox_async = api.inbox_get_actor_contacts_async(
         request.user,
         view.nick,
         limit=(per_page + 1),
         offset=offset)
   elif privacy == 'private':
-    inbox = api.inbox_get_actor_private(
+    inbox_async = api.inbox_get_actor_private_async(
         api.ROOT,
         view.nick,
         limit=(per_page + 1),
         offset=offset)
 
+  actor_streams_async = api.stream_get_actor_async(request.user, view.nick)
+  contact_nicks_async = api.actor_get_contacts_async(request.user, view.nick)
+
+  admins, members, inbox = futures.wait_all(
+      (admins_async, members_async, inbox_async))
+
   # START inbox generation chaos
   # TODO(termie): refacccttttooorrrrr
 
@@ -206,25 +207,23 @@ def channel_history(request, nick, format='html'):
   entries, more = util.page_entries(request, entries, per_page)
 
   stream_keys = [e.stream for e in entries]
-  actor_streams = api.stream_get_actor(request.user, view.nick)
+  actor_streams = actor_streams_async.get_result()
   stream_keys += [s.key().name() for s in actor_streams]
-  streams = api.stream_get_streams(request.user, stream_keys)
-
-  contact_nicks = api.actor_get_contacts(request.user, view.nick)
-  actor_nicks = (contact_nicks +
-                 admins +
-                 members +
-                 [view.nick] +
-                 [s.owner for s in streams.values()] +
-                 [e.actor for e in entries])
-  actors = api.actor_get_actors(request.user, actor_nicks)
+
+  contact_nicks = contact_nicks_async.get_result()
+
+  # register everything first so that it is all fetched in one go
+  data = dataloader.for_user(request.user)
+  data.want_streams(stream_keys)
+  data.want_entries(entries)
+  data.want_actors(contact_nicks + admins + members + [view.nick])
 
   # here comes lots of munging data into shape
-  contacts = [actors[x] for x in contact_nicks if actors[x]]
-  streams = display.prep_stream_dict(streams, actors)
-  entries = display.prep_entry_list(entries, streams, actors)
-  admins = [actors[x] for x in admins if actors[x]]
-  members = [actors[x] for x in members if actors[x]]
+  contacts = data.actor_list(contact_nicks)
+  streams = data.prep_streams(stream_keys)
+  entries = data.prep_entries(entries)
+  admins = data.actor_list(admins)
+  members = data.actor_list(members)
 
   # END inbox generation chaos
 
@@ -15,7 +15,9 @@
 import random
 import re
 import datetime
+import itertools
 import logging
+import traceback
 
 from cleanliness import cleaner
 from django.conf import settings
@@ -27,10 +29,11 @@ from google.appengine.api import images
 
 from common.models import Stream, StreamEntry, InboxEntry, Relation
 from common.models import Subscription, Invite, OAuthConsumer, OAuthRequestToken
-from common.models import OAuthAccessToken, Image, Activation
+from common.models import OAuthAccessToken, Image, Activation, Address
+from common.models import Digest
 from common.models import KeyValue, Presence
 from common.models import AbuseReport
-from common.models import Task
+from common.models import Task, DeadTask
 from common.models import PRIVACY_PRIVATE, PRIVACY_CONTACTS, PRIVACY_PUBLIC
 from django.contrib.auth.models import User
 
@@ -39,6 +42,7 @@ from common import clean
 from common import clock
 from common import context_processors
 from common import exception
+from common import futures
 from common import imageutil
 from common import mail
 from common import memcache
@@ -82,15 +86,54 @@ MAX_ADMINS_PER_ACTOR = 48
 # The default length of a task's visibility lock in seconds
 DEFAULT_TASK_EXPIRE = 10
 
+# The lanes of the task queue in the order they are served, interactive work
+# (the author's own inboxes, comments, IM and SMS) goes ahead of bulk work
+# (follower fan-out and email)
+TASK_LANES = ('interactive', 'bulk')
+
+# The share of each batch of tasks kept for the bulk lane so that it keeps
+# moving while the interactive lane is busy
+TASK_BULK_SHARE = 0.25
+
+# The number of times a task may fail before it is moved to the dead tasks
+TASK_MAX_ATTEMPTS = 5
+
+# Seconds before a failed task is retried, doubling with every failure
+TASK_RETRY_DELAY = 30
+TASK_RETRY_MAX_DELAY = 3600
+
+# Seconds a fan-out task that is waiting for its shards leaves it before it
+# checks on them again
+TASK_SHARD_WAIT_DELAY = 10
+
 # The maximum number of followers to process per task iteration of inboxes
 MAX_FOLLOWERS_PER_INBOX = 100
 
+# The maximum number of InboxEntry rows written in a single datastore call,
+# a fan-out shard covers this many pages of MAX_FOLLOWERS_PER_INBOX followers
+INBOX_WRITE_BATCH_SIZE = 5
+
+# The maximum number of fan-out shard tasks a post task creates per iteration
+MAX_SHARDS_PER_TASK = 20
+
 MAX_NOTIFICATIONS_PER_TASK = 100
 # The maximum number of followers we can notify per task iteration
 
+# The number of subscriptions updated per datastore call when an actor's
+# notification settings are copied onto them
+DELIVERY_SYNC_BATCH_SIZE = 100
+
 # The first notification type to handle
 FIRST_NOTIFICATION_TYPE = 'im'
 
+# The number of subscriptions marked per datastore call when a stream starts
+# being read by its followers rather than written to their inboxes
+FANOUT_ON_READ_BATCH_SIZE = 100
+
+# How long a rendered notification is kept for the later passes over the
+# subscribers of the same entry, in seconds
+NOTIFICATION_RENDER_TTL = 3600
+
 AVATAR_IMAGE_SIZES = { 'u': (30, 30),
                        't': (50, 50),
                        'f': (60, 60),
@@ -141,6 +184,140 @@ def _stream_from_args_kw(allowed, args, kw):
 
 
 # Better Access Control
+
+# The decisions made by the actor_owns_* and actor_can_view_* checks below are
+# remembered for the rest of the request, anything that changes privacy or
+# relations between actors must call _access_memo_clear()
+def _access_memoized(f):
+  def _wrap(actor_ref, other_ref):
+    memo = models.CachingModel.memo('access')
+    if memo is None or not other_ref or not other_ref.is_saved():
+      return f(actor_ref, other_ref)
+
+    key = (f.func_name,
+           getattr(actor_ref, 'nick', None),
+           getattr(actor_ref, 'access_level', DELETE_ACCESS),
+           other_ref.kind(),
+           other_ref.key().name())
+    if key not in memo:
+      memo[key] = f(actor_ref, other_ref)
+    return memo[key]
+
+  _wrap.func_name = f.func_name
+  _wrap.__doc__ = f.__doc__
+  return _wrap
+
+def _access_memo_clear():
+  for name in ('access', 'viewer_context'):
+    memo = models.CachingModel.memo(name)
+    if memo is not None:
+      memo.clear()
+
+class ViewerContext(object):
+  """How the viewer of a page relates to the actor who owns it
+
+  Use viewer_context() rather than creating these directly, it fetches the
+  relations involved in one batch and remembers the result for the rest of
+  the request.
+
+  ATTRIBUTES:
+    viewer - the viewing actor_ref, may be None or anonymous
+    owner - the actor_ref being viewed
+    anonymous - the viewer isn't logged in
+    is_owner - the viewer is the owner
+    is_contact - the owner (a user) has the viewer as a contact
+    follows - the viewer has the owner (a user) as a contact
+    is_admin - the viewer is an admin of the owner (a channel)
+    is_member - the viewer is a member of the owner (a channel)
+  """
+  def __init__(self, viewer, owner, anonymous=False, is_owner=False,
+               is_contact=False, follows=False, is_admin=False,
+               is_member=False):
+    self.viewer = viewer
+    self.owner = owner
+    self.anonymous = anonymous
+    self.is_owner = is_owner
+    self.is_contact = is_contact
+    self.follows = follows
+    self.is_admin = is_admin
+    self.is_member = is_member
+
+  @property
+  def privacy(self):
+    """which of the owner's inboxes the viewer gets to see: 'private',
+    'contacts' or 'public'"""
+    if self.is_owner or self.is_admin:
+      return 'private'
+    if self.is_contact or self.is_member:
+      return 'contacts'
+    return 'public'
+
+def viewer_context(api_user, owner_ref):
+  """returns the ViewerContext of api_user looking at owner_ref"""
+  return viewer_contexts(api_user, [owner_ref])[owner_ref.nick]
+
+def viewer_contexts(api_user, owner_refs):
+  """viewer_context() for several owners at once, the relations needed for
+  all of them are fetched in a single batch
+
+  RETURNS: {owner_nick: ViewerContext}
+  """
+  memo = models.CachingModel.memo('viewer_context')
+  viewer_nick = getattr(api_user, 'nick', None)
+
+  o = {}
+  pending = []
+  for owner_ref in owner_refs:
+    key = (viewer_nick, owner_ref.nick)
+    if memo is not None and key in memo:
+      o[owner_ref.nick] = memo[key]
+    elif not api_user or api_user.is_anonymous():
+      o[owner_ref.nick] = ViewerContext(api_user, owner_ref, anonymous=True)
+    elif viewer_nick == owner_ref.nick:
+      o[owner_ref.nick] = ViewerContext(api_user, owner_ref, is_owner=True)
+    else:
+      pending.append(owner_ref)
+
+  key_names = []
+  for owner_ref in pending:
+    key_names.extend(_viewer_context_keys(viewer_nick, owner_ref))
+  if key_names:
+    rel_refs = Relation.get_by_key_name(key_names)
+
+  for i, owner_ref in enumerate(pending):
+    first, second = rel_refs[2 * i], rel_refs[2 * i + 1]
+    if owner_ref.is_channel():
+      context = ViewerContext(api_user, owner_ref,
+                              is_admin=bool(first),
+                              is_member=bool(second))
+    else:
+      context = ViewerContext(api_user, owner_ref,
+                              is_contact=bool(first),
+                              follows=bool(second))
+    o[owner_ref.nick] = context
+
+  if memo is not None:
+    for nick, context in o.iteritems():
+      memo[(viewer_nick, nick)] = context
+  return o
+
+def _viewer_context_keys(viewer_nick, owner_ref):
+  """ the key names of the two relations a ViewerContext is made from: admin
+  and member of a channel, or contact in either direction for a user """
+  if owner_ref.is_channel():
+    return [Relation.key_from(relation='channeladmin',
+                              owner=owner_ref.nick,
+                              target=viewer_nick),
+            Relation.key_from(relation='channelmember',
+                              owner=owner_ref.nick,
+                              target=viewer_nick)]
+  return [Relation.key_from(relation='contact',
+                            owner=owner_ref.nick,
+                            target=viewer_nick),
+          Relation.key_from(relation='contact',
+                            owner=viewer_nick,
+                            target=owner_ref.nick)]
+
 def has_access(actor_ref, access_level):
   if not actor_ref:
     return False
@@ -157,6 +334,7 @@ def has_access(actor_ref, access_level):
     return True
   return False
 
+@_access_memoized
 def actor_owns_actor(actor_ref, other_ref):
   if not actor_ref or actor_ref.is_anonymous() or not other_ref:
     return False
@@ -171,13 +349,14 @@ def actor_owns_actor(actor_ref, other_ref):
   
   # if this is a channel, it is owned by its admins
   if (other_ref.is_channel() 
-      and channel_has_admin(ROOT, other_ref.nick, actor_ref.nick)
+      and viewer_context(actor_ref, other_ref).is_admin
       ):
     return True
 
   # well, we tried.
   return False  
 
+@_access_memoized
 def actor_owns_stream(actor_ref, stream_ref):
   if not stream_ref:
     return False
@@ -190,6 +369,7 @@ def actor_owns_stream(actor_ref, stream_ref):
     return False
   return actor_owns_actor(actor_ref, stream_owner_ref)
 
+@_access_memoized
 def actor_owns_entry(actor_ref, entry_ref):
   if not entry_ref:
     return False
@@ -221,6 +401,7 @@ def actor_owns_entry(actor_ref, entry_ref):
 
   return False
 
+@_access_memoized
 def actor_can_view_actor(actor_ref, other_ref):
   """ actor_ref can view other_ref """
   if not other_ref:
@@ -240,19 +421,17 @@ def actor_can_view_actor(actor_ref, other_ref):
 
   # other_ref is restricted
   if other_ref.is_restricted():
+    context = viewer_context(actor_ref, other_ref)
     # and we are a contact
-    if (not other_ref.is_channel() 
-        and actor_has_contact(ROOT, other_ref.nick, actor_ref.nick)
-        ):
+    if context.is_contact:
       return True
     # is a channel and we are a member (admin covered above by owner)
-    if (other_ref.is_channel()
-        and channel_has_member(ROOT, other_ref.nick, actor_ref.nick)
-        ):
+    if context.is_member:
       return True
 
   return False
 
+@_access_memoized
 def actor_can_view_stream(actor_ref, stream_ref):
   if not stream_ref:
     return False
@@ -280,6 +459,7 @@ def actor_can_view_stream(actor_ref, stream_ref):
 
   return False
 
+@_access_memoized
 def actor_can_view_entry(actor_ref, entry_ref):
   if not entry_ref:
     return False
@@ -585,14 +765,19 @@ def activation_get(api_user, nick, type, content):
   key_name = Activation.key_from(actor=nick, type=type, content=content)
   return Activation.get_by_key_name(key_name)
 
-@owner_required
-def activation_get_actor_email(api_user, nick):
+def _activation_get_actor_email_future(nick):
   query = Activation.gql('WHERE type = :1 AND actor = :2',
                          'email',
                          nick)
+  return futures.run_async(query)
 
-  activations = list(query.run())
-  return activations
+@owner_required
+def activation_get_actor_email(api_user, nick):
+  return _activation_get_actor_email_future(nick).get_result()
+
+@owner_required
+def activation_get_actor_email_async(api_user, nick):
+  return _activation_get_actor_email_future(nick)
 
 def activation_get_by_email(api_user, email):
   query = Activation.gql('WHERE type = :1 AND content = :2',
@@ -747,6 +932,7 @@ def actor_add_contact(api_user, owner, target):
                        target=target_ref.nick,
                        )
     rel_ref.put()
+    _access_memo_clear()
   else:
     rel_ref = existing_rel_ref
 
@@ -916,7 +1102,10 @@ def actor_get(api_user, nick):
     
   if actor_ref.is_deleted():
     raise exception.ApiDeleted(not_found_message)
-  
+
+  return _actor_result(api_user, actor_ref)
+
+def _actor_result(api_user, actor_ref):
   if actor_can_view_actor(api_user, actor_ref):
     return ResultWrapper(actor_ref, actor=actor_ref)
 
@@ -933,15 +1122,13 @@ def actor_get_actors(api_user, nicks):
   if not nicks:
     return o
 
-  for nick in nicks:
-    try:
-      actor = actor_get(api_user, nick)
-    except exception.ApiException:
-      actor = None
-    except exception.ValidationError:
-      logging.warn('Validation error for nick: %s' % nick)
-      actor = None
-    o[nick] = actor
+  actor_refs = _get_actor_refs(nicks)
+  viewer_contexts(api_user,
+                  [a for a in actor_refs.values() if a and not a.is_public()])
+  for nick, actor_ref in actor_refs.iteritems():
+    if actor_ref:
+      actor_ref = _actor_result(api_user, actor_ref)
+    o[nick] = actor_ref
 
   return o
 
@@ -956,15 +1143,22 @@ def actor_get_channels_admin(api_user, nick, limit=48, offset=None):
   rv = query.fetch(limit)
   return [x.owner for x in rv]
 
-@public_owner_or_contact
-def actor_get_channels_member(api_user, nick, limit=48, offset=None):
-  """returns the channels the given actor is a member of"""
+def _actor_get_channels_member_future(nick, limit, offset):
   query = Relation.gql('WHERE target = :1 AND relation = :2 AND owner > :3',
                        nick,
                        'channelmember',
                        offset)
-  rv = query.fetch(limit)
-  return [x.owner for x in rv]
+  return futures.fetch_async(query, limit).then(
+      lambda rv: [x.owner for x in rv])
+
+@public_owner_or_contact
+def actor_get_channels_member(api_user, nick, limit=48, offset=None):
+  """returns the channels the given actor is a member of"""
+  return _actor_get_channels_member_future(nick, limit, offset).get_result()
+
+@public_owner_or_contact
+def actor_get_channels_member_async(api_user, nick, limit=48, offset=None):
+  return _actor_get_channels_member_future(nick, limit, offset)
 
 def actor_get_channels_member_safe(api_user, nick, limit=48, offset=None):
   try:
@@ -972,15 +1166,29 @@ def actor_get_channels_member_safe(api_user, nick, limit=48, offset=None):
   except exception.ApiException:
     return []
 
-@public_owner_or_contact
-def actor_get_contacts(api_user, nick, limit=48, offset=None):
-  """returns the contacts for the given actor if current_actor can view them"""
+def actor_get_channels_member_safe_async(api_user, nick, limit=48,
+                                         offset=None):
+  try:
+    return actor_get_channels_member_async(api_user, nick, limit, offset)
+  except exception.ApiException:
+    return futures.Future(value=[])
+
+def _actor_get_contacts_future(nick, limit, offset):
   query = Relation.gql('WHERE owner = :1 AND relation = :2 AND target > :3',
                        nick,
                        'contact',
                        offset)
-  results = query.fetch(limit)
-  return [x.target for x in results]
+  return futures.fetch_async(query, limit).then(
+      lambda results: [x.target for x in results])
+
+@public_owner_or_contact
+def actor_get_contacts(api_user, nick, limit=48, offset=None):
+  """returns the contacts for the given actor if current_actor can view them"""
+  return _actor_get_contacts_future(nick, limit, offset).get_result()
+
+@public_owner_or_contact
+def actor_get_contacts_async(api_user, nick, limit=48, offset=None):
+  return _actor_get_contacts_future(nick, limit, offset)
 
 def actor_get_contacts_safe(api_user, nick, limit=48, offset=None):
   try:
@@ -988,6 +1196,12 @@ def actor_get_contacts_safe(api_user, nick, limit=48, offset=None):
   except exception.ApiException:
      return []
 
+def actor_get_contacts_safe_async(api_user, nick, limit=48, offset=None):
+  try:
+    return actor_get_contacts_async(api_user, nick, limit, offset)
+  except exception.ApiException:
+    return futures.Future(value=[])
+
 @owner_required
 def actor_get_contacts_since(api_user, nick, limit=30, since_time=None):
   """returns the contacts for the given actor if current_actor can view them"""
@@ -1122,6 +1336,7 @@ def actor_remove(api_user, nick):
 
   if actor_ref:
     actor_ref.mark_as_deleted()
+    _access_memo_clear()
     return True
 
   return False
@@ -1144,6 +1359,7 @@ def actor_remove_contact(api_user, owner, target):
         0, 'Cannot remove a relationship that does not exist')
 
   rel.delete()
+  _access_memo_clear()
 
   # Decrease the counts for each
   owner_ref.extra.setdefault('contact_count', 1)
@@ -1395,6 +1611,7 @@ def channel_create(api_user, **kw):
                      target=creator_ref.nick,
                      )
   rel_ref.put()
+  _access_memo_clear()
 
   # create the presence stream for the channel
   stream_ref = stream_create_presence(api_user,
@@ -1432,12 +1649,20 @@ def channel_get(api_user, channel):
 
   return channel_ref
 
-@public_owner_or_member
-def channel_get_admins(api_user, channel, limit=24):
+def _channel_get_admins_future(channel, limit):
   query = Relation.gql('WHERE owner = :1 AND relation = :2',
                        channel,
                        'channeladmin')
-  return [a.target for a in query.fetch(limit)]
+  return futures.fetch_async(query, limit).then(
+      lambda rv: [a.target for a in rv])
+
+@public_owner_or_member
+def channel_get_admins(api_user, channel, limit=24):
+  return _channel_get_admins_future(channel, limit).get_result()
+
+@public_owner_or_member
+def channel_get_admins_async(api_user, channel, limit=24):
+  return _channel_get_admins_future(channel, limit)
 
 # depends on channel_get's privacy
 def channel_get_channels(api_user, channels):
@@ -1456,21 +1681,34 @@ def channel_get_channels(api_user, channels):
   if not channels:
     return channel_refs
 
-  for nick in channels:
-    channel = channel_get_safe(api_user, nick)
+  actor_refs = _get_actor_refs(channels, clean_nick=clean.channel)
+  viewer_contexts(api_user,
+                  [a for a in actor_refs.values() if a and not a.is_public()])
+  is_admin = has_access(api_user, ADMIN_ACCESS)
+  for nick, channel in actor_refs.iteritems():
+    if channel and not (is_admin or actor_can_view_actor(api_user, channel)):
+      channel = None
 
     # Will be set to None if the channel doesn't exist (or was deleted)
     channel_refs[nick] = channel
 
   return channel_refs
 
-@public_owner_or_member
-def channel_get_members(api_user, channel, limit=24, offset=None):
+def _channel_get_members_future(channel, limit):
   query = Relation.gql('WHERE owner = :1 AND relation = :2 AND target > :3',
                        channel,
                        'channelmember',
                        None)
-  return [a.target for a in query.fetch(limit)]
+  return futures.fetch_async(query, limit).then(
+      lambda rv: [a.target for a in rv])
+
+@public_owner_or_member
+def channel_get_members(api_user, channel, limit=24, offset=None):
+  return _channel_get_members_future(channel, limit).get_result()
+
+@public_owner_or_member
+def channel_get_members_async(api_user, channel, limit=24, offset=None):
+  return _channel_get_members_future(channel, limit)
 
 def channel_get_safe(api_user, channel):
   """Retrieve the specified channel, if it has not been deleted.
@@ -1521,6 +1759,7 @@ def channel_join(api_user, nick, channel):
                  target=actor_ref.nick,
                  )
   rel.put()
+  _access_memo_clear()
 
   # TODO probably a race-condition
   count = channel_ref.extra['member_count']
@@ -1555,6 +1794,7 @@ def channel_part(api_user, nick, channel):
   rel_ref = Relation.get_by_key_name(key_name)
 
   rel_ref.delete()
+  _access_memo_clear()
 
   channel_ref.extra['member_count'] -= 1
   channel_ref.put()
@@ -1677,6 +1917,8 @@ def email_associate(api_user, nick, email):
   relation_ref.put()
   # XXX end transaction
 
+  _address_sync(actor_ref)
+  _subscriptions_sync_delivery(actor_ref)
   return relation_ref
 
 @owner_required
@@ -1694,7 +1936,7 @@ def email_get_actor(api_user, nick):
 # we use these simple wrapper functions for email sending.
 @admin_required
 def email_mass_send(api_user, message_tuples):
-  mail.mass_send(message_tuples)
+  return mail.mass_send(message_tuples)
 
 @admin_required
 def email_send(api_user, email, subject, message, on_behalf=None, html_message=None):
@@ -1919,7 +2161,13 @@ def entry_get_entries_dict(api_user, entries, hide_comments=False):
   if not entries:
     return out
 
-  for entry in set(entries):
+  entries = set(entries)
+
+  # warm the request cache so that the access and existence checks done by
+  # entry_get below don't cost a datastore get each
+  _prefetch_entries(entries)
+
+  for entry in entries:
     entry_ref = entry_get_safe(api_user, entry)
     if entry_ref:
       if not hide_comments:
@@ -1995,17 +2243,25 @@ def entry_get_actor_overview_since(api_user, nick, limit=30, since_time=None):
   return entry_get_inbox_since(
       api_user, inbox, limit=limit, since_time=since_time)
 
+def _entry_get_last_future(api_user, stream):
+  query = StreamEntry.gql('WHERE stream = :1 ORDER BY created_at DESC',
+                          stream)
+  def _entry(rv):
+    if not rv:
+      return None
+    return entry_get(api_user, rv[0].key().name())
+  return futures.fetch_async(query, 1).then(_entry)
+
 @public_owner_or_contact_by_stream
 def entry_get_last(api_user, stream):
   """ Queries the StreamEntry entities to find the last StreamEntry
   for the given stream.
   """
-  query = StreamEntry.gql('WHERE stream = :1 ORDER BY created_at DESC',
-                          stream)
-  entry_ref = query.get()
-  if not entry_ref:
-    return None
-  return entry_get(api_user, entry_ref.key().name())
+  return _entry_get_last_future(api_user, stream).get_result()
+
+@public_owner_or_contact_by_stream
+def entry_get_last_async(api_user, stream):
+  return _entry_get_last_future(api_user, stream)
 
 def entry_get_uuid(api_user, uuid):
   """ Queries the StreamEntry entities to find the StreamEntry corresponding to
@@ -2044,6 +2300,7 @@ def entry_remove(api_user, entry):
   if entry_ref.entry:
     raise exception.ApiException(0x00, "Cannot call entry_remove on a comment")
   entry_ref.mark_as_deleted()
+  _access_memo_clear()
 
 @delete_required
 @owner_required_by_entry
@@ -2063,6 +2320,7 @@ def entry_remove_comment(api_user, comment):
 
   entry_ref.put()
   comment_ref.mark_as_deleted()
+  _access_memo_clear()
   # XXX end transaction
 
 #######
@@ -2121,6 +2379,9 @@ def im_associate(api_user, nick, im):
                      target=im,
                      )
   rel_ref.put()
+
+  _address_sync(actor_ref)
+  _subscriptions_sync_delivery(actor_ref)
   return rel_ref
 
 @admin_required
@@ -2132,6 +2393,9 @@ def im_disassociate(api_user, nick, im):
                                target=im)
   rel_ref = Relation.get_by_key_name(key_name)
   rel_ref.delete()
+
+  _address_sync(actor_ref)
+  _subscriptions_sync_delivery(actor_ref)
   return
 
 @owner_required
@@ -2198,11 +2462,13 @@ def inbox_copy_entries(api_user, target, nick, limit=5):
   inbox = 'inbox/%s/public' % target
   query = InboxEntry.Query().filter('inbox =', inbox).order('-created_at')
   results = query.fetch(limit=limit)
+  writer = _InboxWriter()
   for entry in results:
     inbox_item = 'inbox/%s/overview' % nick
     if inbox_item not in entry.inbox:
       entry.inbox.append(inbox_item)
-    entry.put()
+      writer.add(entry)
+  writer.flush()
   return
 
 @public_owner_or_contact
@@ -2212,6 +2478,13 @@ def inbox_get_actor_contacts(api_user, nick, limit=5, offset=None,
   inbox = 'inbox/%s/contacts' % nick
   return inbox_get_entries(api_user, inbox, limit, offset, stream_type)
 
+@public_owner_or_contact
+def inbox_get_actor_contacts_async(api_user, nick, limit=5, offset=None, 
+                                   stream_type=None):
+  nick = clean.nick(nick)
+  inbox = 'inbox/%s/contacts' % nick
+  return inbox_get_entries_async(api_user, inbox, limit, offset, stream_type)
+
 @owner_required
 def inbox_get_actor_overview(api_user, nick, limit=5, offset=None, 
                              stream_type=None):
@@ -2219,6 +2492,13 @@ def inbox_get_actor_overview(api_user, nick, limit=5, offset=None,
   inbox = 'inbox/%s/overview' % nick
   return inbox_get_entries(api_user, inbox, limit, offset, stream_type)
 
+@owner_required
+def inbox_get_actor_overview_async(api_user, nick, limit=5, offset=None, 
+                                   stream_type=None):
+  nick = clean.nick(nick)
+  inbox = 'inbox/%s/overview' % nick
+  return inbox_get_entries_async(api_user, inbox, limit, offset, stream_type)
+
 @owner_required
 def inbox_get_actor_private(api_user, nick, limit=5, offset=None, 
                             stream_type=None):
@@ -2226,14 +2506,37 @@ def inbox_get_actor_private(api_user, nick, limit=5, offset=None,
   inbox = 'inbox/%s/private' % nick
   return inbox_get_entries(api_user, inbox, limit, offset)
 
+@owner_required
+def inbox_get_actor_private_async(api_user, nick, limit=5, offset=None, 
+                                  stream_type=None):
+  nick = clean.nick(nick)
+  inbox = 'inbox/%s/private' % nick
+  return inbox_get_entries_async(api_user, inbox, limit, offset)
+
 def inbox_get_actor_public(api_user, nick, limit=5, offset=None, 
                            stream_type=None):
   nick = clean.nick(nick)
   inbox = 'inbox/%s/public' % nick
   return inbox_get_entries(api_user, inbox, limit, offset, stream_type)
 
+def inbox_get_actor_public_async(api_user, nick, limit=5, offset=None, 
+                                 stream_type=None):
+  nick = clean.nick(nick)
+  inbox = 'inbox/%s/public' % nick
+  return inbox_get_entries_async(api_user, inbox, limit, offset, stream_type)
+
 def inbox_get_entries(api_user, inbox, limit=30, offset=None, 
                       stream_type=None):
+  return inbox_get_entries_async(
+      api_user, inbox, limit, offset, stream_type).get_result()
+
+def inbox_get_entries_async(api_user, inbox, limit=30, offset=None, 
+                            stream_type=None):
+  """inbox_get_entries as a futures.Future
+
+  The entries of any fan-out-on-read streams the inbox follows are merged in
+  with the ones that were written to it, see _fanout_on_read.
+  """
   limit = clean.limit(limit)
   query = InboxEntry.Query().filter('inbox =', inbox).order('-created_at')
   if offset is not None:
@@ -2242,11 +2545,47 @@ def inbox_get_entries(api_user, inbox, limit=30, offset=None,
   if stream_type is not None:
     query.filter('stream_type =', stream_type)
 
-  results = query.fetch(limit=limit)
-  return [x.stream_entry_keyname() for x in results]
+  inbox_async = futures.fetch_async(query, limit)
+  topics = _fanout_on_read_topics(inbox, stream_type)
+  if not topics:
+    return inbox_async.then(
+        lambda results: [x.stream_entry_keyname() for x in results])
+
+  # start them all before merging any of them
+  pending = [inbox_async.then(
+      lambda results: [(x.created_at, x.stream_entry_keyname())
+                       for x in results])]
+  for topic in topics:
+    query = StreamEntry.Query().filter('stream =', topic)
+    if offset is not None:
+      query.filter('created_at <=', offset)
+    query.order('-created_at')
+    pending.append(futures.fetch_async(query, limit).then(
+        lambda results: [(x.created_at, x.keyname()) for x in results]))
+
+  def _merge():
+    rv = []
+    seen = set()
+    merged = util.merge_sorted(futures.wait_all(pending),
+                               key=lambda x: x[0],
+                               reverse=True)
+    for created_at, key_name in merged:
+      if key_name in seen:
+        continue
+      seen.add(key_name)
+      rv.append(key_name)
+      if len(rv) >= limit:
+        break
+    return rv
+  return futures.Future(_merge)
 
 def inbox_get_entries_since(api_user, inbox, limit=30, since_time=None, 
                             stream_type=None):
+  """the inbox entries created on or after since_time, oldest first
+
+  Like inbox_get_entries_async the entries of the fan-out-on-read streams
+  the inbox follows are merged in.
+  """
   limit = clean.limit(limit)
   query = InboxEntry.Query().filter('inbox =', inbox).order('created_at')
   if since_time is not None:
@@ -2256,8 +2595,34 @@ def inbox_get_entries_since(api_user, inbox, limit=30, since_time=None,
   if stream_type is not None:
     query.filter('stream_type =', stream_type)
 
-  results = query.fetch(limit=limit)
-  return [x.stream_entry_keyname() for x in results]
+  topics = _fanout_on_read_topics(inbox, stream_type)
+  if not topics:
+    results = query.fetch(limit=limit)
+    return [x.stream_entry_keyname() for x in results]
+
+  # as in inbox_get_entries_async, oldest first this time
+  pending = [futures.fetch_async(query, limit).then(
+      lambda results: [(x.created_at, x.stream_entry_keyname())
+                       for x in results])]
+  for topic in topics:
+    query = StreamEntry.Query().filter('stream =', topic)
+    if since_time is not None:
+      query.filter('created_at >=', since_time)
+    query.order('created_at')
+    pending.append(futures.fetch_async(query, limit).then(
+        lambda results: [(x.created_at, x.keyname()) for x in results]))
+
+  rv = []
+  seen = set()
+  merged = util.merge_sorted(futures.wait_all(pending), key=lambda x: x[0])
+  for created_at, key_name in merged:
+    if key_name in seen:
+      continue
+    seen.add(key_name)
+    rv.append(key_name)
+    if len(rv) >= limit:
+      break
+  return rv
 
 def inbox_get_explore(api_user, limit=30, offset=None):
   inbox = 'inbox/%s/explore' % ROOT.nick
@@ -2452,6 +2817,8 @@ def mobile_associate(api_user, nick, mobile):
   relation_ref.put()
   # XXX end transaction
 
+  _address_sync(actor_ref)
+  _subscriptions_sync_delivery(actor_ref)
   return relation_ref
 
 @admin_required
@@ -2471,6 +2838,9 @@ def mobile_disassociate(api_user, nick, mobile):
                                target=mobile)
   rel_ref = Relation.get_by_key_name(key_name)
   rel_ref.delete()
+
+  _address_sync(actor_ref)
+  _subscriptions_sync_delivery(actor_ref)
   return
 
 @owner_required
@@ -2488,6 +2858,87 @@ def mobile_get_actor(api_user, nick):
 #######
 #######
 
+def _digest_held_for_actor(service, thread, nick):
+  """ returns all the Digest rows held for nick on thread, a batch at a
+  time """
+  digest_refs = []
+  offset = None
+  while True:
+    query = Digest.Query().filter('service =', service)
+    query.filter('thread =', thread)
+    query.filter('actor =', nick)
+    query.order('entry')
+    if offset is not None:
+      query.filter('entry >', offset)
+    batch = query.fetch(MAX_NOTIFICATIONS_PER_TASK)
+    digest_refs += batch
+    if len(batch) < MAX_NOTIFICATIONS_PER_TASK:
+      return digest_refs
+    offset = batch[-1].entry
+
+def notification_send_digests(api_user, service, thread, _task_ref=None):
+  """ sends the comment notifications for service that were held back for
+  the subscribers of thread, see _digest_hold()
+
+  This is run from the queue once the digest window is up, a batch of
+  recipients at a time.
+  """
+  query = Digest.Query().filter('service =', service)
+  query.filter('thread =', thread)
+  query.order('actor')
+  digest_refs = query.fetch(MAX_NOTIFICATIONS_PER_TASK + 1)
+  more = len(digest_refs) > MAX_NOTIFICATIONS_PER_TASK
+  digest_refs = digest_refs[:MAX_NOTIFICATIONS_PER_TASK]
+  if more:
+    # the last actor's comments may carry on past this batch, leave them
+    # for the next one so that they all go out together
+    rest = [d for d in digest_refs if d.actor != digest_refs[-1].actor]
+    if rest:
+      digest_refs = rest
+    else:
+      # one actor has the whole batch to themselves, go get the rest of
+      # theirs rather than send them half a digest
+      digest_refs = _digest_held_for_actor(service,
+                                           thread,
+                                           digest_refs[-1].actor)
+
+  held = {}
+  for digest_ref in digest_refs:
+    held.setdefault(digest_ref.actor, []).append(digest_ref.entry)
+
+  # there is nothing to tell anybody about an entry that has gone
+  entry_ref = entry_get_safe(ROOT, thread)
+  if entry_ref and held:
+    if service == 'im':
+      _digest_send_im(held, entry_ref)
+    elif service == 'email':
+      _digest_send_email(held, entry_ref)
+
+    # the digest counts as a notification, so the window starts over
+    window_keys = dict([(_digest_window_key(service, nick, thread), 1)
+                        for nick in held])
+    memcache.client.set_multi(window_keys,
+                              time=settings.NOTIFICATION_DIGEST_WINDOW)
+
+  # only the rows that were sent, any held while this was running are left
+  # for the next task
+  Digest.delete_multi(digest_refs)
+
+  if not _task_ref:
+    return
+  if more:
+    memcache.client.delete(_task_ref.key().name())
+    return
+
+  task_remove(ROOT, _task_ref.actor, _task_ref.action, _task_ref.action_id)
+  # anything held back while this was running needs a task of its own
+  if entry_ref and query.get():
+    _digest_schedule(service, entry_ref)
+
+#######
+#######
+#######
+
 def oauth_authorize_request_token(api_user, key, actor, perms="read"):
   # TODO validate perms
   # TODO privacy
@@ -2748,7 +3199,12 @@ def post(api_user, _task_ref=None, **kw):
     #presence = _set_presence(**values)
     entry_ref = _add_entry(stream_ref, new_values=values)
     subscribers = _subscribers_for_entry(stream_ref, entry_ref)
-    inboxes = _add_inboxes_for_entry(subscribers, stream_ref, entry_ref)
+    inboxes = subscribers
+    if _fanout_on_read(actor_ref, stream_ref, entry_ref):
+      own_inbox = 'inbox/%s/overview' % entry_ref.owner
+      inboxes = [i for i in subscribers
+                 if i == own_inbox or not i.endswith('/overview')]
+    inboxes = _add_inboxes_for_entry(inboxes, stream_ref, entry_ref)
     _notify_subscribers_for_entry(subscribers, 
                                   actor_ref, 
                                   stream_ref, 
@@ -2801,8 +3257,25 @@ def presence_get_actors(api_user, nicks):
   if not nicks:
     return o
 
-  for nick in nicks:
-    o[nick] = presence_get_safe(api_user, nick)
+  actor_refs = _get_actor_refs(nicks)
+  viewer_contexts(api_user,
+                  [a for a in actor_refs.values() if a and not a.is_public()])
+  is_admin = has_access(api_user, ADMIN_ACCESS)
+  viewable = []
+  for nick, actor_ref in actor_refs.iteritems():
+    o[nick] = None
+    if actor_ref and (is_admin or actor_can_view_actor(api_user, actor_ref)):
+      viewable.append(nick)
+
+  if viewable:
+    presence_refs = Presence.get_by_key_name(
+        ['presence/%s/current' % actor_refs[nick].nick for nick in viewable])
+    for nick, presence_ref in zip(viewable, presence_refs):
+      if presence_ref:
+        o[nick] = ResultWrapper(presence_ref, presence=presence_ref)
+      else:
+        # presence_get falls back to the latest post
+        o[nick] = presence_get_safe(api_user, nick)
   return ResultWrapper(o, actors=o)
 
 @owner_required
@@ -2878,9 +3351,21 @@ def presence_set(api_user, nick, **kw):
 #######
 #######
 
+def _task_lane(action, progress):
+  """ returns the lane for a task of type action that has got to progress """
+  if not progress:
+    return 'interactive'
+  if progress.startswith('notifications:email:'):
+    return 'bulk'
+  if progress.startswith('notifications:'):
+    return 'interactive'
+  if action == 'entry_add_comment' and progress.startswith('inboxes:'):
+    return 'interactive'
+  return 'bulk'
+
 @owner_required
 def task_create(api_user, nick, action, action_id, args=None, kw=None, 
-                progress=None, expire=None):
+                progress=None, expire=None, priority=0, not_before=None):
   if args is None:
     args = []
   if kw is None:
@@ -2899,7 +3384,10 @@ def task_create(api_user, nick, action, action_id, args=None, kw=None,
                   expire=None,
                   args=args,
                   kw=kw,
-                  progress=progress
+                  progress=progress,
+                  lane=_task_lane(action, progress),
+                  priority=priority,
+                  not_before=not_before
                   )
   task_ref.put()
   return task_ref
@@ -2946,24 +3434,118 @@ def task_process_actor(api_user, nick):
   return task_process_any(ROOT, nick)
  
 @admin_required   
-def task_process_any(api_user, nick=None):
+def task_process_any(api_user, nick=None, work_count=1, time_budget=None):
+  """ process tasks from the queue
+
+  Leases up to work_count tasks at a time and runs them one after the other.
+  If time_budget (in seconds) is given it goes on to lease more until that
+  much time has gone by, whatever was leased but not started by then is
+  released for other workers. Every task checkpoints its own progress with
+  task_update as it goes, so stopping between tasks loses nothing.
+
+  RETURNS: the key names of the tasks that were processed
+  """
+  deadline = None
+  lease_period = DEFAULT_TASK_EXPIRE
+  if time_budget:
+    deadline = utcnow() + datetime.timedelta(seconds=time_budget)
+    # a task can wait for the rest of the batch before its turn comes
+    lease_period += int(time_budget)
+
+  processed = []
+  while True:
+    try:
+      work = _task_lease(nick, work_count, lease_period)
+    except exception.ApiNoTasks:
+      if processed:
+        break
+      raise
+
+    remaining = list(work)
+    try:
+      while remaining:
+        if deadline and utcnow() >= deadline:
+          break
+        task_ref = remaining.pop(0)
+        _task_process(task_ref)
+        processed.append(task_ref.key().name())
+    finally:
+      if remaining:
+        _task_release(remaining)
+
+    if not work or not deadline or utcnow() >= deadline:
+      break
+
+  return processed
+
+def _task_lease(nick, work_count, lease_period):
+  """ locks up to work_count tasks for lease_period seconds, taking them
+  from the lanes in order but keeping a share of the batch for bulk work """
+  bulk_count = int(work_count * TASK_BULK_SHARE)
+  found = False
+  work = []
+  for lane in TASK_LANES:
+    if lane == 'bulk':
+      lane_count = work_count - len(work)
+    else:
+      lane_count = work_count - len(work) - bulk_count
+    if lane_count <= 0:
+      continue
+
+    query = Task.all().filter('lane =', lane)
+    if nick:
+      query.filter('actor =', nick)
+    query.order('priority').order('created_at')
+    lane_work, lane_found = _task_lease_from(query, lane_count, lease_period)
+    work += lane_work
+    found = found or lane_found
+
+  if not found:
+    # tasks from before there were lanes, bin/backfill_task_lane.py puts
+    # them in one so that they don't have to wait for both to be empty
+    if nick:
+      query = Task.gql('WHERE actor = :1 ORDER BY created_at',
+                       nick)
+    else:
+      query = Task.gql('ORDER BY created_at')
+    work, found = _task_lease_from(query, work_count, lease_period)
+
+  if not found:
+    raise exception.ApiNoTasks('No tasks')
+  return work
+
+def _task_interleave(tasks):
+  """ reorders tasks so that each actor gets a turn before anybody gets a
+  second one, one actor's fan-out then can't crowd out everybody else """
+  seen = {}
+  ranked = []
+  for i, task_ref in enumerate(tasks):
+    rank = seen.get(task_ref.actor, 0)
+    seen[task_ref.actor] = rank + 1
+    ranked.append((rank, i, task_ref))
+  ranked.sort()
+  return [task_ref for rank, i, task_ref in ranked]
+
+def _task_lease_from(query, work_count, lease_period):
+  """ locks up to work_count of the tasks at the front of query
+
+  RETURNS: (tasks, whether the query had any tasks at all)
+  """
   # Basing this code largely off of pubsubhubbub's queueing approach
-  # Hard-coded for now, these will get moved up
-  work_count = 1
   sample_ratio = 10
   lock_ratio = 4
-  lease_period = DEFAULT_TASK_EXPIRE
   sample_size = work_count * sample_ratio
 
-  if nick:
-    query = Task.gql('WHERE actor = :1 ORDER BY created_at',
-                     nick)
-  else:
-    query = Task.gql('ORDER BY created_at')
-  
   work_to_do = query.fetch(sample_size)
   if not work_to_do:
-    raise exception.ApiNoTasks('No tasks')
+    return [], False
+
+  # leave alone the ones that are waiting to be retried
+  now = utcnow()
+  work_to_do = _task_interleave([w for w in work_to_do
+                                 if not w.not_before or w.not_before <= now])
+  if not work_to_do:
+    return [], True
 
   # From pubsububhub:
   # Attempt to lock more work than we actually need to do, since there likely
@@ -2971,6 +3553,9 @@ def task_process_any(api_user, nick=None):
   # high. If we've acquired more than we can use, we'll just delete the memcache
   # key and unlock the work. This is much better than an iterative solution,
   # since a single locking API call per worker reduces the locking window.
+  # The sample is taken from the front of the queue rather than all of it so
+  # that priorities and the turns between actors still mostly hold.
+  work_to_do = work_to_do[:2 * lock_ratio * work_count]
   possible_work = random.sample(work_to_do,
                                 min(len(work_to_do), 
                                     lock_ratio * work_count)
@@ -2979,41 +3564,109 @@ def task_process_any(api_user, nick=None):
   try_lock_map = dict((k, 'owned') for k in work_map)
   not_set_keys = set(memcache.client.add_multi(try_lock_map, time=lease_period))
   if len(not_set_keys) == len(try_lock_map):
-    return
+    return [], True
   
-  locked_keys = [k for k in work_map if k not in not_set_keys]
+  # and of what we got, keep the ones nearest the front
+  locked_keys = [str(w.key().name()) for w in work_to_do
+                 if str(w.key().name()) in work_map
+                 and str(w.key().name()) not in not_set_keys]
   reset_keys = locked_keys[work_count:]
   if reset_keys and not memcache.client.delete_multi(reset_keys):
     logging.warning('Could not reset acquired work for model %s: %s',
                     'Task', reset_keys)
 
-  work = [work_map[k] for k in locked_keys[:work_count]]
-  
-  for task_ref in work:
-    logging.info("Processing task: %s %s %s p=%s", 
-                  task_ref.actor,
-                  task_ref.action, 
-                  task_ref.action_id,
-                  task_ref.progress
-                  )
+  return [work_map[k] for k in locked_keys[:work_count]], True
 
-    try:
-      actor_ref = actor_get(ROOT, task_ref.actor)
+def _task_release(work):
+  """ unlocks leased tasks that weren't processed """
+  keys = [str(w.key().name()) for w in work]
+  if not memcache.client.delete_multi(keys):
+    logging.warning('Could not release leased work for model %s: %s',
+                    'Task', keys)
 
-      method_ref = PublicApi.get_method(task_ref.action)
+def _task_process(task_ref):
+  logging.info("Processing task: %s %s %s p=%s", 
+                task_ref.actor,
+                task_ref.action, 
+                task_ref.action_id,
+                task_ref.progress
+                )
 
-      rv = method_ref(actor_ref, 
-                      _task_ref = task_ref, 
-                      *task_ref.args, 
-                      **task_ref.kw)
+  try:
+    actor_ref = actor_get(ROOT, task_ref.actor)
 
-    except exception.ApiDeleted:
-      logging.warning('Owner or target of task has been deleted. Removing task.')
-      task_ref.delete()
-      return
+    # tasks are only ever made by us so they may use the root methods
+    method_ref = PublicApi.get_method(task_ref.action, ROOT)
 
-  return
+    rv = method_ref(actor_ref, 
+                    _task_ref = task_ref, 
+                    *task_ref.args, 
+                    **task_ref.kw)
+
+  except exception.ApiDeleted:
+    logging.warning('Owner or target of task has been deleted. Removing task.')
+    task_ref.delete()
+  except Exception:
+    exception.log_exception()
+    _task_failed(task_ref, traceback.format_exc())
+
+def _task_failed(task_ref, error):
+  """ schedules a task that raised error to be retried later, or moves it
+  to the dead tasks once it has failed TASK_MAX_ATTEMPTS times """
+  key_name = task_ref.key().name()
+
+  # the task may have got further, or been removed, before it failed
+  task_ref = Task.get_by_key_name(key_name)
+  if not task_ref:
+    return
+
+  task_ref.attempts = (task_ref.attempts or 0) + 1
+  task_ref.last_error = error
+  if task_ref.attempts >= TASK_MAX_ATTEMPTS:
+    logging.error('Task failed %s times, giving up: %s',
+                  task_ref.attempts, key_name)
+    values = dict([(k, getattr(task_ref, k)) for k in Task.properties()])
+    dead_ref = DeadTask(**values)
+    dead_ref.put()
+    task_ref.delete()
+  else:
+    delay = min(TASK_RETRY_DELAY * 2 ** (task_ref.attempts - 1),
+                TASK_RETRY_MAX_DELAY)
+    task_ref.not_before = utcnow() + datetime.timedelta(seconds=delay)
+    # and behind the tasks that haven't failed
+    task_ref.priority = (task_ref.priority or 0) + 1
+    task_ref.put()
+
+  memcache.client.delete(key_name)
+
+@admin_required
+def task_get_dead(api_user, limit=20):
+  """ returns the tasks that failed too many times, most recent first """
+  limit = clean.limit(limit)
+  query = DeadTask.Query().order('-dead_at')
+  return query.fetch(limit)
+
+@admin_required
+def task_replay_dead(api_user, nick, action, action_id):
+  """ puts a dead task back on the queue to be tried again from where it
+  got to """
+  key_name = DeadTask.key_from(actor=nick, action=action, action_id=action_id)
   
+  dead_ref = DeadTask.get_by_key_name(key_name)
+  if not dead_ref:
+    raise exception.ApiNotFound(
+        'Could not find dead task: %s %s %s' % (nick, action, action_id))
+
+  task_ref = task_create(ROOT,
+                         dead_ref.actor,
+                         dead_ref.action,
+                         dead_ref.action_id,
+                         args=dead_ref.args,
+                         kw=dead_ref.kw,
+                         progress=dead_ref.progress)
+  dead_ref.delete()
+  return task_ref
+
 
 @owner_required
 def task_remove(api_user, nick, action, action_id):
@@ -3041,6 +3694,7 @@ def task_update(api_user, nick, action, action_id, progress=None, unlock=True):
         'Could not find task: %s %s %s' % (nick, action, action_id))
   
   q.progress = progress
+  q.lane = _task_lane(action, progress)
   q.put()
 
   if unlock:
@@ -3084,6 +3738,8 @@ def settings_change_notify(api_user, nick, **kw):
   actor_ref.extra['sms_notify'] = sms_notifications
 
   actor_ref.put()
+
+  _subscriptions_sync_delivery(actor_ref)
   return actor_ref
 
 @owner_required
@@ -3110,6 +3766,7 @@ def settings_change_privacy(api_user, nick, privacy):
     if s.type != 'comments':
       s.read = privacy
       s.put()
+  _access_memo_clear()
   # XXX end transaction
 
 @owner_required
@@ -3229,7 +3886,12 @@ def stream_get(api_user, stream):
 @public_owner_or_contact
 def stream_get_actor(api_user, nick):
   query = Stream.gql('WHERE owner = :1', nick)
-  return list(query.run())
+  return futures.run_async(query).get_result()
+
+@public_owner_or_contact
+def stream_get_actor_async(api_user, nick):
+  query = Stream.gql('WHERE owner = :1', nick)
+  return futures.run_async(query)
 
 @public_owner_or_contact
 def stream_get_comment(api_user, nick):
@@ -3247,6 +3909,12 @@ def stream_get_actor_safe(api_user, nick):
   except exception.ApiException:
     return []
 
+def stream_get_actor_safe_async(api_user, nick):
+  try:
+    return stream_get_actor_async(api_user, nick)
+  except exception.ApiException:
+    return futures.Future(value=[])
+
 @public_owner_or_contact
 def stream_get_presence(api_user, nick):
   """ Queries the Stream entities to find the Stream corresponding to
@@ -3264,13 +3932,23 @@ def stream_get_presence(api_user, nick):
 # depends on stream_get's privacy
 def stream_get_streams(api_user, streams):
   o = {}
+  streams = [s for s in set(streams) if s]
   if not streams:
     return o
 
-  streams = list(set(streams))
-  for stream in streams:
-    stream_ref = stream_get_safe(api_user, stream)
-    if stream_ref:
+  stream_refs = dict(zip(streams, Stream.get_by_key_name(streams)))
+  stream_refs = dict([(k, v) for k, v in stream_refs.iteritems()
+                      if v and not v.is_deleted()])
+
+  # the owners must exist as well
+  owner_refs = _get_actor_refs(set([s.owner for s in stream_refs.values()]))
+  viewer_contexts(api_user,
+                  [a for a in owner_refs.values() if a and not a.is_public()])
+  is_admin = has_access(api_user, ADMIN_ACCESS)
+  for stream, stream_ref in stream_refs.iteritems():
+    if not owner_refs.get(stream_ref.owner):
+      continue
+    if is_admin or actor_can_view_stream(api_user, stream_ref):
       o[stream] = stream_ref
 
   return o
@@ -3283,6 +3961,37 @@ def stream_get_safe(api_user, stream):
     return None
   return stream_ref
 
+def stream_enable_fanout_on_read(api_user, stream, _task_ref=None):
+  """ marks every subscription to stream as fan-out-on-read and then the
+  stream itself, see _fanout_on_read
+
+  This is run from the queue a batch of subscriptions at a time, without
+  the queue it goes through all of them in one go.
+  """
+  if _task_ref:
+    offset = _task_ref.progress[len('subscriptions:'):]
+    offset = _fanout_on_read_mark(stream, offset or None)
+    if offset:
+      task_update(ROOT,
+                  _task_ref.actor,
+                  _task_ref.action,
+                  _task_ref.action_id,
+                  progress='subscriptions:%s' % offset)
+      return
+  else:
+    offset = _fanout_on_read_mark(stream)
+    while offset:
+      offset = _fanout_on_read_mark(stream, offset)
+
+  stream_ref = Stream.get_by_key_name(stream)
+  if stream_ref:
+    stream_ref.fanout_on_read = True
+    stream_ref.extra.pop('fanout_on_read_pending', None)
+    stream_ref.put()
+
+  if _task_ref:
+    task_remove(ROOT, _task_ref.actor, _task_ref.action, _task_ref.action_id)
+
 def stream_is_private(api_user, stream):
   stream_ref = stream_get(ROOT, stream)
   if stream_ref.read < PRIVACY_PUBLIC:
@@ -3366,6 +4075,16 @@ def subscription_request(api_user, topic, target):
     state = 'pending'
   # TODO(termie) send an error back and set 'unconfigured' state appropriately
 
+  delivery = _actor_delivery(target_ref)
+
+  # followers of a stream that is, or is being switched to, read by its
+  # followers have to be able to find it, see _fanout_on_read
+  fanout_on_read = False
+  stream_ref = Stream.get_by_key_name(topic)
+  if stream_ref and (stream_ref.fanout_on_read
+                     or stream_ref.extra.get('fanout_on_read_pending')):
+    fanout_on_read = True
+
   # if the subscription already exists we probably don't have to do anything
   existing_ref = subscription_get(api_user, topic, target)
   if existing_ref:
@@ -3373,8 +4092,18 @@ def subscription_request(api_user, topic, target):
     # allowed to complete the subscripton upgrade, but don't downgrade
     # if the reverse is true as the subscripton may have been confirmed
     # by the topic's actor
+    changed = False
     if existing_ref.state == 'pending' and state == 'subscribed':
       existing_ref.state = state
+      changed = True
+    # subscriptions from before delivery was recorded pick it up here
+    if existing_ref.delivery != delivery:
+      existing_ref.delivery = delivery
+      changed = True
+    if fanout_on_read and not existing_ref.fanout_on_read:
+      existing_ref.fanout_on_read = True
+      changed = True
+    if changed:
       existing_ref.put()
     return existing_ref
 
@@ -3382,6 +4111,8 @@ def subscription_request(api_user, topic, target):
                          subscriber=target_ref.nick,
                          target=target,
                          state=state,
+                         delivery=delivery,
+                         fanout_on_read=fanout_on_read,
                          )
   sub_ref.put()
   return sub_ref
@@ -3416,6 +4147,10 @@ def user_cleanup(api_user, nick):
   except exception.ApiException:
     stream_create_comment(api_user, actor_ref.nick)
 
+  # addresses and subscriptions from before they recorded notifications
+  _address_sync(actor_ref)
+  _subscriptions_sync_delivery(actor_ref)
+
 @admin_required
 def user_create(api_user, **kw):
   nick = kw.get('nick')
@@ -3552,7 +4287,9 @@ class PublicApi(object):
                      }
 
   root_methods = {"user_authenticate": user_authenticate,
-                  "task_process_actor": task_process_actor
+                  "task_process_actor": task_process_actor,
+                  "notification_send_digests": notification_send_digests,
+                  "stream_enable_fanout_on_read": stream_enable_fanout_on_read,
                   }
 
 
@@ -3695,14 +4432,18 @@ def _process_new_entry_with_progress(task_ref, actor_ref, new_stream_ref,
 
 
     # Next up will be the inboxes for the overviews of the first bunch
-    # of subscribers
-    follower_inboxes, more = _who_cares_web(new_entry_ref, 
-                                            progress=progress,
-                                            skip=initial_inboxes)
+    # of subscribers, unless they pick it up when they read them
+    if _fanout_on_read(actor_ref, new_stream_ref, new_entry_ref):
+      follower_inboxes, more = [], False
+    else:
+      follower_inboxes, more = _who_cares_web(new_entry_ref, 
+                                              progress=progress,
+                                              skip=initial_inboxes)
     
-    last_inbox = _paged_add_inbox(follower_inboxes,
-                                  new_stream_ref,
-                                  new_entry_ref)
+    _paged_add_inbox(follower_inboxes,
+                     new_stream_ref,
+                     new_entry_ref,
+                     start=progress)
 
     if not more:
       # We don't have any more followers to add inboxes for but
@@ -3711,8 +4452,9 @@ def _process_new_entry_with_progress(task_ref, actor_ref, new_stream_ref,
       # handle them
       next_progress = 'notifications:'
     else:
-      # Mark where we are and let the queue handle the rest
-      next_progress = 'inboxes:%s' % last_inbox
+      # Mark where we are and split the rest up into shards that
+      # the queue can work on side by side
+      next_progress = 'shards:0:%s' % more
 
     # Bump the task and chill out, unlock it for the next eager hands
     try:
@@ -3745,13 +4487,14 @@ def _process_new_entry_with_progress(task_ref, actor_ref, new_stream_ref,
                                             progress=my_progress,
                                             skip=initial_inboxes)
     
-    last_inbox = _paged_add_inbox(follower_inboxes,
-                                  new_stream_ref,
-                                  new_entry_ref)
+    _paged_add_inbox(follower_inboxes,
+                     new_stream_ref,
+                     new_entry_ref,
+                     start=my_progress)
     
     # if that was all of them, bump us up to notifications stage
-    if more and last_inbox:
-      next_progress = 'inboxes:%s' % last_inbox
+    if more:
+      next_progress = 'inboxes:%s' % more
     else:
       next_progress = 'notifications:'
     
@@ -3765,6 +4508,111 @@ def _process_new_entry_with_progress(task_ref, actor_ref, new_stream_ref,
     except exception.Error:
       exception.log_exception()
 
+  # SECOND STAGE, SHARDED: split the rest of the followers into ranges
+  #                        that separate shard tasks fill in
+  elif progress.startswith('shards:'):
+    entry_keyname = StreamEntry.key_from(**new_values)
+    new_entry_ref = entry_get(ROOT, entry_keyname)
+
+    shard_count, my_progress = progress[len('shards:'):].split(':', 1)
+    shard_count = int(shard_count)
+    
+    shard_count, last_inbox, more = _fanout_shards_create(task_ref,
+                                                          new_entry_ref,
+                                                          shard_count,
+                                                          my_progress)
+    if more:
+      next_progress = 'shards:%s:%s' % (shard_count, last_inbox)
+    else:
+      next_progress = 'wait:%s' % shard_count
+
+    try:
+      task_ref = task_update(ROOT, 
+                             task_ref.actor,
+                             task_ref.action,
+                             task_ref.action_id,
+                             progress=next_progress,
+                             unlock=True)
+    except exception.Error:
+      exception.log_exception()
+
+  # SECOND STAGE, SHARD: the inboxes for one range of followers, these are
+  #                      separate tasks created by the stage above
+  elif progress.startswith('shard:'):
+    entry_keyname = StreamEntry.key_from(**new_values)
+    new_entry_ref = entry_get(ROOT, entry_keyname)
+
+    initial_inboxes = _who_cares_web_initial(actor_ref, 
+                                             new_entry_ref, 
+                                             entry_ref)
+
+    start, end = progress[len('shard:'):].split(':', 1)
+
+    # up to a batch of pages, all written together at the end
+    writer = _InboxWriter()
+    position = start or None
+    done = False
+    for i in range(INBOX_WRITE_BATCH_SIZE):
+      follower_inboxes, more = _who_cares_web(new_entry_ref,
+                                              progress=position,
+                                              skip=initial_inboxes)
+      in_range = [t for t in follower_inboxes if t <= end]
+      _paged_add_inbox(in_range,
+                       new_stream_ref,
+                       new_entry_ref,
+                       start=start,
+                       page=i,
+                       writer=writer)
+      if not (more and more < end
+              and len(in_range) == len(follower_inboxes)):
+        done = True
+        break
+      position = more
+    writer.flush()
+
+    # a shard usually gets through its range in one go, but if it doesn't
+    # it carries on from where it stopped like any other task
+    if not done:
+      try:
+        task_ref = task_update(ROOT, 
+                               task_ref.actor,
+                               task_ref.action,
+                               task_ref.action_id,
+                               progress='shard:%s:%s' % (position, end),
+                               unlock=True)
+      except exception.Error:
+        exception.log_exception()
+    else:
+      task_remove(ROOT,
+                  task_ref.actor, 
+                  task_ref.action, 
+                  task_ref.action_id
+                  )
+
+  # SECOND STAGE, WAITING: the shards have all been handed out, hold off on
+  #                        the notifications until they are done
+  elif progress.startswith('wait:'):
+    entry_keyname = StreamEntry.key_from(**new_values)
+    new_entry_ref = entry_get(ROOT, entry_keyname)
+
+    shard_count = int(progress[len('wait:'):])
+    if _fanout_shards_pending(task_ref, shard_count):
+      # come back later rather than on every lease until they are done
+      task_ref.not_before = utcnow() + datetime.timedelta(
+          seconds=TASK_SHARD_WAIT_DELAY)
+      task_ref.put()
+      memcache.client.delete(task_ref.key().name())
+    else:
+      try:
+        task_ref = task_update(ROOT, 
+                               task_ref.actor,
+                               task_ref.action,
+                               task_ref.action_id,
+                               progress='notifications:',
+                               unlock=True)
+      except exception.Error:
+        exception.log_exception()
+
   # THIRD STAGE: notifications!
   elif progress.startswith('notifications:'):    
     # We'll need to get a reference to the entry that has already been created
@@ -3831,16 +4679,11 @@ def _process_new_entry_with_progress(task_ref, actor_ref, new_stream_ref,
         follower_inboxes = initial_inboxes + follower_inboxes
  
     # Back to things that happen regardless of notification type
-    last_inbox = None
-    if follower_inboxes:
-      last_inbox = follower_inboxes[-1]
-
     # We update the task first so that we don't accidentally send duplicate
     # notifications, it's not ideal but best we can do for now
     if more or next_notification_type:
-      if more and last_inbox:
-        next_progress = 'notifications:%s:%s' % (notification_type,
-                                                 last_inbox)
+      if more:
+        next_progress = 'notifications:%s:%s' % (notification_type, more)
       else:
         next_progress = 'notifications:%s:' % (next_notification_type)
       
@@ -3873,6 +4716,151 @@ def _process_new_entry_with_progress(task_ref, actor_ref, new_stream_ref,
                                           )
   return new_entry_ref
     
+def _fanout_on_read(actor_ref, stream_ref, entry_ref):
+  """ whether the followers of stream_ref read entry_ref from the stream
+  itself rather than having it written to their inboxes
+
+  That's the case for the posts of actors with at least
+  CELEBRITY_FOLLOWER_COUNT followers, writing to all their followers' inboxes
+  costs far more than merging their latest entries into the inboxes of the
+  followers that happen to look. Readers find those streams through their
+  own subscriptions, so every subscription to the stream is marked first
+  and the stream only switches over once that is done, the posts until then
+  are written as usual. Once a stream has been read that way it stays that
+  way, the entries from before are merged in again harmlessly.
+  """
+  if entry_ref.is_comment() or stream_ref.owner != actor_ref.nick:
+    return False
+  if stream_ref.fanout_on_read:
+    return True
+  follower_count = actor_ref.extra.get('follower_count', 0)
+  if follower_count < settings.CELEBRITY_FOLLOWER_COUNT:
+    return False
+
+  if not stream_ref.extra.get('fanout_on_read_pending'):
+    stream_ref.extra['fanout_on_read_pending'] = True
+    stream_ref.put()
+    if settings.QUEUE_ENABLED:
+      task_create(ROOT,
+                  stream_ref.owner,
+                  'stream_enable_fanout_on_read',
+                  stream_ref.key().name(),
+                  kw={'stream': stream_ref.key().name()},
+                  progress='subscriptions:')
+    else:
+      stream_enable_fanout_on_read(ROOT, stream_ref.key().name())
+  return stream_ref.fanout_on_read
+
+def _fanout_on_read_mark(stream, offset=None):
+  """ marks the next FANOUT_ON_READ_BATCH_SIZE subscriptions to stream after
+  offset as fan-out-on-read, returns the target to carry on after or None
+  once they are all done """
+  query = Subscription.Query().filter('topic =', stream).order('target')
+  if offset:
+    query.filter('target >', offset)
+  batch = query.fetch(FANOUT_ON_READ_BATCH_SIZE)
+
+  changed = [s for s in batch if not s.fanout_on_read]
+  for sub_ref in changed:
+    sub_ref.fanout_on_read = True
+  if changed:
+    Subscription.put_multi(changed)
+
+  if len(batch) < FANOUT_ON_READ_BATCH_SIZE:
+    return None
+  return batch[-1].target
+
+def _fanout_on_read_topics(inbox, stream_type=None):
+  """ returns the fan-out-on-read streams whose entries belong in inbox
+
+  They are looked up from the inbox's own subscriptions, so this costs as
+  much as the number of those streams the inbox follows.
+  """
+  # only followers' overviews are left out when writing
+  if not inbox.endswith('/overview'):
+    return []
+
+  subscribed = []
+  offset = None
+  while True:
+    query = Subscription.Query().filter('target =', inbox)
+    query.filter('fanout_on_read =', True)
+    query.order('topic')
+    if offset is not None:
+      query.filter('topic >', offset)
+    batch = query.fetch(FANOUT_ON_READ_BATCH_SIZE)
+    subscribed += batch
+    if len(batch) < FANOUT_ON_READ_BATCH_SIZE:
+      break
+    offset = batch[-1].topic
+  if not subscribed:
+    return []
+
+  stream_refs = Stream.get_by_key_name([s.topic for s in subscribed])
+  topics = []
+  for sub_ref, stream_ref in zip(subscribed, stream_refs):
+    if (not stream_ref or stream_ref.is_deleted()
+        or not stream_ref.fanout_on_read):
+      continue
+    if stream_type is not None and stream_ref.type != stream_type:
+      continue
+    if stream_ref.read < PRIVACY_PUBLIC and not sub_ref.is_subscribed():
+      continue
+    topics.append(stream_ref.key().name())
+  return topics
+
+def _fanout_shard_id(action_id, index):
+  return '%s/shard/%s' % (action_id, index)
+
+def _fanout_shards_create(task_ref, entry_ref, shard_count, progress):
+  """ creates the shard tasks for the next MAX_SHARDS_PER_TASK ranges of
+  followers after progress
+
+  Each shard is a copy of task_ref whose progress is 'shard:<start>:<end>',
+  where start is the last target of the previous range and end the last
+  target of its own. A shard covers INBOX_WRITE_BATCH_SIZE pages of
+  followers. Every pass's worth of shards goes one step further back
+  in the bulk lane so that other actors' fan-out gets a turn in between.
+
+  RETURNS: (shard_count, last_target, more)
+  """
+  topic_keys, is_restricted = _who_cares_web_topics(entry_ref)
+
+  # the ranges are split on every subscriber, the shards themselves take
+  # care of leaving out the ones that don't apply
+  shard_size = MAX_FOLLOWERS_PER_INBOX * INBOX_WRITE_BATCH_SIZE
+  targets, more = _paged_targets_for_topics(
+      topic_keys,
+      is_restricted=False,
+      progress=progress or None,
+      limit=shard_size * MAX_SHARDS_PER_TASK)
+
+  start = progress
+  for i in range(0, len(targets), shard_size):
+    end = targets[i:i + shard_size][-1]
+    task_create(ROOT,
+                task_ref.actor,
+                task_ref.action,
+                _fanout_shard_id(task_ref.action_id, shard_count),
+                args=task_ref.args,
+                kw=task_ref.kw,
+                progress='shard:%s:%s' % (start, end),
+                priority=shard_count // MAX_SHARDS_PER_TASK)
+    shard_count += 1
+    start = end
+
+  return shard_count, start, more
+
+def _fanout_shards_pending(task_ref, shard_count):
+  """ returns the shard tasks of task_ref that haven't finished yet """
+  key_names = [Task.key_from(actor=task_ref.actor,
+                             action=task_ref.action,
+                             action_id=_fanout_shard_id(task_ref.action_id, i))
+               for i in range(shard_count)]
+  if not key_names:
+    return []
+  return [t for t in Task.get_by_key_name(key_names) if t]
+
 # TODO(termie): what a mess.
 def _add_entry(new_stream_ref, new_values, entry_ref=None):
   """Adds an entry to a stream and returns the created StreamEntry object.  """
@@ -3940,7 +4928,9 @@ def _set_location_if_necessary(entry_ref):
   if 'location' in presence.extra and presence.extra['location']:
     entry_ref.extra['location'] = presence.extra['location']
 
-def _add_inbox(stream_ref, entry_ref, inboxes, shard):
+def _add_inbox(stream_ref, entry_ref, inboxes, shard, writer=None):
+  """ creates the InboxEntry for entry_ref in inboxes, leaving the writing
+  to writer if one is given """
   #logging.info('add_inbox %s|%s: %s', entry_ref.keyname(), shard, inboxes)
   values = {"stream": entry_ref.stream,
             "stream_type": stream_ref.type,
@@ -3952,9 +4942,49 @@ def _add_inbox(stream_ref, entry_ref, inboxes, shard):
   if entry_ref.entry:
     values['entry'] = entry_ref.entry
   inbox_ref = InboxEntry(**values)
-  inbox_ref.put()
+  if writer is None:
+    inbox_ref.put()
+  else:
+    writer.add(inbox_ref)
   return inbox_ref
- 
+
+class _InboxWriter(object):
+  """ collects InboxEntry rows and writes them INBOX_WRITE_BATCH_SIZE at a
+  time with a single datastore call
+
+  Whatever is left is written by flush(), which has to be called once
+  everything has been added. If writing a batch fails each row in it is
+  tried again on its own, so one bad row doesn't lose the others.
+  """
+  def __init__(self, batch_size=None):
+    self.batch_size = batch_size or INBOX_WRITE_BATCH_SIZE
+    self._pending = []
+
+  def add(self, inbox_ref):
+    self._pending.append(inbox_ref)
+    if len(self._pending) >= self.batch_size:
+      self.flush()
+
+  def flush(self):
+    batch = self._pending
+    self._pending = []
+    if not batch:
+      return
+    try:
+      InboxEntry.put_multi(batch)
+    except db.Error:
+      exception.log_exception()
+      failed = None
+      for inbox_ref in batch:
+        try:
+          inbox_ref.put()
+        except db.Error, e:
+          exception.log_exception()
+          failed = e
+      # let the caller know once the rest have had their go
+      if failed:
+        raise failed
+
 def _who_cares_web(entry_ref, progress=None, limit=None, skip=None):
   """ figure out who wants to see this on the web 
   
@@ -3974,6 +5004,19 @@ def _who_cares_web(entry_ref, progress=None, limit=None, skip=None):
   """
   limit = limit is None and MAX_FOLLOWERS_PER_INBOX or limit
   
+  topic_keys, is_restricted = _who_cares_web_topics(entry_ref)
+  targets, more = _paged_targets_for_topics(topic_keys,
+                                            is_restricted,
+                                            progress=progress,
+                                            limit=limit)
+  if skip:
+    targets = [t for t in targets if t not in skip]
+
+  return targets, more
+
+def _who_cares_web_topics(entry_ref):
+  """ returns the topics whose subscribers see entry_ref on the web and
+  whether those subscriptions have to be approved """
   topic_keys = [entry_ref.stream]
   if entry_ref.is_comment():
     topic_keys.append(entry_ref.entry)
@@ -3984,15 +5027,7 @@ def _who_cares_web(entry_ref, progress=None, limit=None, skip=None):
   else:
     stream_ref = stream_get(ROOT, entry_ref.stream)
     is_restricted = stream_ref.is_restricted()
-
-  targets, more = _paged_targets_for_topics(topic_keys,
-                                            is_restricted,
-                                            progress=progress,
-                                            limit=limit)
-  if skip:
-    targets = [t for t in targets if t not in skip]
-
-  return targets, more
+  return topic_keys, is_restricted
 
 def _who_cares_web_initial(actor_ref, new_entry_ref, entry_ref=None):
   inboxes = []
@@ -4045,9 +5080,20 @@ def _who_cares_web_initial(actor_ref, new_entry_ref, entry_ref=None):
   return inboxes
 
 def _who_cares_im(entry_ref, progress=None, limit=None, skip=None):
-  """ who cares about im? the same people as the web! """
+  """ who cares about im? the same people as the web, but only the ones
+  who have im notifications turned on """
   limit = limit is None and MAX_NOTIFICATIONS_PER_TASK or limit
-  return _who_cares_web(entry_ref, progress=progress, limit=limit, skip=skip)
+
+  topic_keys, is_restricted = _who_cares_web_topics(entry_ref)
+  targets, more = _paged_targets_for_topics(topic_keys,
+                                            is_restricted,
+                                            progress=progress,
+                                            limit=limit,
+                                            delivery='im')
+  if skip:
+    targets = [t for t in targets if t not in skip]
+
+  return targets, more
 
 def _who_cares_im_initial(actor_ref, new_entry_ref, entry_ref):
   return _who_cares_web_initial(actor_ref, new_entry_ref, entry_ref)
@@ -4079,7 +5125,8 @@ def _who_cares_email(entry_ref, progress=None, limit=None, skip=None):
   targets, more = _paged_targets_for_topics(topic_keys,
                                             is_restricted,
                                             progress=progress,
-                                            limit=limit)
+                                            limit=limit,
+                                            delivery='email')
 
   # we always want to skip the actor who made this action
   # (unless we make that a setting in the future)
@@ -4133,7 +5180,8 @@ def _who_cares_sms(entry_ref, progress=None, limit=None, skip=None):
   targets, more = _paged_targets_for_topics(topic_keys,
                                             is_restricted,
                                             progress=progress,
-                                            limit=limit)
+                                            limit=limit,
+                                            delivery='sms')
 
   # we always want to skip the actor who made this action
   # (unless we make that a setting in the future)
@@ -4154,95 +5202,250 @@ def _who_cares_sms_initial(actor_ref, new_entry_ref, entry_ref=None):
   return []
 
 def _paged_targets_for_topics(topic_keys, is_restricted=True, progress=None,
-                              limit=MAX_FOLLOWERS_PER_INBOX):
+                              limit=MAX_FOLLOWERS_PER_INBOX, delivery=None):
+  """ returns the next limit subscription targets after progress across all
+  of topic_keys, and the target to carry on after if there are more
 
-  # If you're a little worried about how this works, hopefully this
-  # horrible little diagram will help ease your fears (or find out how
-  # we are doing it wrong and help us fix it)
-  #
-  # Example Time!
-  #       We fetch the subscription targets for both the comments stream
-  #       as well as for the entry, example:
-  #       
-  # ...............    ...............    ...............
-  # limit = 4          limit = 4          limit = 4
-  # progress = None    progress = D       progress = H
-                      
-                  
-  # full data          full data          full data    
-  # stream   entry     stream   entry     stream   entry 
-  # ------   -----     ------   -----     ------   ----- 
-  #   A                  A                  A            
-  #   B        B         B        B         B        B   
-  #   C                  C                  C            
-  #   D        D         D        D         D        D   
-  #   E        E         E        E         E        E   
-  #   F                  F                  F            
-  #            G                  G                  G   
-  #            H                  H                  H   
-  #   I                  I                  I            
-  #   J                  J                  J            
-                    
-                    
-  # fetched data      fetched data        fetched data 
-  # stream   entry    stream   entry      stream   entry 
-  # ------   -----    ------   -----      ------   ----- 
-  #   A                 E        E          I            
-  #   B        B        F                   J        
-  #   C                          G                      
-  #   D        D                 H                    
-  #  ---                I                            
-  #   E        E        J                          
-  #   F                                                 
-  #            G                                       
-  #           ---                                    
-  #            H                                       
-  #   I                                                 
-  #   J                                                 
-                                                       
-  # merged  more       merged  more       merged  more   
-  # ------  -----      ------  -----      ------  -----  
-  #   A     yes          E     yes          I     yes    
-  #   B                  F                  J            
-  #   C                  G                              
-  #   D                  H                              
-
-  subs = []
-  for topic in topic_keys:
-    subs += subscription_get_topic(ROOT,
-                                   topic,
-                                   limit=limit +1,
-                                   offset=progress)
-
-  # unique and sort
-  targets = sorted(list(set([s.target for s in subs])))
-  #logging.info('targets! %s', targets)
-
-  # paging
-  more = False
-  if len(targets) > limit:
-    more = True
-    targets = targets[:limit]
-  
-  # Alright, we've handled all that stuff described in the note above
-  # now we need to filter out the subscriptions that aren't subscribed 
-  if is_restricted:
-    good_targets = [s.target for s in subs if (s.is_subscribed())]
-    targets = sorted(list(set(targets).intersection(set(good_targets))))
+  If you're a little worried about how this works, hopefully this
+  horrible little diagram will help ease your fears (or find out how
+  we are doing it wrong and help us fix it)
 
-  return targets, more
+  Example Time!
+        We want the subscription targets for both the comments stream
+        as well as for the entry, example:
+        
+  ...............    ...............    ...............
+  limit = 4          limit = 4          limit = 4
+  progress = None    progress = D       progress = H
+
+  full data          full data          full data    
+  stream   entry     stream   entry     stream   entry 
+  ------   -----     ------   -----     ------   ----- 
+    A                  A                  A            
+    B        B         B        B         B        B   
+    C                  C                  C            
+    D        D         D        D         D        D   
+    E        E         E        E         E        E   
+    F                  F                  F            
+             G                  G                  G   
+             H                  H                  H   
+    I                  I                  I            
+    J                  J                  J            
+
+  merged  more       merged  more       merged  more   
+  ------  -----      ------  -----      ------  -----  
+    A     yes          E     yes          I     no     
+    B                  F                  J            
+    C                  G                              
+    D                  H                              
+
+  Each topic's subscriptions are read in order of target starting after
+  progress, and only as far as they are needed: the topics are merged a
+  subscription at a time, repeats of a target are folded together as they
+  come up next to each other and it stops at the first target past limit.
+  Every target is a subscriber to be skipped or kept once, so a page costs
+  about limit subscriptions per topic at most and never holds more than a
+  page of targets. The last target doubles as the place to carry on from.
+
+  For restricted topics only the targets with at least one approved
+  subscription count. No more than twice limit subscriptions per topic are
+  looked at, so a long run of pending ones ends the page early, possibly
+  with no targets at all, and the place to carry on from is the last
+  subscription looked at rather than the last target. If delivery is given only the subscriptions that are
+  delivered that way ('im', 'sms' or 'email') are read at all, once
+  SUBSCRIPTION_DELIVERY_SYNCED says that every subscription has it filled in.
+  Before that the subscriptions are all read and it is left to the notify
+  functions to check the subscribers' settings.
+  """
+  if not settings.SUBSCRIPTION_DELIVERY_SYNCED:
+    delivery = None
+
+  batch_size = min(limit + 1, 1000)
+  subs = util.merge_sorted([_subscriptions_after(topic,
+                                                 progress,
+                                                 batch_size,
+                                                 delivery)
+                            for topic in topic_keys],
+                           key=lambda s: s.target)
+
+  max_examined = 2 * limit * len(topic_keys)
+  examined = 0
+  targets = []
+  for target, group in itertools.groupby(subs, lambda s: s.target):
+    group = list(group)
+    examined += len(group)
+    if not is_restricted or [s for s in group if s.is_subscribed()]:
+      if len(targets) == limit:
+        return targets, targets[-1]
+      targets.append(target)
+    if is_restricted and examined >= max_examined:
+      return targets, target
+  return targets, False
+
+def _subscriptions_after(topic, offset=None, batch_size=100, delivery=None):
+  """ the subscriptions to topic with targets after offset in order of
+  target, fetched batch_size at a time as they are iterated """
+  while True:
+    query = Subscription.Query().order('target').filter('topic =', topic)
+    if delivery is not None:
+      query.filter('delivery =', delivery)
+    if offset is not None:
+      query.filter('target >', offset)
+    batch = query.fetch(batch_size)
+    for sub_ref in batch:
+      yield sub_ref
+    if len(batch) < batch_size:
+      return
+    offset = batch[-1].target
 
-def _paged_add_inbox(inboxes, stream_ref, entry_ref):
+def _actor_delivery(actor_ref):
+  """ the ways actor_ref wants to be notified besides the web, for
+  Subscription.delivery
+
+  Having the setting turned on isn't enough, there has to be somewhere to
+  deliver to as well.
+  """
+  address_ref = _actor_addresses([actor_ref.nick])[actor_ref.nick]
+  delivery = []
+  if actor_ref.extra.get('im_notify') and address_ref.im:
+    delivery.append('im')
+  if actor_ref.extra.get('sms_notify') and address_ref.mobile:
+    delivery.append('sms')
+  if actor_ref.extra.get('email_notify') and address_ref.email:
+    delivery.append('email')
+  return delivery
+
+def _actor_addresses(nicks):
+  """ returns {nick: Address} for nicks with a single get
+
+  Actors whose Address hasn't been written yet get one made from their
+  relations, it is saved so that they are only looked up the slow way once.
+  """
+  nicks = list(set(nicks))
+  address_refs = Address.get_by_key_name(
+      [Address.key_from(owner=nick) for nick in nicks])
+
+  o = {}
+  missing = []
+  for nick, address_ref in zip(nicks, address_refs):
+    if not address_ref:
+      address_ref = _address_from_relations(nick)
+      missing.append(address_ref)
+    o[nick] = address_ref
+  if missing:
+    Address.put_multi(missing)
+  return o
+
+def _address_from_relations(nick):
+  address_ref = Address(owner=nick)
+  for relation, attr in (('im_account', 'im'),
+                         ('mobile', 'mobile'),
+                         ('email', 'email')):
+    query = Relation.gql('WHERE owner = :1 AND relation = :2',
+                         nick,
+                         relation)
+    rel_ref = query.get()
+    if rel_ref:
+      setattr(address_ref, attr, rel_ref.target)
+  return address_ref
+
+def _address_sync(actor_ref):
+  """ rewrites actor_ref's Address, call it whenever one of the relations it
+  copies changes """
+  address_ref = _address_from_relations(actor_ref.nick)
+  address_ref.put()
+  return address_ref
+
+def _actors_who_can_view_entry(actor_refs, entry_ref):
+  """ the actors in actor_refs who are allowed to read entry_ref
+
+  Whether an actor can read an entry only depends on how they relate to the
+  actors involved in it (its author and owner, and those of the entry it is
+  on for a comment) so the actors are grouped by that and the full check is
+  only run once per group. The relations for everybody are fetched together
+  first.
+  """
+  if not actor_refs:
+    return []
+
+  entry_keyname = entry_ref.keyname()
+
+  # nothing to work out if anybody at all can read it
+  if entry_get_safe(None, entry_keyname):
+    return list(actor_refs)
+
+  owner_nicks = [entry_ref.actor, entry_ref.owner]
+  if entry_ref.entry:
+    parent_ref = entry_get_safe(ROOT, entry_ref.entry)
+    if parent_ref:
+      owner_nicks += [parent_ref.actor, parent_ref.owner]
+  owner_refs = actor_get_actors(ROOT, list(set(owner_nicks)))
+  owner_refs = [v for k, v in sorted(owner_refs.iteritems()) if v]
+
+  key_names = []
+  for actor_ref in actor_refs:
+    for owner_ref in owner_refs:
+      key_names.extend(_viewer_context_keys(actor_ref.nick, owner_ref))
+  Relation.get_by_key_name(key_names)
+
+  can_view = {}
+  o = []
+  for actor_ref in actor_refs:
+    contexts = viewer_contexts(actor_ref, owner_refs)
+    group = (has_access(actor_ref, ADMIN_ACCESS),
+             tuple([contexts[owner_ref.nick].privacy
+                    for owner_ref in owner_refs]))
+    if group not in can_view:
+      can_view[group] = bool(entry_get_safe(actor_ref, entry_keyname))
+    if can_view[group]:
+      o.append(actor_ref)
+  return o
+
+def _subscriptions_sync_delivery(actor_ref):
+  """ copies actor_ref's notification settings onto all of their
+  subscriptions, call it whenever something _actor_delivery looks at
+  changes """
+  delivery = _actor_delivery(actor_ref)
+
+  # every subscription an actor has is to a different topic
+  offset = None
+  while True:
+    query = Subscription.Query().order('topic')
+    query.filter('subscriber =', actor_ref.nick)
+    if offset is not None:
+      query.filter('topic >', offset)
+    batch = query.fetch(DELIVERY_SYNC_BATCH_SIZE)
+
+    changed = [s for s in batch if s.delivery != delivery]
+    for sub_ref in changed:
+      sub_ref.delivery = delivery
+    if changed:
+      Subscription.put_multi(changed)
+
+    if len(batch) < DELIVERY_SYNC_BATCH_SIZE:
+      return
+    offset = batch[-1].topic
+
+def _inbox_shard_id(start, page):
+  """ names the InboxEntry for the page-th page of followers after start
+
+  The name only depends on where the pass started and how far into it the
+  page is, not on who is in it, so replaying a pass writes over the rows it
+  wrote before instead of adding to them even if subscribers have come and
+  gone in between.
+  """
+  return 'page/%s/%s' % (page, start or '')
+
+def _paged_add_inbox(inboxes, stream_ref, entry_ref, start, page=0,
+                     writer=None):
+  """ adds the page-th page of inboxes after start, returns the last one """
   if inboxes:
     last_inbox = inboxes[-1]
-    # TODO(termie): maybe we should come up with a better shard identifier?
-    #               theoretically, upon replay of this item the last item
-    #               could change (a subscriber goes away) and we duplicate
-    #               the inbox entry
     inbox_ref = _add_inbox(stream_ref, 
                            entry_ref, 
                            inboxes,
-                           shard=last_inbox)
+                           shard=_inbox_shard_id(start, page),
+                           writer=writer)
 
     return last_inbox
   return None
@@ -4253,11 +5456,9 @@ def _notify_subscribers_for_entry_by_type(notification_type, inboxes,
                                           new_entry_ref, entry_ref=None,
                                           entry_stream_ref=None):
 
-  # TODO(termie): this is not the most efficient way to do this at all
-  #               it'd be nice if the subscription encoded the information
-  #               about whether there should be im or sms delivery
-  #               so that we at least have a smaller subset to work with
-  
+  # apart from the initial ones, inboxes only holds subscribers who have this
+  # type of notification turned on (see Subscription.delivery), the checks
+  # further down look at the actors themselves in case that copy is stale
   if notification_type == 'im':
     _notify_im_for_entry(inboxes,
                          actor_ref,
@@ -4323,16 +5524,12 @@ def _notify_sms_for_entry(inboxes, actor_ref, new_stream_ref, new_entry_ref,
   subscribers_ref = actor_get_actors(ROOT, subscribers)
   subscribers_ref = [v for k, v in subscribers_ref.iteritems() if v]
   
-  mobile_numbers = []
-  for subscriber_ref in subscribers_ref:
-    if not subscriber_ref.extra.get('sms_notify'):
-      continue
-    mobile = mobile_get_actor(ROOT, subscriber_ref.nick)
-    if not mobile:
-      continue
-    can_read_entry = entry_get_safe(subscriber_ref, new_entry_ref.keyname())
-    if can_read_entry:
-      mobile_numbers.append(mobile)
+  wants_sms = [s for s in subscribers_ref if s.extra.get('sms_notify')]
+  addresses = _actor_addresses([s.nick for s in wants_sms])
+  wants_sms = [s for s in wants_sms if addresses[s.nick].mobile]
+  mobile_numbers = [addresses[s.nick].mobile
+                    for s in _actors_who_can_view_entry(wants_sms,
+                                                        new_entry_ref)]
   if not mobile_numbers:
     return
   
@@ -4482,116 +5679,276 @@ def _notify_subscribers_for_comment(actor_ref, comment_ref, entry_ref):
 
 def _notify_email_subscribers_for_comment(subscribers_ref, actor_ref,
                                           comment_ref, entry_ref):
-  for subscriber_ref in subscribers_ref:
-    if not subscriber_ref.extra.get('email_notify'):
+  wants_email = [s for s in subscribers_ref
+                 if s.extra.get('email_notify') and s.nick != actor_ref.nick]
+  addresses = _actor_addresses([s.nick for s in wants_email])
+  wants_email = [s for s in wants_email if addresses[s.nick].email]
+  readers = _actors_who_can_view_entry(wants_email, comment_ref)
+
+  sending = _digest_hold('email',
+                         [s.nick for s in readers],
+                         comment_ref,
+                         entry_ref)
+
+  # everybody gets their own copy, but there are only ever two different
+  # messages and they all go out together
+  rendered = {}
+  message_tuples = []
+  for subscriber_ref in readers:
+    if subscriber_ref.nick not in sending:
       continue
-    email = email_get_actor(ROOT, subscriber_ref.nick)
-    if not email:
-      continue
-    if subscriber_ref.nick == actor_ref.nick:
-      continue
-    can_read_entry = entry_get_safe(subscriber_ref, comment_ref.keyname())
-    if not can_read_entry:
-      continue
-
-    subject, message = mail.email_comment_notification(
-        subscriber_ref,
-        actor_ref,
-        comment_ref,
-        entry_ref)
-    email_send(ROOT, email, subject, message)
+    # the message only differs for the author of the entry
+    if subscriber_ref.nick == entry_ref.actor:
+      name = 'email/mine'
+    else:
+      name = 'email'
+    if name not in rendered:
+      rendered[name] = _notification_render(
+          comment_ref,
+          name,
+          lambda: mail.email_comment_notification(subscriber_ref,
+                                                  actor_ref,
+                                                  comment_ref,
+                                                  entry_ref))
+    subject, message = rendered[name]
+    message_tuples.append((subject,
+                           message,
+                           settings.DEFAULT_FROM_EMAIL,
+                           [addresses[subscriber_ref.nick].email]))
+
+  if message_tuples:
+    email_mass_send(ROOT, message_tuples)
 
 def _notify_im_subscribers_for_comment(subscribers_ref, actor_ref,
                                        comment_ref, entry_ref):
   xmpp_connection = xmpp.XmppConnection()
   
-  im_aliases = []
-  for subscriber_ref in subscribers_ref:
-    if not subscriber_ref.extra.get('im_notify'):
-      continue
-    im = im_get_actor(ROOT, subscriber_ref.nick)
-    if not im:
-      continue
-    can_read_entry = entry_get_safe(subscriber_ref, comment_ref.keyname())
-    if can_read_entry:
-      im_aliases.append(im)
-  if not im_aliases:
-    return
-  # We're effectively duplicationg common.display.prep_comment here
-  comment_ref.owner_ref = actor_get(ROOT, entry_ref.owner)
-  comment_ref.actor_ref = actor_ref
-  comment_ref.entry_ref = entry_ref
-  entry = comment_ref
-  entries = [entry]
-
-  context = {'entry': entry,
-             'entries': entries,
-             'entry_title_max_length':
-                 settings.IM_MAX_LENGTH_OF_ENTRY_TITLES_FOR_COMMENTS,
-             }
+  recipients = _im_recipients_for_entry(subscribers_ref, comment_ref)
+  sending = _digest_hold('im',
+                         [nick for nick, im in recipients],
+                         comment_ref,
+                         entry_ref)
+  im_aliases = [im for nick, im in recipients if nick in sending]
+  if im_aliases:
+    plain_text_message, html_message, atom_message = _im_comment_message(
+        actor_ref, comment_ref, entry_ref)
+
+    xmpp_connection.send_message(im_aliases,
+                                 plain_text_message,
+                                 html_message=html_message,
+                                 atom_message=atom_message)
+
+  # the ones held back for a digest can reply to it all the same
+  if recipients:
+    _reply_add_cache_im(actor_ref, subscribers_ref, entry_ref.keyname())
+
+def _im_comment_message(actor_ref, comment_ref, entry_ref):
+  """ the plain text, html and atom im messages about comment_ref """
+  def render():
+    # We're effectively duplicationg common.display.prep_comment here
+    comment_ref.owner_ref = actor_get(ROOT, entry_ref.owner)
+    comment_ref.actor_ref = actor_ref
+    comment_ref.entry_ref = entry_ref
+    entry = comment_ref
+    entries = [entry]
+
+    context = {'entry': entry,
+               'entries': entries,
+               'entry_title_max_length':
+                   settings.IM_MAX_LENGTH_OF_ENTRY_TITLES_FOR_COMMENTS,
+               }
+    return _render_im('common/im/im_comment', context)
+
+  return _notification_render(comment_ref, 'im', render)
+
+def _render_im(name, context):
+  """ returns the plain text, html and atom versions of the im message in the
+  templates called name, the last two are None if IM_PLAIN_TEXT_ONLY """
   # add all our settings to the context
   context.update(context_processors.settings(None))
-
   c = template.Context(context, autoescape=False)
-  t = template.loader.get_template('common/im/im_comment.txt')
-  plain_text_message = t.render(c)
+  plain_text_message = util.get_template('%s.txt' % name).render(c)
 
   if settings.IM_PLAIN_TEXT_ONLY:
-    html_message = None
-  else:
-    t = template.loader.get_template('common/im/im_comment.html')
-    html_message = t.render(c)
-    
-    t = template.loader.get_template('common/im/im_comment.atom')
-    atom_message = t.render(c)
+    return plain_text_message, None, None
 
-  xmpp_connection.send_message(im_aliases,
-                               plain_text_message,
-                               html_message=html_message,
-                               atom_message=atom_message)
+  html_message = util.get_template('%s.html' % name).render(c)
+  atom_message = util.get_template('%s.atom' % name).render(c)
+  return plain_text_message, html_message, atom_message
 
-  _reply_add_cache_im(actor_ref, subscribers_ref, entry_ref.keyname())
+def _notification_render(entry_ref, name, render):
+  """ returns render(), the notification called name about entry_ref
 
-def _notify_im_subscribers_for_entry(subscribers_ref, actor_ref, stream_ref, entry_ref):
+  A notification is the same for everybody who gets it so it is kept in
+  memcache for the later passes over the entry's subscribers rather than
+  being rendered again for every one of them.
+  """
+  key = 'notification/%s/%s' % (name, entry_ref.keyname())
+  rendered = memcache.client.get(key)
+  if rendered is None:
+    rendered = render()
+    memcache.client.set(key, rendered, time=NOTIFICATION_RENDER_TTL)
+  return rendered
+
+def _digest_window_key(service, nick, thread):
+  return 'digest/%s/%s/%s' % (service, nick, thread)
+
+def _digest_hold(service, nicks, comment_ref, entry_ref):
+  """ returns the ones of nicks to notify about comment_ref right away
+
+  The first notification about a comment on entry_ref that somebody gets
+  opens a window of NOTIFICATION_DIGEST_WINDOW seconds. The notifications
+  about the comments after it are held back as Digest rows until the
+  window is up, and then all go out together in one message.
+  """
+  window = settings.NOTIFICATION_DIGEST_WINDOW
+  if not window or not settings.QUEUE_ENABLED or not nicks:
+    return nicks
+
+  thread = entry_ref.keyname()
+  window_keys = dict([(_digest_window_key(service, nick, thread), nick)
+                      for nick in nicks])
+  # the ones that already had a window open
+  held_keys = memcache.client.add_multi(dict([(k, 1) for k in window_keys]),
+                                        time=window)
+  if not held_keys:
+    return nicks
+  held = [window_keys[k] for k in held_keys]
+
+  # a row of its own for each held comment, nothing is read or changed in
+  # place so comments held at the same time can't lose each other
+  Digest.put_multi([Digest(service=service,
+                           actor=nick,
+                           thread=thread,
+                           entry=comment_ref.keyname())
+                    for nick in held])
+  _digest_schedule(service, entry_ref)
+
+  held = set(held)
+  return [nick for nick in nicks if nick not in held]
+
+def _digest_schedule(service, entry_ref):
+  """ makes sure there is a task to send the digests for entry_ref once the
+  window is up """
+  action_id = '%s/%s' % (service, entry_ref.keyname())
+  key_name = Task.key_from(actor=entry_ref.actor,
+                           action='notification_send_digests',
+                           action_id=action_id)
+  if Task.get_by_key_name(key_name):
+    return
+
+  window = settings.NOTIFICATION_DIGEST_WINDOW
+  task_create(ROOT,
+              entry_ref.actor,
+              'notification_send_digests',
+              action_id,
+              kw={'service': service, 'thread': entry_ref.keyname()},
+              not_before=utcnow() + datetime.timedelta(seconds=window))
+
+def _digest_comments(held):
+  """ returns {nick: [(actor_ref, comment_ref), ...]} with the comments held
+  for each of the nicks in held that are still there, oldest first """
+  keys = set()
+  for entries in held.itervalues():
+    keys.update(entries)
+  comment_refs = entry_get_entries_dict(ROOT, list(keys))
+  actor_refs = actor_get_actors(ROOT,
+                                [c.actor for c in comment_refs.values()])
+
+  o = {}
+  for nick, entries in held.iteritems():
+    comments = [(actor_refs[comment_refs[k].actor], comment_refs[k])
+                for k in entries
+                if comment_refs.get(k) and actor_refs.get(comment_refs[k].actor)]
+    comments.sort(key=lambda c: c[1].created_at)
+    if comments:
+      o[nick] = comments
+  return o
+
+def _digest_send_im(held, entry_ref):
+  """ one im to each of the actors in held with all the comments they were
+  held back for, the ones waiting for the same comments share a message """
+  comments = _digest_comments(held)
+  addresses = _actor_addresses(comments.keys())
+
+  groups = {}
+  for nick, actor_comments in comments.iteritems():
+    keys = tuple([c.keyname() for a, c in actor_comments])
+    im = addresses[nick].im
+    if im:
+      groups.setdefault(keys, (actor_comments, []))[1].append(
+          xmpp.JID.from_uri(im))
+
+  # a digest is just the plain text of each of the comments, one after the
+  # other, the html ones are whole documents that can't be put together
   xmpp_connection = xmpp.XmppConnection()
-  im_aliases = []
-  for subscriber_ref in subscribers_ref:
-    if not subscriber_ref.extra.get('im_notify'):
-      continue
-    im = im_get_actor(ROOT, subscriber_ref.nick)
-    if not im:
+  for actor_comments, im_aliases in groups.itervalues():
+    messages = [_im_comment_message(a, c, entry_ref)
+                for a, c in actor_comments]
+    plain_text_message = '\n'.join([m[0].strip() for m in messages])
+    xmpp_connection.send_message(im_aliases, plain_text_message)
+
+def _digest_send_email(held, entry_ref):
+  """ one email to each of the actors in held with all the comments they
+  were held back for """
+  comments = _digest_comments(held)
+  addresses = _actor_addresses(comments.keys())
+  actor_refs = actor_get_actors(ROOT, comments.keys())
+
+  rendered = {}
+  message_tuples = []
+  for nick, actor_comments in comments.iteritems():
+    email = addresses[nick].email
+    actor_ref = actor_refs.get(nick)
+    if not email or not actor_ref:
       continue
-    can_read_entry = entry_get_safe(subscriber_ref, entry_ref.keyname())
-    if can_read_entry:
-      im_aliases.append(im)
+
+    # as with single comments, the author of the entry gets their own
+    keys = tuple([c.keyname() for a, c in actor_comments])
+    my_entry = nick == entry_ref.actor
+    if (keys, my_entry) not in rendered:
+      rendered[(keys, my_entry)] = mail.email_comment_digest(
+          actor_ref, actor_comments, entry_ref)
+    subject, message = rendered[(keys, my_entry)]
+    message_tuples.append((subject,
+                           message,
+                           settings.DEFAULT_FROM_EMAIL,
+                           [email]))
+
+  if message_tuples:
+    email_mass_send(ROOT, message_tuples)
+
+def _im_recipients_for_entry(subscribers_ref, entry_ref):
+  """ (nick, im) for the subscribers who want im notifications and can read
+  entry_ref """
+  wants_im = [s for s in subscribers_ref if s.extra.get('im_notify')]
+  addresses = _actor_addresses([s.nick for s in wants_im])
+  wants_im = [s for s in wants_im if addresses[s.nick].im]
+  return [(s.nick, xmpp.JID.from_uri(addresses[s.nick].im))
+          for s in _actors_who_can_view_entry(wants_im, entry_ref)]
+
+def _notify_im_subscribers_for_entry(subscribers_ref, actor_ref, stream_ref, entry_ref):
+  xmpp_connection = xmpp.XmppConnection()
+  im_aliases = [im for nick, im
+                in _im_recipients_for_entry(subscribers_ref, entry_ref)]
   if not im_aliases:
     return
 
-  # We're effectively duplicationg common.display.prep_entry here
-  entry_ref.stream_ref = stream_ref
-  logging.info('stream_ref %s', stream_ref)
-  entry_ref.owner_ref = actor_get(ROOT, entry_ref.owner)
-  entry_ref.actor_ref = actor_ref
-  entry = entry_ref
-  entries = [entry]
+  def render():
+    # We're effectively duplicationg common.display.prep_entry here
+    entry_ref.stream_ref = stream_ref
+    entry_ref.owner_ref = actor_get(ROOT, entry_ref.owner)
+    entry_ref.actor_ref = actor_ref
+    entry = entry_ref
+    entries = [entry]
 
-  context = {'entry': entry,
-             'entries': entries,
-             }
-  # add all our settings to the context
-  context.update(context_processors.settings(None))
-  c = template.Context(context, autoescape=False)
-  t = template.loader.get_template('common/im/im_entry.txt')
-  plain_text_message = t.render(c)
-  
-  if settings.IM_PLAIN_TEXT_ONLY:
-    html_message = None
-  else:
-    t = template.loader.get_template('common/im/im_entry.html')
-    html_message = t.render(c)
+    context = {'entry': entry,
+               'entries': entries,
+               }
+    return _render_im('common/im/im_entry', context)
 
-    t = template.loader.get_template('common/im/im_entry.atom')
-    atom_message = t.render(c)
+  plain_text_message, html_message, atom_message = _notification_render(
+      entry_ref, 'im', render)
 
   xmpp_connection.send_message(im_aliases,
                                plain_text_message,
@@ -4705,6 +6062,57 @@ def _set_presence(api_user, **kw):
   pass
 
 # HELPER
+def _get_actor_refs(nicks, clean_nick=clean.nick):
+  """Fetches the actors for nicks with one batched get
+
+  RETURNS: {nick: actor_ref} where actor_ref is None for invalid nicks and
+  for actors that don't exist or have been deleted
+  """
+  o = {}
+  key_names = {}
+  for nick in nicks:
+    try:
+      key_names[nick] = User.key_from(nick=clean_nick(nick))
+    except exception.ValidationError:
+      logging.warn('Validation error for nick: %s' % nick)
+      o[nick] = None
+
+  nicks = key_names.keys()
+  if nicks:
+    actor_refs = User.get_by_key_name([key_names[nick] for nick in nicks])
+    for nick, actor_ref in zip(nicks, actor_refs):
+      if actor_ref and actor_ref.is_deleted():
+        actor_ref = None
+      o[nick] = actor_ref
+  return o
+
+def _prefetch_entries(entry_keys):
+  """Loads the given entries into the request cache along with their parent
+  entries and the actors and streams they reference.
+
+  Rather than one get per entity this takes one multi-get for the entries,
+  one for their parents, authors, owners and streams together, and one more
+  for anything referenced only by the parents. Nothing is returned, the
+  entries are read back from the cache by the usual getters.
+  """
+  seen = set()
+  pairs = [(StreamEntry, k) for k in entry_keys]
+  while pairs:
+    seen.update(pairs)
+    fetched = models.get_multi_by_key_name(pairs)
+
+    new_entries = [v for (model_class, k), v in fetched.iteritems()
+                   if model_class is StreamEntry and v]
+    pairs = []
+    for entry_ref in new_entries:
+      wanted = [(User, User.key_from(nick=entry_ref.actor)),
+                (User, User.key_from(nick=entry_ref.owner)),
+                (Stream, entry_ref.stream)]
+      if entry_ref.entry:
+        wanted.append((StreamEntry, entry_ref.entry))
+      pairs.extend([p for p in wanted if p not in seen])
+    pairs = list(set(pairs))
+
 def _limit_query(query, limit, offset):
   o = []
   query_it = query.run()
@@ -0,0 +1,146 @@
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batch loading of the actors, channels and streams a page refers to
+
+Views register everything they are going to need first and read it back
+afterwards. The first read fetches whatever has been registered so far using
+the batched api getters, so a page costs the same few datastore round trips
+however many entries, contacts and channels are on it::
+
+  data = dataloader.for_user(request.user)
+  data.want_entries(entries)
+  data.want_actors(contact_nicks)
+  entries = data.prep_entries(entries)
+  contacts = data.actor_list(contact_nicks)
+
+A loader lives for the length of the request, so different parts of a page
+asking for the same actors share the results.
+"""
+
+from common import api
+from common import display
+from common import models
+
+def _load_streams(api_user, keys):
+  return api.stream_get_streams(api_user, keys)
+
+def _load_channels(api_user, nicks):
+  return api.channel_get_channels(api_user, nicks)
+
+def _load_actors(api_user, nicks):
+  return api.actor_get_actors(api_user, nicks)
+
+# in the order they are resolved, streams come first because their owners
+# have to be loaded as well
+LOADERS = (('stream', _load_streams),
+           ('channel', _load_channels),
+           ('actor', _load_actors),
+           )
+
+def for_user(api_user):
+  """returns the DataLoader for api_user in the current request"""
+  memo = models.CachingModel.memo('dataloader')
+  if memo is None:
+    return DataLoader(api_user)
+
+  key = getattr(api_user, 'nick', None)
+  if key not in memo:
+    memo[key] = DataLoader(api_user)
+  return memo[key]
+
+class DataLoader(object):
+  def __init__(self, api_user):
+    self.api_user = api_user
+    self._pending = {}
+    self._loaded = {}
+    for kind, load in LOADERS:
+      self._pending[kind] = set()
+      self._loaded[kind] = {}
+
+  def want(self, kind, keys):
+    loaded = self._loaded[kind]
+    for key in keys:
+      if key and key not in loaded:
+        self._pending[kind].add(key)
+
+  def want_actors(self, nicks):
+    self.want('actor', nicks)
+
+  def want_channels(self, nicks):
+    self.want('channel', nicks)
+
+  def want_streams(self, keys):
+    self.want('stream', keys)
+
+  def want_entries(self, entries):
+    """the streams, owners and authors of entries"""
+    self.want_streams([e.stream for e in entries])
+    self.want_actors([e.owner for e in entries] + [e.actor for e in entries])
+
+  def resolve(self):
+    """fetches everything that has been asked for but not loaded yet"""
+    for kind, load in LOADERS:
+      keys = list(self._pending[kind])
+      if not keys:
+        continue
+      self._pending[kind].clear()
+
+      rv = load(self.api_user, keys)
+      for key in keys:
+        self._loaded[kind][key] = rv.get(key)
+
+      if kind == 'stream':
+        self.want_actors([s.owner for s in rv.values() if s])
+
+  def get(self, kind, keys):
+    """returns {key: value} for keys, value is None if it can't be viewed"""
+    self.want(kind, keys)
+    if self._pending[kind]:
+      self.resolve()
+    loaded = self._loaded[kind]
+    return dict([(key, loaded.get(key)) for key in keys])
+
+  def actors(self, nicks):
+    return self.get('actor', nicks)
+
+  def channels(self, nicks):
+    return self.get('channel', nicks)
+
+  def streams(self, keys):
+    """like stream_get_streams, leaves out the streams that can't be viewed"""
+    return dict([(k, v) for k, v in self.get('stream', keys).iteritems() if v])
+
+  def actor_list(self, nicks):
+    """the actors for nicks that can be viewed, in the same order"""
+    actors = self.actors(nicks)
+    return [actors[nick] for nick in nicks if actors[nick]]
+
+  def channel_list(self, nicks):
+    channels = self.channels(nicks)
+    return [channels[nick] for nick in nicks if channels[nick]]
+
+  def prep_streams(self, keys):
+    """prep_stream_dict for the streams with keys"""
+    streams = self.streams(keys)
+    actors = self.actors([s.owner for s in streams.values()])
+    return display.prep_stream_dict(streams, actors)
+
+  def prep_entries(self, entries):
+    """prep_entry_list for entries"""
+    self.want_entries(entries)
+    streams = self.prep_streams([e.stream for e in entries])
+    actors = self.actors([e.owner for e in entries] +
+                         [e.actor for e in entries])
+    return display.prep_entry_list(entries, streams, actors)
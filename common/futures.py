@@ -0,0 +1,71 @@
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Datastore calls that can be started now and collected later
+
+A view that needs the results of several independent queries starts them
+all first and only then asks for the results, so that the page waits for
+the slowest query rather than for all of them in turn::
+
+  inbox = api.inbox_get_actor_public_async(api_user, nick)
+  streams = api.stream_get_actor_async(api_user, nick)
+  inbox, streams = futures.wait_all([inbox, streams])
+
+The queries only actually overlap with a datastore API that can run them
+asynchronously; without one they run when their result is first needed,
+which keeps the calling code the same either way.
+"""
+
+from google.appengine.ext import db
+
+ASYNC_DATASTORE = hasattr(db, 'get_async')
+
+class Future(object):
+  """The result of a call that may still be in progress
+
+  Either wraps a callback that produces the result, which is called once the
+  first time the result is asked for, or an already known value.
+  """
+  def __init__(self, callback=None, value=None):
+    self._callback = callback
+    self._value = value
+
+  def get_result(self):
+    if self._callback is not None:
+      callback = self._callback
+      self._callback = None
+      self._value = callback()
+    return self._value
+
+  def then(self, f):
+    """returns a Future of f applied to this one's result"""
+    return Future(lambda: f(self.get_result()))
+
+def fetch_async(query, limit, offset=0):
+  """query.fetch(limit, offset) as a Future"""
+  if ASYNC_DATASTORE:
+    results = query.run(limit=limit, offset=offset)
+    return Future(lambda: list(results))
+  return Future(lambda: query.fetch(limit, offset))
+
+def run_async(query):
+  """list(query.run()) as a Future"""
+  if ASYNC_DATASTORE:
+    results = query.run()
+    return Future(lambda: list(results))
+  return Future(lambda: list(query.run()))
+
+def wait_all(futures):
+  """the results of futures, in the same order"""
+  return [f.get_result() for f in futures]
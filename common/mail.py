@@ -84,9 +84,14 @@ def filter_out_blocked_addresses(message_tuples):
   return (allowed, send_count)
 
 def mass_send(message_tuples):
+  """sends (subject, message, from_email, recipients) tuples over a single
+  connection, every recipient of a tuple is on the To: line of its message
+  """
   send_count = 0
   allowed, fake_send_count = filter_out_blocked_addresses(message_tuples)
   send_count += fake_send_count
+  # nothing left to send for the ones that only had blocked recipients
+  allowed = [t for t in allowed if t[3]]
   send_count += mail.send_mass_mail(tuple(allowed))
   return send_count
 
@@ -114,12 +119,36 @@ def email_comment_notification(actor_to_ref, actor_from_ref,
   # TODO(termie) pretty 'r up
   comment_pretty = comment_ref.extra.get('content', '')
 
-  t = loader.get_template('common/email/email_comment.txt')
+  t = util.get_template('common/email/email_comment.txt')
   c = template.Context(locals(), autoescape=False)
   message = t.render(c)
   subject = 'New comment on %s' % (entry_ref.title())
   return (subject, message)
 
+def email_comment_digest(actor_to_ref, comments, entry_ref):
+  """Send one email about several comments posted on the same entry.
+  PARAMETERS:
+    actor_to_ref - actor whom this email is going to
+    comments - (actor_from_ref, comment_ref) for each comment, oldest first
+    entry_ref - the entry that was commented on
+  RETURNS: (subject, message)
+  """
+  entry_url = entry_ref.url()
+  entry_mobile_url = entry_ref.url(mobile=True)
+  my_entry = (actor_to_ref.nick == entry_ref.actor)
+  entry_actor_name = util.display_nick(entry_ref.actor)
+  entry_title = entry_ref.title()
+
+  comments = [{'from_name': actor_from_ref.display_nick(),
+               'comment_pretty': comment_ref.extra.get('content', '')}
+              for actor_from_ref, comment_ref in comments]
+
+  t = util.get_template('common/email/email_comment_digest.txt')
+  c = template.Context(locals(), autoescape=False)
+  message = t.render(c)
+  subject = '%s new comments on %s' % (len(comments), entry_ref.title())
+  return (subject, message)
+
 def email_confirmation_message(actor, activation_code):
   name = _greeting_name(actor)
   # TODO(teemu): what is a canonical way to do get URLs in Django?
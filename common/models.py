@@ -14,13 +14,17 @@
 
 import datetime
 import logging
+import threading
+import time
 
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import db as models
 
 from oauth import oauth
 from django.conf import settings
 from django.db import models as django_models
 
+from common import memcache
 from common import profile
 from common import properties
 from common import util
@@ -74,6 +78,171 @@ def _to_api(v):
   return v
 
 
+# Cross-request cache
+#
+# Kinds that set memcache_ttl keep a copy of each entity read by key name in
+# memcache as (generation, serialized protobuf) under 'model/<kind>/<key_name>'.
+# Every put() and delete() bumps a generation counter stored next to it, so a
+# value is only served if it was written under the current generation; a
+# reader that raced with a write ends up storing a value nobody will read.
+#
+# Kinds that set negative_ttl also remember for that long that a key name
+# doesn't exist, stored as (generation, None); creating the entity with put()
+# bumps the generation just the same.
+
+def _memcached(model_class):
+  return model_class.memcache_ttl or model_class.negative_ttl
+
+def _memcache_keys(model_class, key_name):
+  base = 'model/%s/%s' % (model_class.kind(), key_name)
+  return base + '/gen', base
+
+def _memcache_read(pairs):
+  """Looks (model_class, key_name) pairs up in memcache
+
+  RETURNS: (found, generations) where found is {pair: entity} for the hits
+  and generations is {pair: generation} for the misses that may be written
+  back with _memcache_write() once they have been read from the datastore
+  """
+  if not pairs:
+    return {}, {}
+
+  keys = []
+  for pair in pairs:
+    keys.extend(_memcache_keys(*pair))
+  cached = memcache.client.get_multi(keys)
+
+  found = {}
+  generations = {}
+  new_generations = {}
+  for pair in pairs:
+    gen_key, value_key = _memcache_keys(*pair)
+    generation = cached.get(gen_key)
+    if generation is None:
+      # start a new counter before going to the datastore so that a put()
+      # that happens after our read still invalidates what we write back
+      generation = int(time.time() * 1000000)
+      new_generations[gen_key] = generation
+    else:
+      value = cached.get(value_key)
+      if value and value[0] == generation:
+        if value[1] is None:
+          profile.store_call(pair[0], 'get_by_key_name',
+                             'memcache_negative_hit')
+          CachingModel._negative_hit_count += 1
+          found[pair] = None
+        else:
+          found[pair] = models.model_from_protobuf(
+              entity_pb.EntityProto(value[1]))
+        continue
+    generations[pair] = generation
+
+  if new_generations:
+    # if somebody else started the counter first we don't know its value
+    not_added = memcache.client.add_multi(new_generations)
+    for pair in generations.keys():
+      if _memcache_keys(*pair)[0] in not_added:
+        del generations[pair]
+  return found, generations
+
+def _memcache_write(entities, generations):
+  """Stores {(model_class, key_name): entity} read from the datastore"""
+  by_ttl = {}
+  for pair, entity in entities.iteritems():
+    if pair not in generations:
+      continue
+    model_class = pair[0]
+    if entity is None:
+      if not model_class.negative_ttl:
+        continue
+      ttl = model_class.negative_ttl
+      value = (generations[pair], None)
+    else:
+      if not model_class.memcache_ttl:
+        continue
+      ttl = model_class.memcache_ttl
+      value = (generations[pair], models.model_to_protobuf(entity).Encode())
+    by_ttl.setdefault(ttl, {})[_memcache_keys(*pair)[1]] = value
+
+  for ttl, mapping in by_ttl.iteritems():
+    memcache.client.set_multi(mapping, time=ttl)
+
+def _memcache_invalidate(model_class, key_name):
+  if _memcached(model_class):
+    memcache.client.incr(_memcache_keys(model_class, key_name)[0])
+
+# Per-request cache
+
+class RequestCache(object):
+  """The entities read by key name while processing a single request
+
+  Each thread has its own, see request_cache(). Holds at most max_size
+  entities, the least recently used ones are dropped beyond that so that long
+  running tasks don't grow it without bounds.
+  """
+  def __init__(self, max_size=None):
+    if max_size is None:
+      max_size = settings.REQUEST_CACHE_SIZE
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entities = {}
+    self._last_used = {}
+    self._clock = 0
+    self._memos = {}
+
+  def __len__(self):
+    return len(self._entities)
+
+  def lookup(self, key):
+    """returns (found, entity)"""
+    if key not in self._entities:
+      self.misses += 1
+      return False, None
+    self.hits += 1
+    self._touch(key)
+    return True, self._entities[key]
+
+  def store(self, key, entity):
+    if key not in self._entities and len(self._entities) >= self.max_size:
+      self._evict()
+    self._entities[key] = entity
+    self._touch(key)
+
+  def remove(self, key):
+    if key in self._entities:
+      del self._entities[key]
+      del self._last_used[key]
+
+  def memo(self, name):
+    """a dict for anything else worth remembering for the request"""
+    return self._memos.setdefault(name, {})
+
+  def stats(self):
+    return {'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._entities)}
+
+  def _touch(self, key):
+    self._clock += 1
+    self._last_used[key] = self._clock
+
+  def _evict(self):
+    # drop the least recently used quarter in one go rather than one entity
+    # per store() so that the sort is amortized
+    by_age = sorted(self._last_used.iteritems(), key=lambda x: x[1])
+    for key, used in by_age[:max(1, self.max_size / 4)]:
+      self.remove(key)
+      self.evictions += 1
+
+_request_local = threading.local()
+
+def request_cache():
+  """returns this thread's RequestCache or None if caching is disabled"""
+  return getattr(_request_local, 'cache', None)
+
 # Base Models, Internal Only
 
 class ApiMixinModel(models.Model):
@@ -88,10 +257,16 @@ class CachingModel(ApiMixinModel):
   """A simple caching layer for model objects: caches any item read with
   get_by_key_name and removes from the cache on put() and delete()
 
-  You must call reset_cache() in the beginning of any HTTP request or test.
+  The cache is a RequestCache private to the current thread. It is created by
+  enable_cache() and thrown away by enable_cache(False), the CacheMiddleware
+  does both around every HTTP request; tests and tasks call them directly.
 
   The design idea is that this should give a consistent view of the data within
   the processing a single request.
+
+  Kinds that are read far more often than they are written can also set
+  memcache_ttl (in seconds) to be cached across requests and negative_ttl to
+  remember key names that don't exist, see _memcache_read() above.
   """
 
   # TODO(mikie): appengine has non-Model put() and delete() that act on a bunch
@@ -101,9 +276,10 @@ class CachingModel(ApiMixinModel):
   # TODO(mikie): should cache items read through methods other than
   # get_by_key_name()
 
-  _cache = { }
-  _cache_enabled = False
   _get_count = 0
+  _negative_hit_count = 0
+  memcache_ttl = None
+  negative_ttl = None
   def __init__(self, parent=None, key_name=None, _app=None, **kw):
     if not key_name:
       key_name = self.key_from(**kw)
@@ -123,11 +299,9 @@ class CachingModel(ApiMixinModel):
     return None
 
   def _remove_from_cache(self):
-    clsname = self.__class__.__name__
-    if CachingModel._cache_enabled:
-      if CachingModel._cache.has_key(clsname):
-        if CachingModel._cache[clsname].has_key(self._cache_keyname__):
-          CachingModel._cache[clsname].pop(self._cache_keyname__)
+    cache = request_cache()
+    if cache is not None:
+      cache.remove((self.__class__.__name__,) + self._cache_keyname__)
 
   @profile.log_write
   def put(self):
@@ -135,59 +309,188 @@ class CachingModel(ApiMixinModel):
     ret = super(CachingModel, self).put()
     self._cache_keyname__ = (self.key().name(), self.parent_key())
     self._remove_from_cache()
+    if self.parent_key() is None:
+      _memcache_invalidate(self.__class__, self.key().name())
     return ret
 
   def save(self):
     return self.put()
+
+  @classmethod
+  @profile.log_call('write')
+  def put_multi(cls, entities):
+    """puts entities with a single datastore call, keeping the caches in
+    step the way put() does for each of them"""
+    for entity in entities:
+      entity._remove_from_cache()
+    ret = models.put(entities)
+    for entity in entities:
+      entity._cache_keyname__ = (entity.key().name(), entity.parent_key())
+      entity._remove_from_cache()
+      if entity.parent_key() is None:
+        _memcache_invalidate(entity.__class__, entity.key().name())
+    return ret
   
+  @classmethod
+  @profile.log_call('write')
+  def delete_multi(cls, entities):
+    """deletes entities with a single datastore call, like put_multi"""
+    for entity in entities:
+      entity._remove_from_cache()
+    keys = [entity.key() for entity in entities]
+    ret = models.delete(keys)
+    for key in keys:
+      if key.parent() is None:
+        _memcache_invalidate(cls, key.name())
+    return ret
+
   @profile.log_write
   def delete(self):
     self._remove_from_cache()
-    return super(CachingModel, self).delete()
+    key = self.key()
+    ret = super(CachingModel, self).delete()
+    if key.parent() is None:
+      _memcache_invalidate(self.__class__, key.name())
+    return ret
   
   @classmethod
   @profile.log_call('threadlocal_cached_read')
   def get_by_key_name(cls, key_names, parent=None):
     if not key_names:
       return
-    # Only caches when called with a single key
-    if CachingModel._cache_enabled and (
-          isinstance(key_names, str) or isinstance(key_names, unicode)):
-      clsname = cls.__name__
-      if not CachingModel._cache.has_key(clsname):
-        CachingModel._cache[clsname] = { }
-      elif CachingModel._cache[clsname].has_key((key_names, parent)):
-        profile.store_call(cls, 'get_by_key_name', 'threadlocal_cache_hit')
-        return CachingModel._cache[clsname][(key_names, parent)]
+    if not (isinstance(key_names, str) or isinstance(key_names, unicode)):
+      return cls._get_by_key_names(key_names, parent)
 
-      profile.store_call(cls, 'get_by_key_name', 'threadlocal_cache_miss')
-      ret = super(CachingModel, cls).get_by_key_name(key_names, parent)
-      CachingModel._get_count += 1
-      CachingModel._cache[clsname][(key_names, parent)] = ret
-      if ret:
-        ret._cache_keyname__ = (key_names, parent)
+    if request_cache() is None:
+      return cls._get_uncached([key_names], parent)[0]
+
+    found, ret = cls._cache_lookup(key_names, parent)
+    if found:
+      profile.store_call(cls, 'get_by_key_name', 'threadlocal_cache_hit')
       return ret
-    else:
+
+    profile.store_call(cls, 'get_by_key_name', 'threadlocal_cache_miss')
+    ret = cls._get_uncached([key_names], parent)[0]
+    cls._cache_store(key_names, ret, parent)
+    return ret
+
+  @classmethod
+  def _get_by_key_names(cls, key_names, parent=None):
+    """get_by_key_name for a list of key names
+
+    Whatever is already in the per-request cache is served from there, the
+    rest is fetched with a single batched get and added to the cache.
+    Returns a list in the same order as key_names with None for missing items.
+    """
+    if request_cache() is None:
+      return cls._get_uncached(key_names, parent)
+
+    o = {}
+    misses = []
+    for key_name in key_names:
+      if key_name in o:
+        continue
+      found, entity = cls._cache_lookup(key_name, parent)
+      if found:
+        o[key_name] = entity
+      else:
+        o[key_name] = None
+        misses.append(key_name)
+
+    hits = len(o) - len(misses)
+    if hits:
+      profile.store_call(cls, 'get_by_key_name', 'threadlocal_cache_hit')
+
+    if misses:
+      profile.store_call(cls, 'get_by_key_name', 'threadlocal_cache_miss')
+      fetched = cls._get_uncached(misses, parent)
+      for key_name, entity in zip(misses, fetched):
+        cls._cache_store(key_name, entity, parent)
+        o[key_name] = entity
+
+    return [o[key_name] for key_name in key_names]
+
+  @classmethod
+  def _get_uncached(cls, key_names, parent=None):
+    """Reads key_names from memcache if this kind is cached there and
+    from the datastore otherwise, in the same order as key_names"""
+    if not _memcached(cls) or parent is not None:
       CachingModel._get_count += len(key_names)
       return super(CachingModel, cls).get_by_key_name(key_names, parent)
 
+    found, generations = _memcache_read([(cls, k) for k in key_names])
+    if found:
+      profile.store_call(cls, 'get_by_key_name', 'memcache_cache_hit')
+
+    misses = [k for k in key_names if (cls, k) not in found]
+    if misses:
+      profile.store_call(cls, 'get_by_key_name', 'memcache_cache_miss')
+      CachingModel._get_count += len(misses)
+      fetched = super(CachingModel, cls).get_by_key_name(misses, parent)
+      fetched = dict(zip([(cls, k) for k in misses], fetched))
+      _memcache_write(fetched, generations)
+      found.update(fetched)
+
+    return [found[(cls, k)] for k in key_names]
+
+  @classmethod
+  def _cache_lookup(cls, key_name, parent=None):
+    """returns (found, entity) for key_name in the per-request cache"""
+    cache = request_cache()
+    if cache is None:
+      return False, None
+    return cache.lookup((cls.__name__, key_name, parent))
+
+  @classmethod
+  def _cache_store(cls, key_name, entity, parent=None):
+    cache = request_cache()
+    if cache is None:
+      return
+    cache.store((cls.__name__, key_name, parent), entity)
+    if entity:
+      entity._cache_keyname__ = (key_name, parent)
+
   @classmethod
   def db_get_count(cls):
     return CachingModel._get_count
 
   @classmethod
   def reset_cache(cls):
-    CachingModel._cache = { }
+    if request_cache() is not None:
+      _request_local.cache = RequestCache()
 
   @classmethod
   def enable_cache(cls, enabled = True):
-    CachingModel._cache_enabled = enabled
     if not enabled:
-      CachingModel._cache = { }
+      _request_local.cache = None
+    elif request_cache() is None:
+      _request_local.cache = RequestCache()
+
+  @classmethod
+  def memo(cls, name):
+    """this thread's memo dict for name, None if caching is disabled"""
+    cache = request_cache()
+    if cache is None:
+      return None
+    return cache.memo(name)
+
+  @classmethod
+  def cache_stats(cls):
+    """hit/miss/eviction counts for this thread's cache, None if disabled"""
+    cache = request_cache()
+    if cache is None:
+      return None
+    return cache.stats()
+
+  @classmethod
+  def negative_hit_count(cls):
+    """the number of datastore gets saved by negative_ttl caching"""
+    return CachingModel._negative_hit_count
 
   @classmethod
   def reset_get_count(cls):
     CachingModel._get_count = 0
+    CachingModel._negative_hit_count = 0
   
   @classmethod
   @profile.log_read
@@ -201,6 +504,57 @@ class CachingModel(ApiMixinModel):
     #               I'd prefer to be accessing it by "db"
     return models.Query(cls)
 
+def get_multi_by_key_name(pairs):
+  """Fetches entities of possibly different kinds with a single datastore get
+
+  Entities already in the per-request cache are served from there and
+  everything fetched, including misses, is added to the cache so that later
+  get_by_key_name() calls for the same keys don't go back to the datastore.
+
+  PARAMS:
+    pairs - a list of (model_class, key_name) tuples
+
+  RETURNS: {(model_class, key_name): entity or None}
+  """
+  o = {}
+  to_fetch = []
+  for model_class, key_name in pairs:
+    if not key_name or (model_class, key_name) in o:
+      continue
+    found, entity = model_class._cache_lookup(key_name)
+    if found:
+      profile.store_call(model_class, 'get_by_key_name',
+                         'threadlocal_cache_hit')
+      o[(model_class, key_name)] = entity
+      continue
+    o[(model_class, key_name)] = None
+    to_fetch.append((model_class, key_name))
+
+  if not to_fetch:
+    return o
+
+  profile.store_call(CachingModel, 'get_multi_by_key_name',
+                     'threadlocal_cache_miss')
+  found, generations = _memcache_read(
+      [pair for pair in to_fetch if _memcached(pair[0])])
+  if found:
+    profile.store_call(CachingModel, 'get_multi_by_key_name',
+                       'memcache_cache_hit')
+  to_fetch_ds = [pair for pair in to_fetch if pair not in found]
+
+  if to_fetch_ds:
+    keys = [models.Key.from_path(model_class.kind(), key_name)
+            for model_class, key_name in to_fetch_ds]
+    CachingModel._get_count += len(keys)
+    fetched = dict(zip(to_fetch_ds, models.get(keys)))
+    _memcache_write(fetched, generations)
+    found.update(fetched)
+
+  for (model_class, key_name), entity in found.iteritems():
+    model_class._cache_store(key_name, entity)
+    o[(model_class, key_name)] = entity
+  return o
+
 class DeletedMarkerModel(CachingModel):
   deleted_at = properties.DateTimeProperty()
 
@@ -230,6 +584,36 @@ class Activation(CachingModel):
 
   key_template = 'activation/%(actor)s/%(type)s/%(content)s'
 
+class Address(CachingModel):
+  """where an actor gets notified, a copy of their 'im_account', 'mobile'
+  and 'email' relations under a key name that only depends on the actor so
+  that the addresses for a whole list of actors are a single get
+  """
+  owner = models.StringProperty()     # ref - actor nick
+  im = models.StringProperty()        # uri of the im account
+  mobile = models.StringProperty()
+  email = models.StringProperty()
+
+  key_template = 'address/%(owner)s'
+  memcache_ttl = 600
+  negative_ttl = 60
+
+class Digest(CachingModel):
+  """a comment on an entry that an actor's notification about was held back
+  for, the ones for an entry are sent together once the digest window is
+  up, see api._digest_hold()
+
+  There is a row for each held comment so that holding one more never has
+  to change the ones already there.
+  """
+  actor = models.StringProperty()     # ref - who the digest is going to
+  service = models.StringProperty()   # 'im' or 'email'
+  thread = models.StringProperty()    # ref - the entry commented on
+  entry = models.StringProperty()     # ref - the comment
+  created_at = properties.DateTimeProperty(auto_now_add=True)
+
+  key_template = 'digest/%(service)s/%(actor)s/%(entry)s'
+
 def actor_url(nick, actor_type, path='', request=None, mobile=False):
   """ returns a url, with optional path appended
 
@@ -383,16 +767,35 @@ class Task(CachingModel):
                                       # when our lock will expire
   progress = models.StringProperty()  # a string representing the offset to 
                                       # which we've progressed so far
+  lane = models.StringProperty(default='interactive')
+                                      # which lane of the queue this is in,
+                                      # follows progress, see api._task_lane
+  priority = models.IntegerProperty(default=0)
+                                      # lower goes first within a lane
+  attempts = models.IntegerProperty(default=0)
+                                      # how many times this has failed
+  last_error = models.TextProperty()  # the traceback of the last failure
+  not_before = properties.DateTimeProperty()
+                                      # when this may be retried
   created_at = properties.DateTimeProperty(auto_now_add=True)
   
   key_template = 'task/%(actor)s/%(action)s/%(action_id)s'
 
+class DeadTask(Task):
+  """A Task that kept failing, kept around to be looked at and replayed, see
+  api.task_get_dead() and api.task_replay_dead()"""
+  dead_at = properties.DateTimeProperty(auto_now_add=True)
+
+  key_template = 'deadtask/%(actor)s/%(action)s/%(action_id)s'
+
 class Relation(CachingModel):
   owner = models.StringProperty()     # ref - actor nick
   relation = models.StringProperty()  # what type of relationship this is
   target = models.StringProperty()    # ref - actor nick
 
   key_template = 'relation/%(relation)s/%(owner)s/%(target)s'
+  memcache_ttl = 600
+  negative_ttl = 60
 
 class Stream(DeletedMarkerModel):
   """
@@ -404,9 +807,15 @@ class Stream(DeletedMarkerModel):
   slug = models.StringProperty()
   read = models.IntegerProperty()     # TODO: document this
   write = models.IntegerProperty()
+  fanout_on_read = models.BooleanProperty(default=False)
+                                      # followers read the entries from here
+                                      # rather than their inboxes, only set
+                                      # once all its subscriptions have been
+                                      # marked, see api._fanout_on_read
   extra = properties.DictProperty()
 
   key_template = 'stream/%(owner)s/%(slug)s'
+  memcache_ttl = 3600
 
   def is_public(self):
     return self.read == PRIVACY_PUBLIC
@@ -526,9 +935,21 @@ class Subscription(CachingModel):
                                   # relationships, so a single query for
                                   # state='subscribed' can again be used.
   extra = properties.DictProperty()     # holds a bunch of stuff
+  delivery = models.StringListProperty() # how the subscriber wants to be
+                                  # notified besides the web: any of 'im',
+                                  # 'sms' and 'email'. A copy of the
+                                  # subscriber's notification settings so that
+                                  # the notifications only have to look at the
+                                  # subscriptions that will get one.
+  fanout_on_read = models.BooleanProperty(default=False)
+                                  # the topic is a stream whose followers read
+                                  # its entries from it rather than having
+                                  # them written to their inboxes, see
+                                  # api._fanout_on_read
   created_at = properties.DateTimeProperty(auto_now_add=True) 
                                   # for ordering someday
   key_template = '%(topic)s/%(target)s'
+  negative_ttl = 60
 
   def is_subscribed(self):
     # LEGACY COMPAT: the 'or' here is for legacy compat
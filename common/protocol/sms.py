@@ -65,15 +65,19 @@ class SmsConnection(base.Connection):
       exception.log_warning()
       return
 
-    # global monthly sms limit
-    # TODO(termie): this means that no messages will be sent if any
-    #               will go over the limit, is this really the behavior
-    #               we want?
-    for i in range(0, len(to_list)):
-      throttle.throttle(None, 
-                        'sms_global_send', 
-                        month=settings.THROTTLE_SMS_GLOBAL_MONTH)
-  
+    # global monthly sms limit, send to as many as still fit under it
+    granted = throttle.throttle_reserve(
+        None,
+        'sms_global_send',
+        len(to_list),
+        month=settings.THROTTLE_SMS_GLOBAL_MONTH)
+    if not granted:
+      raise exception.ApiThrottled('Too many attempts this month')
+    if granted < len(to_list):
+      logging.warning('SMS global limit reached, sending to %d of %d targets',
+                      granted, len(to_list))
+      to_list = to_list[:granted]
+
     message = encoding.smart_str(message)
     sms_service = component.best['sms_service']
     sms_service.send_message(to_list, message)
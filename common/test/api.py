@@ -25,12 +25,14 @@ from google.appengine.api import images
 
 from common import api
 from common import exception
+from common import futures
 from common import mail as common_mail
 from common import models
 from common import oauth_util
 from common import profile
 from common import util
 from common.protocol import sms
+from common.protocol import xmpp
 from common.test import base
 from common.test import util as test_util
 
@@ -566,6 +568,165 @@ class ApiUnitTestBasic(ApiUnitTest):
 
 
 class ApiUnitTestSubscriptions(ApiUnitTest):
+  def test_paged_targets_for_topics(self):
+    topics = ['stream/%s/presence' % nick
+              for nick in (self.popular_nick,
+                           self.unpopular_nick,
+                           self.hermit_nick)]
+    # a subscription that only counts when approval isn't needed
+    pending_ref = api.subscription_request(
+        self.popular, topics[2], 'inbox/%s/overview' % self.popular_nick)
+    self.assertEqual(pending_ref.state, 'pending')
+
+    subs = []
+    for topic in topics:
+      subs += api.subscription_get_topic(api.ROOT, topic, limit=100)
+
+    pages = {}
+    for is_restricted in (False, True):
+      expected = sorted(set([s.target for s in subs
+                             if not is_restricted or s.is_subscribed()]))
+
+      # a couple at a time, carrying on from the last one each time
+      targets = []
+      progress = None
+      more = True
+      while more:
+        page, more = api._paged_targets_for_topics(topics,
+                                                   is_restricted,
+                                                   progress=progress,
+                                                   limit=2)
+        self.assert_(len(page) <= 2)
+        targets += page
+        progress = more
+      self.assertEqual(targets, expected)
+      pages[is_restricted] = targets
+
+    self.assertNotEqual(pages[False], pages[True])
+
+  def test_paged_targets_for_topics_pending(self):
+    topic = 'stream/%s/presence' % self.popular_nick
+    # a long run of pending subscriptions ahead of everybody else
+    for i in range(5):
+      models.Subscription(topic=topic,
+                          subscriber='pending%s@example.com' % i,
+                          target='inbox/aaa%s@example.com/overview' % i,
+                          state='pending').put()
+    subs = api.subscription_get_topic(api.ROOT, topic, limit=100)
+    expected = sorted(set([s.target for s in subs if s.is_subscribed()]))
+    self.assert_(expected)
+
+    # only so many of them are looked at before the page is cut short
+    page, more = api._paged_targets_for_topics([topic], limit=1)
+    self.assertEqual(page, [])
+    self.assertEqual(more, 'inbox/aaa1@example.com/overview')
+
+    # and carrying on from there still gets to everybody
+    targets = []
+    while more:
+      page, more = api._paged_targets_for_topics([topic],
+                                                 progress=more,
+                                                 limit=1)
+      targets += page
+    self.assertEqual(targets, expected)
+
+  def test_subscription_delivery(self):
+    topic = 'stream/%s/presence' % self.popular_nick
+    unpopular_inbox = 'inbox/%s/overview' % self.unpopular_nick
+    entry_ref = api.entry_get(api.ROOT, '%s/12345' % topic)
+
+    def delivery():
+      sub_ref = api.subscription_get(api.ROOT, topic, unpopular_inbox)
+      return sub_ref.delivery
+
+    self.override = test_util.override(SUBSCRIPTION_DELIVERY_SYNCED=True)
+
+    # only the followers with im turned on are looked at for im
+    self.assertEqual(delivery(), ['im', 'email'])
+    targets, more = api._who_cares_im(entry_ref)
+    self.assertEqual(targets, [unpopular_inbox])
+
+    # asking for sms without a mobile number doesn't get you any
+    api.settings_change_notify(api.ROOT, self.unpopular_nick, sms=True)
+    self.assertEqual(delivery(), [])
+    targets, more = api._who_cares_im(entry_ref)
+    self.assertEqual(targets, [])
+
+    api.mobile_associate(api.ROOT, self.unpopular_nick, '+14084763232')
+    self.assertEqual(delivery(), ['sms'])
+    targets, more = api._who_cares_sms(entry_ref)
+    self.assertEqual(targets, [unpopular_inbox])
+
+    # new subscriptions pick it up straight away
+    hermit_topic = 'stream/%s/presence' % self.hermit_nick
+    sub_ref = api.subscription_request(api.ROOT, hermit_topic, unpopular_inbox)
+    self.assertEqual(sub_ref.delivery, ['sms'])
+
+  def test_subscription_delivery_unsynced(self):
+    popular_ref = api.actor_get(api.ROOT, self.popular_nick)
+    topic = 'stream/%s/presence' % self.popular_nick
+    unpopular_inbox = 'inbox/%s/overview' % self.unpopular_nick
+
+    # a subscription from before delivery was recorded
+    sub_ref = api.subscription_get(api.ROOT, topic, unpopular_inbox)
+    sub_ref.delivery = []
+    sub_ref.put()
+
+    xmpp.outbox = []
+    api.post(popular_ref, nick=self.popular_nick, message='still there?')
+    self.exhaust_queue_any()
+
+    jids = [jid.base() for jid, message, html_message in xmpp.outbox]
+    self.assert_(self.unpopular_nick in jids)
+
+  def test_actor_addresses(self):
+    nicks = [self.popular_nick, self.hermit_nick]
+    addresses = api._actor_addresses(nicks)
+    self.assertEqual(addresses[self.popular_nick].email,
+                     api.email_get_actor(api.ROOT, self.popular_nick))
+    self.assertEqual(addresses[self.popular_nick].im, self.popular_nick)
+    self.assertEqual(addresses[self.hermit_nick].mobile, None)
+
+    # the addresses are kept from then on and follow the relations
+    key_name = models.Address.key_from(owner=self.hermit_nick)
+    self.assertNotEqual(models.Address.get_by_key_name(key_name), None)
+    api.mobile_associate(api.ROOT, self.hermit_nick, '+14084763232')
+    addresses = api._actor_addresses(nicks)
+    self.assertEqual(addresses[self.hermit_nick].mobile, '+14084763232')
+
+  def test_actors_who_can_view_entry(self):
+    nicks = ['boyfriend@example.com', 'girlfriend@example.com',
+             self.popular_nick, self.celebrity_nick, self.hermit_nick]
+    actor_refs = api.actor_get_actors(api.ROOT, nicks)
+    actor_refs = [actor_refs[nick] for nick in nicks]
+
+    for keyname in ('stream/girlfriend@example.com/presence/16961',
+                    'stream/girlfriend@example.com/comments/16962',
+                    'stream/popular@example.com/presence/12345'):
+      entry_ref = api.entry_get(api.ROOT, keyname)
+      expected = [a.nick for a in actor_refs
+                  if api.entry_get_safe(a, keyname)]
+      readers = api._actors_who_can_view_entry(actor_refs, entry_ref)
+      self.assertEqual([a.nick for a in readers], expected)
+
+  def test_notification_render(self):
+    entry_ref = api.entry_get(api.ROOT,
+                              'stream/popular@example.com/presence/12345')
+    rendered = []
+    def render():
+      rendered.append(entry_ref.keyname())
+      return api._render_im('common/im/im_entry', {'entry': entry_ref,
+                                                   'entries': [entry_ref]})
+
+    first = api._notification_render(entry_ref, 'im', render)
+    again = api._notification_render(entry_ref, 'im', render)
+    self.assertEqual(first, again)
+    self.assertEqual(len(rendered), 1)
+
+    # the templates themselves are only compiled once
+    self.assert_(util.get_template('common/im/im_entry.txt') is
+                 util.get_template('common/im/im_entry.txt'))
+
   def test_subscription_request(self):
     topic = "stream/%s/presence"
     inbox = "inbox/%s/overview"
@@ -912,6 +1073,103 @@ class ApiUnitTestSubscriptions(ApiUnitTest):
     for x in (private_streams + nonexist_streams):
       self.assert_(not streams.get(x, None))
 
+  def test_batched_getters(self):
+    nicks = [self.popular_nick, 'unpopular@example.com', self.hermit_nick,
+             'celebrity@example.com', 'nonexist@example.com', '#popular',
+             '#nonexist']
+    channels = ['#popular', '#popular@example.com', '#nonexist', 'invalid!']
+    streams = ['stream/popular@example.com/presence',
+               'stream/hermit@example.com/presence',
+               'stream/hermit@example.com/comments',
+               'stream/nonexist@example.com/presence']
+
+    # the batched versions should agree with looking things up one by one
+    for viewer in (api.ROOT, self.popular, self.hermit, None):
+      actors = api.actor_get_actors(viewer, nicks)
+      for nick in nicks:
+        expected = api.actor_get_safe(viewer, nick)
+        self.assertEqual(actors[nick] and actors[nick].to_api(),
+                         expected and expected.to_api())
+
+      presences = api.presence_get_actors(viewer, nicks)
+      for nick in nicks:
+        expected = api.presence_get_safe(viewer, nick)
+        self.assertEqual(bool(presences[nick]), bool(expected), nick)
+
+      channel_refs = api.channel_get_channels(viewer, channels[:3])
+      for nick in channels[:3]:
+        expected = api.channel_get_safe(viewer, nick)
+        self.assertEqual(channel_refs[nick] and channel_refs[nick].nick,
+                         expected and expected.nick)
+
+      stream_refs = api.stream_get_streams(viewer, streams)
+      for stream in streams:
+        expected = api.stream_get_safe(viewer, stream)
+        self.assertEqual(bool(stream_refs.get(stream)), bool(expected))
+
+    # invalid nicks map to None rather than raising
+    channel_refs = api.channel_get_channels(api.ROOT, channels)
+    self.assertEqual(channel_refs['invalid!'], None)
+
+  def test_async_getters(self):
+    # starting several queries and collecting them later gives the same
+    # results as running them one after another
+    nick = self.popular_nick
+    pending = [api.actor_get_contacts_async(self.popular, nick),
+               api.actor_get_channels_member_async(self.popular, nick),
+               api.inbox_get_actor_overview_async(self.popular, nick),
+               api.stream_get_actor_async(self.popular, nick),
+               api.channel_get_members_async(self.popular, '#popular'),
+               ]
+    results = futures.wait_all(pending)
+    self.assertEqual(results[0], api.actor_get_contacts(self.popular, nick))
+    self.assertEqual(results[1],
+                     api.actor_get_channels_member(self.popular, nick))
+    self.assertEqual(results[2],
+                     api.inbox_get_actor_overview(self.popular, nick))
+    self.assertEqual([s.key() for s in results[3]],
+                     [s.key() for s in api.stream_get_actor(self.popular,
+                                                            nick)])
+    self.assertEqual(results[4],
+                     api.channel_get_members(self.popular, '#popular'))
+
+    # privacy is still checked when the query is started
+    self.assertRaises(exception.ApiException,
+                      api.actor_get_contacts_async,
+                      self.popular, self.hermit_nick)
+    self.assertEqual(
+        api.actor_get_contacts_safe_async(self.popular,
+                                          self.hermit_nick).get_result(),
+        [])
+
+  def test_entry_get_entries_dict(self):
+    entry_keys = ['stream/popular@example.com/presence/12345',
+                  'stream/popular@example.com/presence/12348',
+                  'stream/popular@example.com/comments/12348',
+                  'stream/unpopular@example.com/comments/14341',
+                  'stream/unpopular@example.com/comments/114341',
+                  'stream/girlfriend@example.com/presence/16961',
+                  'stream/boyfriend@example.com/comments/16963',
+                  'stream/deleted@example.com/presence/10347',
+                  'stream/nonexist@example.com/presence/1',
+                  ]
+
+    # the batched lookup should agree with looking entries up one by one
+    for viewer in (api.ROOT, self.popular, self.hermit):
+      expected = dict([(k, api.entry_get_safe(viewer, k))
+                       for k in entry_keys])
+      expected = dict([(k, v) for k, v in expected.iteritems() if v])
+
+      models.CachingModel.reset_cache()
+      entries = api.entry_get_entries_dict(viewer, entry_keys)
+      self.assertEqual(sorted(entries.keys()), sorted(expected.keys()))
+
+      models.CachingModel.reset_cache()
+      entries = api.entry_get_entries_dict(viewer, entry_keys,
+                                           hide_comments=True)
+      for entry_ref in entries.values():
+        self.assert_(not entry_ref.is_comment())
+
 class ApiUnitTestRemove(ApiUnitTest):
   def setUp(self):
     super(ApiUnitTestRemove, self).setUp()
@@ -1046,6 +1304,56 @@ class ApiUnitTestPrivacy(ApiUnitTest):
                               "non-contact %s sees entry %s" % (
                                   sub_ref.nick, entry_ref.keyname()))
 
+  def test_access_memo(self):
+    unpopular_ref = api.actor_get(api.ROOT, 'unpopular@example.com')
+    hermit_ref = api.actor_get(api.ROOT, self.hermit_nick)
+    self.assert_(not api.actor_can_view_actor(unpopular_ref, hermit_ref))
+
+    # the decision is remembered for the rest of the request
+    memo = models.CachingModel.memo('access')
+    self.assert_(memo)
+    models.CachingModel.reset_get_count()
+    self.assert_(not api.actor_can_view_actor(unpopular_ref, hermit_ref))
+    self.assertEqual(models.CachingModel.db_get_count(), 0)
+
+    # and forgotten once the relationship changes
+    api.actor_add_contact(self.hermit, self.hermit_nick, unpopular_ref.nick)
+    self.assert_(api.actor_can_view_actor(unpopular_ref, hermit_ref))
+
+  def test_viewer_context(self):
+    unpopular_ref = api.actor_get(api.ROOT, 'unpopular@example.com')
+    celebrity_ref = api.actor_get(api.ROOT, 'celebrity@example.com')
+    channel_ref = api.channel_get(api.ROOT, '#popular@example.com')
+
+    context = api.viewer_context(None, self.popular)
+    self.assert_(context.anonymous)
+    self.assertEqual(context.privacy, 'public')
+
+    context = api.viewer_context(self.popular, self.popular)
+    self.assert_(context.is_owner)
+    self.assertEqual(context.privacy, 'private')
+
+    context = api.viewer_context(unpopular_ref, self.popular)
+    self.assert_(context.follows)
+    self.assert_(not context.is_contact)
+    self.assertEqual(context.privacy, 'public')
+
+    context = api.viewer_context(celebrity_ref, self.popular)
+    self.assert_(context.is_contact)
+    self.assertEqual(context.privacy, 'contacts')
+
+    context = api.viewer_context(self.popular, channel_ref)
+    self.assert_(context.is_admin)
+    self.assertEqual(context.privacy, 'private')
+
+    context = api.viewer_context(unpopular_ref, channel_ref)
+    self.assert_(context.is_member)
+    self.assert_(not context.is_admin)
+    self.assertEqual(context.privacy, 'contacts')
+
+    # computed once per request
+    self.assert_(api.viewer_context(unpopular_ref, channel_ref) is context)
+
 class ApiUnitTestPresence(ApiUnitTest):
   def setUp(self):
     super(ApiUnitTestPresence, self).setUp()
@@ -1303,6 +1611,100 @@ class ApiUnitTestPost(ApiUnitTest):
                          location='oak')
     self.assertEqual(entry_ref.extra['location'], 'oak')
 
+  def test_post_fanout_on_read(self):
+    # popular only has a few followers, make that enough to count
+    self.override = test_util.override(CELEBRITY_FOLLOWER_COUNT=1)
+    follower_nick = 'unpopular@example.com'
+
+    popular_ref = api.actor_get(api.ROOT, self.popular_nick)
+    first_ref = api.post(popular_ref,
+                         nick=popular_ref.nick,
+                         message='switching over')
+    test_util.exhaust_queue(self.popular_nick)
+
+    # the post that starts the switch is still written to the follower's
+    # inbox, their subscriptions are marked before the stream is
+    query = models.InboxEntry.all()
+    query.filter('inbox =', 'inbox/%s/overview' % follower_nick)
+    query.filter('uuid =', first_ref.uuid)
+    self.assertNotEqual(query.get(), None)
+    stream_ref = api.stream_get_presence(api.ROOT, self.popular_nick)
+    self.assert_(stream_ref.fanout_on_read)
+    sub_ref = api.subscription_get(api.ROOT,
+                                   stream_ref.key().name(),
+                                   'inbox/%s/overview' % follower_nick)
+    self.assert_(sub_ref.fanout_on_read)
+
+    entry_ref = api.post(popular_ref,
+                         nick=popular_ref.nick,
+                         message='to the masses')
+    test_util.exhaust_queue(self.popular_nick)
+
+    # nothing was written to the follower's inbox
+    query = models.InboxEntry.all()
+    query.filter('inbox =', 'inbox/%s/overview' % follower_nick)
+    query.filter('uuid =', entry_ref.uuid)
+    self.assertEqual(query.get(), None)
+
+    # but it is there when they read it, along with what was written to it
+    inbox = api.inbox_get_actor_overview(api.ROOT, follower_nick, limit=30)
+    self.assertEqual(inbox[0], entry_ref.keyname())
+    self.assertEqual(len(inbox), len(set(inbox)))
+    entries = api.entry_get_entries(api.ROOT, inbox)
+    created = [e.created_at for e in entries]
+    self.assertEqual(created, sorted(created, reverse=True))
+
+    # the author's own overview is still written to
+    query = models.InboxEntry.all()
+    query.filter('inbox =', 'inbox/%s/overview' % self.popular_nick)
+    query.filter('uuid =', entry_ref.uuid)
+    self.assertNotEqual(query.get(), None)
+
+    # and somebody who doesn't follow them doesn't get it
+    inbox = api.inbox_get_actor_overview(api.ROOT, self.hermit_nick, limit=30)
+    self.failIf(entry_ref.keyname() in inbox)
+
+    # until they start following
+    hermit_ref = api.actor_get(api.ROOT, self.hermit_nick)
+    api.subscription_request(hermit_ref,
+                             stream_ref.key().name(),
+                             'inbox/%s/overview' % self.hermit_nick)
+    inbox = api.inbox_get_actor_overview(api.ROOT, self.hermit_nick, limit=30)
+    self.assert_(entry_ref.keyname() in inbox)
+
+  def test_post_fanout_on_read_since(self):
+    self.override = test_util.override(CELEBRITY_FOLLOWER_COUNT=1)
+    follower_nick = 'unpopular@example.com'
+
+    popular_ref = api.actor_get(api.ROOT, self.popular_nick)
+    api.post(popular_ref, nick=popular_ref.nick, message='switching over')
+    test_util.exhaust_queue(self.popular_nick)
+    entry_ref = api.post(popular_ref,
+                         nick=popular_ref.nick,
+                         message='to the masses')
+    test_util.exhaust_queue(self.popular_nick)
+
+    # polling for what is new shows it too
+    since_time = entry_ref.created_at - datetime.timedelta(seconds=1)
+    since_time = since_time.strftime('%Y-%m-%d %H:%M:%S')
+    follower_ref = api.actor_get(api.ROOT, follower_nick)
+    entries = api.entry_get_actor_overview_since(follower_ref,
+                                                 follower_nick,
+                                                 since_time=since_time).raw
+    keys = [e.keyname() for e in entries]
+    self.assert_(entry_ref.keyname() in keys)
+    self.assertEqual(len(keys), len(set(keys)))
+    created = [e.created_at for e in entries]
+    self.assertEqual(created, sorted(created))
+
+    # and not when polling from after it
+    since_time = entry_ref.created_at + datetime.timedelta(seconds=1)
+    since_time = since_time.strftime('%Y-%m-%d %H:%M:%S')
+    inbox = api.inbox_get_entries_since(api.ROOT,
+                                        'inbox/%s/overview' % follower_nick,
+                                        since_time=since_time)
+    self.failIf(entry_ref.keyname() in inbox)
+
 class ApiUnitTestSpam(ApiUnitTest):
 
   def setUp(self):
@@ -1459,6 +1861,102 @@ class EmailTest(ApiUnitTest):
                       for r in recipients];
     r = common_mail.mass_send(message_tuples)
 
+  def test_comment_notification_emails(self):
+    celebrity_ref = api.actor_get(api.ROOT, self.celebrity_nick)
+    entry_ref = api.entry_get(api.ROOT,
+                              'stream/popular@example.com/presence/12345')
+    mail.outbox = []
+
+    # popular wrote the entry and unpopular follows its comments
+    api.entry_add_comment(celebrity_ref,
+                          stream=entry_ref.stream,
+                          entry=entry_ref.keyname(),
+                          nick=celebrity_ref.nick,
+                          content='celebrity comment')
+    self.exhaust_queue_any()
+
+    sent = dict([(m.to[0], m) for m in mail.outbox])
+    self.assertEqual(len(mail.outbox), 2)
+    self.assertEqual(sorted(sent.keys()),
+                     ['popular@example.com', 'unpopular@example.com'])
+    self.assert_('your update' in sent['popular@example.com'].body)
+    self.assert_('your update' not in sent['unpopular@example.com'].body)
+
+  def test_comment_notification_digest(self):
+    self.override = test_util.override(NOTIFICATION_DIGEST_WINDOW=300)
+    celebrity_ref = api.actor_get(api.ROOT, self.celebrity_nick)
+    entry_ref = api.entry_get(api.ROOT,
+                              'stream/popular@example.com/presence/12345')
+    def comment(content):
+      api.entry_add_comment(celebrity_ref,
+                            stream=entry_ref.stream,
+                            entry=entry_ref.keyname(),
+                            nick=celebrity_ref.nick,
+                            content=content)
+      self.exhaust_queue_any()
+
+    # the first one goes out straight away
+    mail.outbox = []
+    comment('first comment')
+    self.assertEqual(len(mail.outbox), 2)
+
+    # the ones after it wait for the window to close
+    mail.outbox = []
+    comment('second comment')
+    comment('third comment')
+    self.assertEqual(len(mail.outbox), 0)
+    query = models.Digest.all().filter('service =', 'email')
+    query.filter('actor =', self.unpopular_nick)
+    query.filter('thread =', entry_ref.keyname())
+    self.assertEqual(query.count(), 2)
+
+    old_utcnow = api.utcnow
+    now = api.utcnow()
+    api.utcnow = lambda: now + datetime.timedelta(seconds=600)
+    try:
+      self.exhaust_queue_any()
+    finally:
+      api.utcnow = old_utcnow
+
+    self.assertEqual(len(mail.outbox), 2)
+    for message in mail.outbox:
+      self.assert_(message.subject.startswith('2 new comments'))
+      self.assert_('second comment' in message.body)
+      self.assert_('third comment' in message.body)
+    self.assertEqual(models.Digest.all().count(), 0)
+
+  def test_comment_notification_digest_split(self):
+    """ test that somebody with more held comments than fit in a batch still
+    gets them all in one digest """
+    self.override = test_util.override(NOTIFICATION_DIGEST_WINDOW=300)
+    celebrity_ref = api.actor_get(api.ROOT, self.celebrity_nick)
+    entry_ref = api.entry_get(api.ROOT,
+                              'stream/popular@example.com/presence/12345')
+    for content in ('first comment', 'second comment', 'third comment'):
+      api.entry_add_comment(celebrity_ref,
+                            stream=entry_ref.stream,
+                            entry=entry_ref.keyname(),
+                            nick=celebrity_ref.nick,
+                            content=content)
+      self.exhaust_queue_any()
+
+    mail.outbox = []
+    old_utcnow = api.utcnow
+    old_max = api.MAX_NOTIFICATIONS_PER_TASK
+    now = api.utcnow()
+    api.utcnow = lambda: now + datetime.timedelta(seconds=600)
+    api.MAX_NOTIFICATIONS_PER_TASK = 1
+    try:
+      self.exhaust_queue_any()
+    finally:
+      api.utcnow = old_utcnow
+      api.MAX_NOTIFICATIONS_PER_TASK = old_max
+
+    self.assertEqual(len(mail.outbox), 2)
+    for message in mail.outbox:
+      self.assert_(message.subject.startswith('2 new comments'))
+    self.assertEqual(models.Digest.all().count(), 0)
+
   # If a real email sending is not working in your environment,
   # comment out this test to test your setup.
   #def test_smtp_server(self):
@@ -0,0 +1,66 @@
+# Copyright 2009 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from common import api
+from common import dataloader
+from common import models
+from common.test import base
+
+class DataLoaderTest(base.FixturesTestCase):
+  entry_keys = ['stream/popular@example.com/presence/12345',
+                'stream/popular@example.com/presence/12348',
+                'stream/hermit@example.com/presence/12349',
+                ]
+
+  def setUp(self):
+    super(DataLoaderTest, self).setUp()
+    models.CachingModel.reset_cache()
+    models.CachingModel.enable_cache(True)
+    self.popular = api.actor_get(api.ROOT, 'popular@example.com')
+
+  def tearDown(self):
+    super(DataLoaderTest, self).tearDown()
+    models.CachingModel.enable_cache(False)
+
+  def test_prep_entries(self):
+    entries = api.entry_get_entries(self.popular, self.entry_keys)
+    data = dataloader.for_user(self.popular)
+    data.want_actors(['unpopular@example.com', 'nonexist@example.com'])
+
+    entries = data.prep_entries(entries)
+    for entry_ref in entries:
+      self.assertEqual(entry_ref.actor_ref.nick, entry_ref.actor)
+      self.assertEqual(entry_ref.stream_ref.owner_ref.nick,
+                       entry_ref.stream_ref.owner)
+
+    # everything registered before the first read was loaded with it
+    models.CachingModel.reset_get_count()
+    self.assertEqual(data.actor_list(['unpopular@example.com',
+                                      'nonexist@example.com'])[0].nick,
+                     'unpopular@example.com')
+    self.assertEqual(models.CachingModel.db_get_count(), 0)
+
+  def test_per_request(self):
+    self.assert_(dataloader.for_user(self.popular) is
+                 dataloader.for_user(self.popular))
+    self.assert_(dataloader.for_user(self.popular) is not
+                 dataloader.for_user(None))
+
+  def test_privacy(self):
+    data = dataloader.for_user(self.popular)
+    streams = data.streams(['stream/popular@example.com/presence',
+                            'stream/hermit@example.com/presence'])
+    self.assertEqual(streams.keys(), ['stream/popular@example.com/presence'])
+    self.assertEqual(data.channel_list(['#popular', '#nonexist']),
+                     [data.channels(['#popular'])['#popular']])
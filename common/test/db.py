@@ -13,12 +13,15 @@
 # limitations under the License.
 
 import datetime
+import threading
 
 from django import test
 
 from common import api
+from common import memcache
 from common import models
 from common import properties
+from common.test import util as test_util
 
 class DbCacheTest(test.TestCase):
   entry_keys = ('stream/popular@example.com/presence/12345',
@@ -34,6 +37,63 @@ class DbCacheTest(test.TestCase):
     api.entry_get_entries(api.ROOT, self.entry_keys)
     self.assertEqual(models.CachingModel.db_get_count(), first_count)
 
+  def test_with_cache_multi(self):
+    models.CachingModel.reset_get_count()
+    models.CachingModel.reset_cache()
+    models.CachingModel.enable_cache()
+    nonexist_key = 'stream/nonexist@example.com/presence/1'
+
+    # a single read first, the list read should only fetch the rest
+    models.StreamEntry.get_by_key_name(self.entry_keys[0])
+    self.assertEqual(models.CachingModel.db_get_count(), 1)
+
+    keys = [self.entry_keys[1], nonexist_key, self.entry_keys[0]]
+    rv = models.StreamEntry.get_by_key_name(keys)
+    self.assertEqual(len(rv), 3)
+    self.assertEqual(rv[1], None)
+    self.assertEqual(models.CachingModel.db_get_count(), 3)
+
+    # everything, including the miss, is now served from the cache
+    again = models.StreamEntry.get_by_key_name(keys)
+    self.assertEqual(models.CachingModel.db_get_count(), 3)
+    self.assertEqual([x and x.key() for x in again],
+                     [x and x.key() for x in rv])
+    models.StreamEntry.get_by_key_name(nonexist_key)
+    self.assertEqual(models.CachingModel.db_get_count(), 3)
+
+  def test_cache_per_thread(self):
+    models.CachingModel.reset_cache()
+    models.CachingModel.enable_cache()
+    models.StreamEntry.get_by_key_name(self.entry_keys[0])
+
+    # another thread neither sees nor resets this thread's cache
+    seen = []
+    def other_thread():
+      seen.append(models.request_cache())
+      models.CachingModel.enable_cache()
+      models.CachingModel.reset_cache()
+    t = threading.Thread(target=other_thread)
+    t.start()
+    t.join()
+
+    self.assertEqual(seen, [None])
+    self.assertEqual(len(models.request_cache()), 1)
+    models.CachingModel.enable_cache(False)
+
+  def test_cache_eviction(self):
+    cache = models.RequestCache(max_size=4)
+    for i in range(4):
+      cache.store(('StreamEntry', str(i), None), i)
+    # '0' was used recently so '1' is the one to go
+    cache.lookup(('StreamEntry', '0', None))
+    cache.store(('StreamEntry', '4', None), 4)
+
+    self.assertEqual(len(cache), 4)
+    self.assertEqual(cache.lookup(('StreamEntry', '0', None)), (True, 0))
+    self.assertEqual(cache.lookup(('StreamEntry', '1', None)), (False, None))
+    self.assertEqual(cache.stats(),
+                     {'hits': 2, 'misses': 1, 'evictions': 1, 'size': 4})
+
   def test_without_cache(self):
     models.CachingModel.reset_get_count()
     models.CachingModel.reset_cache()
@@ -44,6 +104,92 @@ class DbCacheTest(test.TestCase):
     api.entry_get_entries(api.ROOT, self.entry_keys)
     self.assertNotEqual(models.CachingModel.db_get_count(), first_count)
 
+class DbMemcacheTest(test.TestCase):
+  nick = 'popular@example.com'
+  key_name = 'actor/popular@example.com'
+
+  def setUp(self):
+    self.old_client = memcache.client
+    memcache.client = test_util.FakeMemcache()
+    models.CachingModel.reset_get_count()
+    models.CachingModel.reset_cache()
+    models.CachingModel.enable_cache()
+
+  def tearDown(self):
+    memcache.client = self.old_client
+
+  def new_request(self):
+    models.CachingModel.reset_cache()
+
+  def test_cross_request(self):
+    actor_ref = models.User.get_by_key_name(self.key_name)
+    self.assertEqual(models.CachingModel.db_get_count(), 1)
+
+    # a new request gets it from memcache rather than the datastore
+    self.new_request()
+    again = models.User.get_by_key_name(self.key_name)
+    self.assertEqual(models.CachingModel.db_get_count(), 1)
+    self.assertEqual(again.key(), actor_ref.key())
+    self.assertEqual(again.extra, actor_ref.extra)
+
+    # list reads use it as well
+    self.new_request()
+    models.User.get_by_key_name([self.key_name])
+    self.assertEqual(models.CachingModel.db_get_count(), 1)
+
+  def test_put_invalidates(self):
+    actor_ref = models.User.get_by_key_name(self.key_name)
+    actor_ref.extra['description'] = 'changed'
+    actor_ref.put()
+
+    self.new_request()
+    again = models.User.get_by_key_name(self.key_name)
+    self.assertEqual(models.CachingModel.db_get_count(), 2)
+    self.assertEqual(again.extra['description'], 'changed')
+
+  def test_stale_write_ignored(self):
+    # a reader that started before the put() can't repopulate the cache
+    found, generations = models._memcache_read([(models.User, self.key_name)])
+    stale_ref = models.User.get_by_key_name(self.key_name)
+    self.new_request()
+
+    actor_ref = models.User.get_by_key_name(self.key_name)
+    actor_ref.extra['description'] = 'changed'
+    actor_ref.put()
+
+    models._memcache_write({(models.User, self.key_name): stale_ref},
+                           generations)
+    self.new_request()
+    again = models.User.get_by_key_name(self.key_name)
+    self.assertEqual(again.extra['description'], 'changed')
+
+  def test_negative(self):
+    key_name = models.Relation.key_from(relation='contact',
+                                        owner='hermit@example.com',
+                                        target='popular@example.com')
+    self.assertEqual(models.Relation.get_by_key_name(key_name), None)
+    self.assertEqual(models.CachingModel.db_get_count(), 1)
+
+    self.new_request()
+    self.assertEqual(models.Relation.get_by_key_name(key_name), None)
+    self.assertEqual(models.CachingModel.db_get_count(), 1)
+    self.assertEqual(models.CachingModel.negative_hit_count(), 1)
+
+    # creating it invalidates the negative entry
+    models.Relation(owner='hermit@example.com',
+                    relation='contact',
+                    target='popular@example.com').put()
+    self.new_request()
+    self.assertNotEqual(models.Relation.get_by_key_name(key_name), None)
+    self.assertEqual(models.CachingModel.db_get_count(), 2)
+
+  def test_uncached_kind(self):
+    key_name = DbCacheTest.entry_keys[0]
+    models.StreamEntry.get_by_key_name(key_name)
+    self.new_request()
+    models.StreamEntry.get_by_key_name(key_name)
+    self.assertEqual(models.CachingModel.db_get_count(), 2)
+
 class PropertyTestCase(test.TestCase):
   def test_datetimeproperty_validate(self):
     p = properties.DateTimeProperty()
@@ -20,9 +20,12 @@ from oauth import oauth
 from django.conf import settings
 from django.core import mail
 
+from google.appengine.ext import db
+
 from common import api
 from common import exception
 from common import mail as common_mail
+from common import memcache
 from common import models
 from common import oauth_util
 from common import profile
@@ -48,6 +51,22 @@ class QueueTest(base.FixturesTestCase):
 
     settings.QUEUE_ENABLED = self.old_enabled
 
+  def exhaust_queue_waiting(self, nick=None):
+    """ exhaust the queue, including the tasks that are waiting on others
+    and only due again later """
+    old_utcnow = api.utcnow
+    try:
+      for i in range(10):
+        if nick:
+          test_util.exhaust_queue(nick)
+        else:
+          test_util.exhaust_queue_any()
+        later = api.utcnow() + datetime.timedelta(
+            seconds=api.TASK_SHARD_WAIT_DELAY)
+        api.utcnow = lambda later=later: later
+    finally:
+      api.utcnow = old_utcnow
+
   def test_task_crud(self):
     # make a fake task for posting a simple message
     nick = 'popular@example.com'
@@ -142,8 +161,7 @@ class QueueTest(base.FixturesTestCase):
     
       # and that task_process_actor works
       # and run out the queue
-      for i in range(5):
-        api.task_process_actor(api.ROOT, nick)
+      self.exhaust_queue_waiting(nick)
     
       self.assertRaises(exception.ApiNoTasks,
                         lambda: api.task_process_actor(api.ROOT, nick))
@@ -173,11 +191,328 @@ class QueueTest(base.FixturesTestCase):
     
       # and that task_process_any works
       # and run out the queue
-      for i in range(5):
-        api.task_process_any(api.ROOT, nick)
+      self.exhaust_queue_waiting()
       
       self.assertRaises(exception.ApiNoTasks,
                         lambda: api.task_process_actor(api.ROOT, nick))
     finally:
       api.MAX_FOLLOWERS_PER_INBOX = old_max  
 
+  def test_task_post_sharded(self):
+    """ test that followers past the first page are handed out to shard
+    tasks and that the post task waits for them
+    """
+    nick = 'popular@example.com'
+    uuid = 'HOWNOW'
+    message = 'BROWNCOW'
+    followers = ['celebrity@example.com',
+                 'obligated@example.com',
+                 'unpopular@example.com']
+
+    actor_ref = api.actor_get(api.ROOT, nick)
+
+    old_max = api.MAX_FOLLOWERS_PER_INBOX
+    old_batch_size = api.INBOX_WRITE_BATCH_SIZE
+    api.MAX_FOLLOWERS_PER_INBOX = 1
+    api.INBOX_WRITE_BATCH_SIZE = 1
+
+    try:
+      entry_ref = api.post(actor_ref, nick=nick, uuid=uuid, message=message)
+
+      # the first follower was handled right away, the post task is the only
+      # one so far so it will be the one processed next
+      tasks = models.Task.all().filter('actor =', nick).fetch(100)
+      self.assertEqual(len(tasks), 1)
+      self.assert_(tasks[0].progress.startswith('shards:0:'))
+      api.task_process_actor(api.ROOT, nick)
+
+      task_ref = models.Task.get_by_key_name(
+          models.Task.key_from(actor=nick, action='post', action_id=uuid))
+      self.assertEqual(task_ref.progress, 'wait:%s' % len(followers))
+
+      shards = api._fanout_shards_pending(task_ref, len(followers))
+      self.assertEqual(len(shards), len(followers))
+      self.assertEqual([s.progress.split(':')[-1] for s in shards],
+                       ['inbox/%s/overview' % f for f in followers])
+
+      self.exhaust_queue_waiting(nick)
+      self.assertRaises(exception.ApiNoTasks,
+                        lambda: api.task_process_actor(api.ROOT, nick))
+
+      for follower in followers:
+        inbox = api.inbox_get_actor_overview(api.ROOT, follower)
+        self.assert_(entry_ref.keyname() in inbox, follower)
+    finally:
+      api.MAX_FOLLOWERS_PER_INBOX = old_max
+      api.INBOX_WRITE_BATCH_SIZE = old_batch_size
+
+  def test_task_post_shard_wait(self):
+    """ test that a post task waiting for its shards backs off instead of
+    being leased again until they are done
+    """
+    nick = 'popular@example.com'
+    uuid = 'HOWNOW'
+    actor_ref = api.actor_get(api.ROOT, nick)
+    key_name = models.Task.key_from(actor=nick, action='post', action_id=uuid)
+
+    old_max = api.MAX_FOLLOWERS_PER_INBOX
+    old_batch_size = api.INBOX_WRITE_BATCH_SIZE
+    old_utcnow = api.utcnow
+    api.MAX_FOLLOWERS_PER_INBOX = 1
+    api.INBOX_WRITE_BATCH_SIZE = 1
+
+    try:
+      api.post(actor_ref, nick=nick, uuid=uuid, message='BROWNCOW')
+      api.task_process_actor(api.ROOT, nick)
+      task_ref = models.Task.get_by_key_name(key_name)
+      shard_count = int(task_ref.progress[len('wait:'):])
+
+      # the post task is at the front so it looks first and finds the
+      # shards still to do
+      api.task_process_any(api.ROOT, nick, work_count=10)
+      task_ref = models.Task.get_by_key_name(key_name)
+      self.assertEqual(task_ref.progress, 'wait:%s' % shard_count)
+      self.assert_(task_ref.not_before > api.utcnow())
+      self.assertEqual(api._fanout_shards_pending(task_ref, shard_count), [])
+
+      # and is left alone until it is due to look again
+      self.assertEqual(api.task_process_actor(api.ROOT, nick), [])
+
+      not_before = task_ref.not_before
+      api.utcnow = lambda: not_before
+      self.assertEqual(api.task_process_actor(api.ROOT, nick), [key_name])
+      task_ref = models.Task.get_by_key_name(key_name)
+      self.assert_(task_ref.progress.startswith('notifications:'))
+    finally:
+      api.MAX_FOLLOWERS_PER_INBOX = old_max
+      api.INBOX_WRITE_BATCH_SIZE = old_batch_size
+      api.utcnow = old_utcnow
+
+  def test_task_process_batch(self):
+    """ test that a batch of tasks gets processed in one call and that the
+    time budget is respected
+    """
+    nick = 'popular@example.com'
+    actor_ref = api.actor_get(api.ROOT, nick)
+
+    old_max = api.MAX_FOLLOWERS_PER_INBOX
+    old_batch_size = api.INBOX_WRITE_BATCH_SIZE
+    old_process = api._task_process
+    old_utcnow = api.utcnow
+    api.MAX_FOLLOWERS_PER_INBOX = 1
+    api.INBOX_WRITE_BATCH_SIZE = 1
+
+    try:
+      # the first post leaves a post task and three shards behind
+      api.post(actor_ref, nick=nick, uuid='HOWNOW', message='BROWNCOW')
+      api.task_process_actor(api.ROOT, nick)
+      self.assertEqual(
+          len(models.Task.all().filter('actor =', nick).fetch(100)), 4)
+
+      # run out of time after the first task, the rest are left for others
+      now = api.utcnow()
+      def _process_slowly(task_ref):
+        old_process(task_ref)
+        api.utcnow = lambda: now + datetime.timedelta(seconds=60)
+      api._task_process = _process_slowly
+
+      processed = api.task_process_any(api.ROOT, nick, work_count=10,
+                                       time_budget=30)
+      self.assertEqual(len(processed), 1)
+      for task_ref in models.Task.all().filter('actor =', nick).fetch(100):
+        if task_ref.key().name() not in processed:
+          self.assertEqual(memcache.client.get(task_ref.key().name()), None)
+
+      api._task_process = old_process
+      api.utcnow = old_utcnow
+
+      # with time to spare one call gets through everything that is due,
+      # which leaves just the post task waiting to check on its shards
+      api.post(actor_ref, nick=nick, uuid='HOWNOW2', message='BROWNCOW')
+      processed = api.task_process_any(api.ROOT, nick, work_count=10,
+                                       time_budget=30)
+      self.assert_(len(processed) > 1)
+      self.exhaust_queue_waiting(nick)
+      self.assertRaises(exception.ApiNoTasks,
+                        lambda: api.task_process_actor(api.ROOT, nick))
+    finally:
+      api.MAX_FOLLOWERS_PER_INBOX = old_max
+      api.INBOX_WRITE_BATCH_SIZE = old_batch_size
+      api._task_process = old_process
+      api.utcnow = old_utcnow
+
+  def test_task_lanes(self):
+    """ test that interactive tasks are leased ahead of bulk ones and that
+    actors take turns
+    """
+    # bulk work that was queued first still waits for interactive work
+    api.task_create(api.ROOT, 'celebrity@example.com', 'post', 'bulk',
+                    progress='shard::inbox/popular@example.com/overview')
+    task_ref = api.task_create(api.ROOT, 'popular@example.com', 'post',
+                               'quick')
+    self.assertEqual(task_ref.lane, 'interactive')
+
+    work = api._task_lease(None, 1, api.DEFAULT_TASK_EXPIRE)
+    self.assertEqual([t.action_id for t in work], ['quick'])
+
+    # the lane follows the progress of the task
+    task_ref = api.task_update(api.ROOT, 'popular@example.com', 'post',
+                               'quick', progress='notifications:email:')
+    self.assertEqual(task_ref.lane, 'bulk')
+
+    # one actor's tasks don't all go ahead of everybody else's
+    tasks = [models.Task(actor=actor, action='post', action_id=str(i))
+             for i, actor in enumerate(['celebrity@example.com',
+                                        'celebrity@example.com',
+                                        'celebrity@example.com',
+                                        'popular@example.com',
+                                        'celebrity@example.com',
+                                        'unpopular@example.com'])]
+    self.assertEqual([t.action_id for t in api._task_interleave(tasks)],
+                     ['0', '3', '5', '1', '2', '4'])
+
+  def test_task_retry(self):
+    """ test that a failing task backs off and ends up with the dead tasks
+    once it has failed too many times
+    """
+    nick = 'popular@example.com'
+    # the method doesn't take a task so it fails every time
+    api.task_create(api.ROOT, nick, 'actor_get', 'poison')
+    key_name = models.Task.key_from(actor=nick,
+                                    action='actor_get',
+                                    action_id='poison')
+
+    old_utcnow = api.utcnow
+    try:
+      for i in range(api.TASK_MAX_ATTEMPTS - 1):
+        api.task_process_actor(api.ROOT, nick)
+        task_ref = models.Task.get_by_key_name(key_name)
+        self.assertEqual(task_ref.attempts, i + 1)
+        self.assert_('TypeError' in task_ref.last_error)
+
+        # it's left alone until it is due again
+        self.assertEqual(api.task_process_actor(api.ROOT, nick), [])
+        api.utcnow = lambda not_before=task_ref.not_before: not_before
+
+      api.task_process_actor(api.ROOT, nick)
+      self.assertEqual(models.Task.get_by_key_name(key_name), None)
+      self.assertRaises(exception.ApiNoTasks,
+                        lambda: api.task_process_actor(api.ROOT, nick))
+
+      dead = api.task_get_dead(api.ROOT)
+      self.assertEqual([t.action_id for t in dead], ['poison'])
+      self.assertEqual(dead[0].attempts, api.TASK_MAX_ATTEMPTS)
+
+      # replaying puts it back on the queue with a clean slate
+      api.task_replay_dead(api.ROOT, nick, 'actor_get', 'poison')
+      task_ref = models.Task.get_by_key_name(key_name)
+      self.assertEqual(task_ref.attempts, 0)
+      self.assertEqual(api.task_get_dead(api.ROOT), [])
+    finally:
+      api.utcnow = old_utcnow
+
+  def test_inbox_writer(self):
+    """ test that inbox rows are written in batches, and one at a time if a
+    batch can't be written
+    """
+    entry_ref = api.entry_get(api.ROOT,
+                              'stream/popular@example.com/presence/12345')
+    stream_ref = api.stream_get(api.ROOT, entry_ref.stream)
+    inboxes = ['inbox/%s/overview' % nick
+               for nick in ('annoying@example.com',
+                            'celebrity@example.com',
+                            'unpopular@example.com')]
+
+    old_put_multi = models.InboxEntry.put_multi
+    batches = []
+    def _put_multi(cls, entities):
+      batches.append(len(entities))
+      return old_put_multi(entities)
+    def _put_multi_fails(cls, entities):
+      batches.append(len(entities))
+      raise db.Timeout()
+
+    for put_multi, prefix in ((_put_multi, 'batch'),
+                              (_put_multi_fails, 'fallback')):
+      batches = []
+      models.InboxEntry.put_multi = classmethod(put_multi)
+      try:
+        writer = api._InboxWriter(batch_size=2)
+        for i, inbox in enumerate(inboxes):
+          api._add_inbox(stream_ref, entry_ref, [inbox],
+                         shard='%s%s' % (prefix, i), writer=writer)
+        writer.flush()
+      finally:
+        del models.InboxEntry.put_multi
+
+      self.assertEqual(batches, [2, 1])
+      for i, inbox in enumerate(inboxes):
+        key_name = models.InboxEntry.key_from(stream=entry_ref.stream,
+                                              uuid=entry_ref.uuid,
+                                              shard='%s%s' % (prefix, i))
+        inbox_ref = models.InboxEntry.get_by_key_name(key_name)
+        self.assertEqual(inbox_ref.inbox, [inbox])
+
+  def test_inbox_writer_bad_row(self):
+    """ test that a row that can't be written on its own doesn't stop the
+    rest of its batch, and that the error still gets out
+    """
+    entry_ref = api.entry_get(api.ROOT,
+                              'stream/popular@example.com/presence/12345')
+    stream_ref = api.stream_get(api.ROOT, entry_ref.stream)
+    inboxes = ['inbox/%s/overview' % nick
+               for nick in ('annoying@example.com',
+                            'celebrity@example.com',
+                            'unpopular@example.com')]
+
+    old_put = models.InboxEntry.put
+    def _put_multi_fails(cls, entities):
+      raise db.Timeout()
+    def _put(self):
+      if self.inbox == [inboxes[0]]:
+        raise db.Timeout()
+      return old_put(self)
+
+    models.InboxEntry.put_multi = classmethod(_put_multi_fails)
+    models.InboxEntry.put = _put
+    try:
+      writer = api._InboxWriter(batch_size=len(inboxes) + 1)
+      for i, inbox in enumerate(inboxes):
+        api._add_inbox(stream_ref, entry_ref, [inbox],
+                       shard='bad%s' % i, writer=writer)
+      self.assertRaises(db.Timeout, writer.flush)
+    finally:
+      del models.InboxEntry.put_multi
+      del models.InboxEntry.put
+
+    for i, inbox in enumerate(inboxes):
+      key_name = models.InboxEntry.key_from(stream=entry_ref.stream,
+                                            uuid=entry_ref.uuid,
+                                            shard='bad%s' % i)
+      inbox_ref = models.InboxEntry.get_by_key_name(key_name)
+      if i == 0:
+        self.assertEqual(inbox_ref, None)
+      else:
+        self.assertEqual(inbox_ref.inbox, [inbox])
+
+  def test_inbox_shard_replay(self):
+    """ test that replaying a page of fan-out writes over what it wrote the
+    first time even if the subscribers changed in between
+    """
+    entry_ref = api.entry_get(api.ROOT,
+                              'stream/popular@example.com/presence/12345')
+    stream_ref = api.stream_get(api.ROOT, entry_ref.stream)
+    first = ['inbox/annoying@example.com/overview',
+             'inbox/celebrity@example.com/overview']
+    again = ['inbox/celebrity@example.com/overview',
+             'inbox/unpopular@example.com/overview']
+
+    for inboxes in (first, again):
+      api._paged_add_inbox(inboxes, stream_ref, entry_ref,
+                           start='inbox/a', page=1)
+
+    query = models.InboxEntry.all()
+    query.filter('stream =', entry_ref.stream)
+    query.filter('uuid =', entry_ref.uuid)
+    query.filter('shard =', api._inbox_shard_id('inbox/a', 1))
+    self.assertEqual([x.inbox for x in query.fetch(10)], [again])
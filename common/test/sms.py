@@ -20,6 +20,7 @@ from django.core import mail
 
 from common import api
 from common import clean
+from common import component
 from common import exception
 from common import profile
 from common import sms as sms_service
@@ -130,3 +131,37 @@ class SmsTest(base.FixturesTestCase):
     self.assert_(r)
 
     o.reset()
+
+  def test_send_message_global_limit(self):
+    self.override = test_util.override(THROTTLE_SMS_GLOBAL_MONTH=3)
+
+    sent = []
+    class FakeSmsService(object):
+      def send_message(self, to_list, message):
+        sent.append((list(to_list), message))
+
+    old_service = component.loaded.get('sms_service')
+    component.loaded['sms_service'] = FakeSmsService()
+    try:
+      # the real send_message, TestSmsConnection replaces it
+      connection = test_util.TestSmsConnection()
+      def send(to_list):
+        super(test_util.TestSmsConnection, connection).send_message(
+            to_list, 'limited')
+
+      send(['+14085551111', '+14085552222'])
+      self.assertEqual(sent[-1], (['+14085551111', '+14085552222'], 'limited'))
+
+      # only as many as are left under the limit get it
+      send(['+14085553333', '+14085554444', '+14085555555'])
+      self.assertEqual(sent[-1], (['+14085553333'], 'limited'))
+
+      # and once it has been reached nobody does
+      self.assertRaises(exception.ApiThrottled,
+                        lambda: send(['+14085556666']))
+      self.assertEqual(len(sent), 2)
+    finally:
+      if old_service is None:
+        del component.loaded['sms_service']
+      else:
+        component.loaded['sms_service'] = old_service
@@ -53,3 +53,68 @@ class ThrottleTest(base.FixturesTestCase):
     self.assertRaises(exception.ApiThrottled, _failPants)
 
     o.reset()
+
+  def test_reserve(self):
+    # grant whatever is left under the limit
+    self.assertEqual(
+        throttle.throttle_reserve(self.popular, 'test', 3, minute=5), 3)
+    self.assertEqual(
+        throttle.throttle_reserve(self.popular, 'test', 3, minute=5), 2)
+    self.assertEqual(
+        throttle.throttle_reserve(self.popular, 'test', 3, minute=5), 0)
+
+    def _failPants():
+      throttle.throttle(self.popular, 'test', minute=5)
+
+    self.assertRaises(exception.ApiThrottled, _failPants)
+
+  def test_reserve_multiple_buckets(self):
+    # early in the hour, so that moving on a couple of minutes stays in it
+    now = datetime.datetime.utcnow()
+    offset = (now.replace(minute=0, second=0, microsecond=0)
+              + datetime.timedelta(seconds=10) - now)
+    o = test_util.override_clock(clock, seconds=offset.seconds,
+                                 days=offset.days)
+
+    # the hour only pays for what the minute allowed
+    self.assertEqual(
+        throttle.throttle_reserve(self.popular, 'test', 3, minute=2, hour=4),
+        2)
+    self.assertEqual(
+        throttle.throttle_reserve(self.popular, 'test', 3, minute=10, hour=4),
+        2)
+    o.reset()
+
+    # a new minute, but the hour remembers what it was charged
+    o = test_util.override_clock(clock, seconds=offset.seconds + 120,
+                                 days=offset.days)
+    self.assertEqual(
+        throttle.throttle_reserve(self.popular, 'test', 1, minute=2, hour=4),
+        0)
+    o.reset()
+
+  def test_calendar_month(self):
+    # a minute before the start of next month
+    now = datetime.datetime.utcnow()
+    if now.month == 12:
+      next_month = datetime.datetime(now.year + 1, 1, 1)
+    else:
+      next_month = datetime.datetime(now.year, now.month + 1, 1)
+    offset = next_month - now - datetime.timedelta(minutes=1)
+    o = test_util.override_clock(clock, seconds=offset.seconds,
+                                 days=offset.days)
+
+    throttle.throttle(self.popular, 'test', month=1)
+
+    def _failPants():
+      throttle.throttle(self.popular, 'test', month=1)
+
+    self.assertRaises(exception.ApiThrottled, _failPants)
+    o.reset()
+
+    # the month starts over on the first, not thirty days later
+    o = test_util.override_clock(clock, seconds=offset.seconds + 120,
+                                 days=offset.days)
+    throttle.throttle(self.popular, 'test', month=1)
+    self.assertRaises(exception.ApiThrottled, _failPants)
+    o.reset()
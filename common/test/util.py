@@ -44,14 +44,17 @@ def get_relative_url(s):
 def exhaust_queue(nick):
   for i in xrange(1000):
     try:
-      api.task_process_actor(api.ROOT, nick)
+      # whatever is left isn't due yet
+      if not api.task_process_actor(api.ROOT, nick):
+        break
     except exception.ApiNoTasks:
       break
     
 def exhaust_queue_any():
   for i in xrange(1000):
     try:
-      api.task_process_any(api.ROOT)
+      if not api.task_process_any(api.ROOT):
+        break
     except exception.ApiNoTasks:
       break
 
@@ -126,7 +129,7 @@ class FakeMemcache(object):
     for k, v in mapping.iteritems():
       success = self.add(key_prefix + k, v, time=time)
       if not success:
-        o.append[k]
+        o.append(k)
     return o
   
   def incr(self, key, delta=1):
@@ -144,7 +147,7 @@ class FakeMemcache(object):
     return count
 
   def decr(self, key, delta=1):
-    return incr(key, delta=-(delta))
+    return self.incr(key, delta=-(delta))
   
   def delete(self, key, seconds=0):
     # NOTE: doesn't support seconds
@@ -159,7 +162,7 @@ class FakeMemcache(object):
     for k in keys:
       success = self.delete(key_prefix + k)
       if success != 2:
-        o.append[k]
+        o.append(k)
     return o
 
   def get(self, key):
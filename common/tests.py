@@ -58,6 +58,7 @@ class UtilTestCase(test.TestCase):
 # python manage.py test common.WhateverTest
 from common.test.api import *
 from common.test.clean import *
+from common.test.dataloader import *
 from common.test.db import *
 from common.test.domain import *
 from common.test.monitor import *
@@ -29,55 +29,156 @@ utcnow = lambda: clock.utcnow()
 def _d2t(dt):
   return time.mktime(dt.timetuple())
 
-# TODO(termie): replace month with an implementation that gives the first
-#               second of next month rather than this 30-days from now
-BUCKETS = {'minute': lambda: _d2t(utcnow()) + 60,
-           'hour': lambda: _d2t(utcnow()) + 60 * 60,
-           'day': lambda: _d2t(utcnow()) + 60 * 60 * 24,
-           'month': lambda: _d2t(utcnow()) + 60 * 60 * 24 * 30,
-           } 
-
-def throttle_key(actor_ref, action, bucket):
+# Each bucket is a calendar period, a counter only ever counts the period it
+# was created in, e.g. everything since the first second of this month
+def _minute(now):
+  start = now.replace(second=0, microsecond=0)
+  return start, start + datetime.timedelta(minutes=1)
+
+def _hour(now):
+  start = now.replace(minute=0, second=0, microsecond=0)
+  return start, start + datetime.timedelta(hours=1)
+
+def _day(now):
+  start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+  return start, start + datetime.timedelta(days=1)
+
+def _month(now):
+  start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+  if start.month == 12:
+    return start, start.replace(year=start.year + 1, month=1)
+  return start, start.replace(month=start.month + 1)
+
+BUCKETS = {'minute': _minute,
+           'hour': _hour,
+           'day': _day,
+           'month': _month,
+           }
+
+def throttle_key(actor_ref, action, bucket, now=None):
+  if now is None:
+    now = utcnow()
   nick = ''
   if actor_ref and actor_ref.is_authenticated():
     nick = actor_ref.nick
-  return 'throttle/%s/%s/%s' % (nick, action, bucket)
+  start, end = BUCKETS[bucket](now)
+  return 'throttle/%s/%s/%s/%s' % (nick,
+                                   action,
+                                   bucket,
+                                   start.strftime('%Y%m%d%H%M'))
+
+def _throttle_keys(actor_ref, action, buckets, now):
+  return dict([(k, throttle_key(actor_ref, action, k, now)) for k in buckets])
+
+def _throttle_limits(actor_ref, kw):
+  """ the bucket limits in kw that apply to actor_ref
+  """
+  if actor_ref and actor_ref.is_authenticated() and actor_ref.nick == settings.ROOT_NICK:
+    return {}
+  return dict([(k, v) for k, v in kw.iteritems() if k in BUCKETS])
 
 def throttle(actor_ref, action, **kw):
   """ enforces throttling of some action per user with defined limits
+
+  The counts for all the buckets are read with a single get_multi.
   """
-  if actor_ref and actor_ref.is_authenticated() and actor_ref.nick == settings.ROOT_NICK:
+  limits = _throttle_limits(actor_ref, kw)
+  if not limits:
     return
 
+  now = utcnow()
+  keys = _throttle_keys(actor_ref, action, limits, now)
+  counts = memcache.client.get_multi(keys.values())
+
   already_throttled = False
-  for k, v in kw.iteritems():
-    if k in BUCKETS:
-      throttled = throttle_status(actor_ref, action, bucket=k, max=v)
-      
-      # if anything is throttled we will raise an error in the end
-      if throttled and not already_throttled:
-        already_throttled = k
-
-      # for any thresholds not yet hit increase the count
-      if not throttled:
-        throttle_inc(actor_ref, action, bucket=k)
-        
+  not_throttled = []
+  for k, v in limits.iteritems():
+    throttled = counts.get(keys[k]) >= v
+
+    # if anything is throttled we will raise an error in the end
+    if throttled and not already_throttled:
+      already_throttled = k
+
+    # for any thresholds not yet hit increase the count
+    if not throttled:
+      not_throttled.append(k)
+
+  _throttle_incr_multi(keys, not_throttled, now, counts=counts)
+
   if already_throttled:
     raise exception.ApiThrottled(
         'Too many attempts this %s' % already_throttled)
 
-def throttle_status(actor_ref, action, bucket, max):
-  """ check whether a throttling threshold has been hit
+def throttle_reserve(actor_ref, action, count, **kw):
+  """ reserves up to count units of some action against the defined limits
+
+  Each bucket is charged with a single incr of count and whatever is left
+  under its limit is granted, so a batch of sends costs one memcache call
+  per bucket rather than two per send.
+
+  Returns the number of units granted, which is the smallest amount any of
+  the buckets could grant. Buckets that had more room are given back the
+  difference.
+  """
+  if count <= 0:
+    return 0
+
+  limits = _throttle_limits(actor_ref, kw)
+  if not limits:
+    return count
+
+  now = utcnow()
+  keys = _throttle_keys(actor_ref, action, limits, now)
+  totals = _throttle_incr_multi(keys, limits.keys(), now, delta=count)
+
+  granted = {}
+  for k, v in limits.iteritems():
+    if totals[k] is None:
+      # memcache is unavailable, don't hold anything back
+      granted[k] = count
+      continue
+    granted[k] = max(0, min(count, v - (totals[k] - count)))
+
+  rv = min(granted.values())
+  for k, bucket_granted in granted.iteritems():
+    if bucket_granted > rv:
+      memcache.client.decr(keys[k], delta=bucket_granted - rv)
+  return rv
+
+def _throttle_incr_multi(keys, buckets, now, delta=1, counts=None):
+  """ adds delta to the counters for buckets, returns {bucket: new count}
+
+  keys maps each bucket to its counter, counts are the values already read
+  for them if there are any, counters known not to exist yet skip the incr
+  and are created with an add_multi for each time they are due to expire.
   """
-  cache_key = throttle_key(actor_ref, action, bucket)
-  count = memcache.client.get(cache_key)
-  if count >= max:
-    return True
-  return False
-
-def throttle_inc(actor_ref, action, bucket):
-  timeout = BUCKETS[bucket]()
-  cache_key = throttle_key(actor_ref, action, bucket)
-  
-  memcache.client.add(cache_key, 0, timeout)
-  memcache.client.incr(cache_key)
+  rv = {}
+  missing = []
+  for k in buckets:
+    if counts is not None and counts.get(keys[k]) is None:
+      missing.append(k)
+      continue
+    rv[k] = memcache.client.incr(keys[k], delta=delta)
+    if rv[k] is None:
+      missing.append(k)
+
+  if not missing:
+    return rv
+
+  # each counter expires at the end of its own period, so the ones that are
+  # added together are the ones whose periods end together, mostly there is
+  # only the new minute's
+  by_end = {}
+  for k in missing:
+    by_end.setdefault(BUCKETS[k](now)[1], []).append(k)
+
+  for end, buckets in by_end.iteritems():
+    not_added = memcache.client.add_multi(
+        dict([(keys[k], delta) for k in buckets]), time=_d2t(end))
+    for k in buckets:
+      if keys[k] in not_added:
+        # someone else got there first
+        rv[k] = memcache.client.incr(keys[k], delta=delta)
+      else:
+        rv[k] = delta
+  return rv
@@ -61,6 +61,8 @@ class User(DeletedMarkerModel, GoogleUserTraits):
       default=datetime.datetime(2009, 01, 01))
 
   key_template = 'actor/%(nick)s'
+  memcache_ttl = 600
+  negative_ttl = 60
 
   def url(self, path="", request=None, mobile=False):
     """ returns a url, with optional path appended
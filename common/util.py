@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import datetime
+import heapq
 import hmac
 import logging
 import math
@@ -24,6 +25,7 @@ import urllib
 
 from django import http
 from django.conf import settings
+from django.template import loader
 from django.utils import safestring
 
 from common import clean
@@ -268,6 +270,54 @@ def page_actors(request, actors, per_page):
     return actors[:-1], more
   return actors, None
 
+class _Reversed(object):
+  """sorts in the opposite order to the value it wraps"""
+  def __init__(self, value):
+    self.value = value
+
+  def __cmp__(self, other):
+    return cmp(other.value, self.value)
+
+def merge_sorted(lists, key=None, reverse=False):
+  """ k-way merge of lists that are each already sorted by key (newest or
+  largest first if reverse), yields their items in that order as a whole
+
+  only the front item of each list is looked at at a time so a caller that
+  stops early doesn't pay for the rest
+  """
+  if key is None:
+    key = lambda x: x
+  sort_key = key
+  if reverse:
+    sort_key = lambda x: _Reversed(key(x))
+
+  iterators = [iter(l) for l in lists]
+  heap = []
+  for i, it in enumerate(iterators):
+    for item in it:
+      heap.append((sort_key(item), i, item))
+      break
+  heapq.heapify(heap)
+
+  while heap:
+    k, i, item = heap[0]
+    yield item
+    for next_item in iterators[i]:
+      heapq.heapreplace(heap, (sort_key(next_item), i, next_item))
+      break
+    else:
+      heapq.heappop(heap)
+
+# template name -> compiled template, see get_template()
+_templates = {}
+
+def get_template(name):
+  """ like django's loader.get_template but each template is only loaded and
+  compiled once per process, for the ones that get rendered over and over
+  such as the notifications """
+  if name not in _templates:
+    _templates[name] = loader.get_template(name)
+  return _templates[name]
 
 def display_nick(nick):
   # TODO(teemu): combine nick functionality from models.py with this
@@ -18,7 +18,7 @@ from django.conf import settings
 from django.template import loader
 
 from common import api, util
-from common.display import prep_entry_list, prep_stream_dict
+from common import dataloader
 
 ENTRIES_PER_PAGE = 20
 
@@ -36,16 +36,8 @@ def explore_recent(request, format="html"):
   per_page = per_page - (len(inbox) - len(entries))
   entries, more = util.page_entries(request, entries, per_page)
 
-  stream_keys = [e.stream for e in entries]
-
-  streams = api.stream_get_streams(request.user, stream_keys)
-
-  actor_nicks = [e.owner for e in entries] + [e.actor for e in entries]
-  actors = api.actor_get_actors(request.user, actor_nicks)
-
   # here comes lots of munging data into shape
-  streams = prep_stream_dict(streams, actors)
-  entries = prep_entry_list(entries, streams, actors)
+  entries = dataloader.for_user(request.user).prep_entries(entries)
 
   # END inbox generation chaos
 
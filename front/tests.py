@@ -1,3 +1,5 @@
+from common import api
+from common import exception
 from common import profile
 from common.tests import ViewTestCase
 
@@ -22,3 +24,26 @@ class SmokeTest(ViewTestCase):
 
     self.assertTemplateUsed(r, 'front.html')
     self.assertWellformed(r)
+
+  def test_public_frontpage_without_members(self):
+    def _not_found(*args, **kw):
+      raise exception.ApiNotFound('no contacts')
+
+    old_get_contacts = api.actor_get_contacts
+    api.actor_get_contacts = _not_found
+    try:
+      r = self.client.get('/')
+    finally:
+      api.actor_get_contacts = old_get_contacts
+
+    self.assertTemplateUsed(r, 'front.html')
+    self.assertWellformed(r)
+
+    # the featured channels still come through as channels, not nicks
+    contexts = r.context
+    if not isinstance(contexts, list):
+      contexts = [contexts]
+    context = [c for c in contexts if 'featured_channels' in c][0]
+    for channel_ref in context['featured_channels']:
+      self.assert_(channel_ref.is_channel())
+    self.assertEqual(context['featured_members'], [])
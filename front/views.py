@@ -23,7 +23,7 @@ from common import exception
 from common import user
 
 from common import api, util
-from common.display import prep_stream_dict, prep_entry_list
+from common import dataloader
 
 ENTRIES_PER_PAGE = 5
 SIDEBAR_LIMIT = 9
@@ -47,22 +47,15 @@ def front_front(request):
   per_page = per_page - (len(inbox) - len(entries))
   entries, more = util.page_entries(request, entries, per_page)
 
-  stream_keys = [e.stream for e in entries]
-  streams = api.stream_get_streams(request.user, stream_keys)
-
-  actor_nicks = [e.owner for e in entries] + [e.actor for e in entries]
-  actors = api.actor_get_actors(request.user, actor_nicks)
-
   # take it back down and don't show a more link
   entries = entries[:ENTRIES_PER_PAGE]
   more = None
 
-  # here comes lots of munging data into shape
-  streams = prep_stream_dict(streams, actors)
-  entries = prep_entry_list(entries, streams, actors)
-
-  # END inbox generation chaos
+  data = dataloader.for_user(request.user)
+  data.want_entries(entries)
 
+  featured_channels = []
+  featured_members = []
   try:
     # Featured Channels -- Ones to which the ROOT user is a member
     featured_channels = api.actor_get_channels_member(
@@ -71,10 +64,7 @@ def front_front(request):
 
     # Just in case any are deleted:
     featured_channels = featured_channels[:2*SIDEBAR_LIMIT]
-    featured_channels = api.channel_get_channels(
-        request.user, featured_channels)
-    featured_channels = [x for x in featured_channels.values() if x]
-    featured_channels = featured_channels[:SIDEBAR_LIMIT]
+    data.want_channels(featured_channels)
 
     featured_members = api.actor_get_contacts(
         request.user, api.ROOT.nick, limit=SIDEBAR_FETCH_LIMIT)
@@ -82,13 +72,19 @@ def front_front(request):
 
     # Just in case any are deleted:
     featured_members = featured_members[:2*SIDEBAR_LIMIT]
-    featured_members = api.actor_get_actors(request.user, featured_members)
-    featured_members = [x for x in featured_members.values() if x]
-    featured_members = featured_members[:SIDEBAR_LIMIT]
-
+    data.want_actors(featured_members)
   except exception.ApiNotFound:
     pass
 
+  # whichever of them were found, as channels and actors rather than nicks
+  featured_channels = data.channel_list(featured_channels)[:SIDEBAR_LIMIT]
+  featured_members = data.actor_list(featured_members)[:SIDEBAR_LIMIT]
+
+  # here comes lots of munging data into shape
+  entries = data.prep_entries(entries)
+
+  # END inbox generation chaos
+
   root = api.ROOT
 
   area = 'frontpage'
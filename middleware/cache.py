@@ -12,6 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
+
 from common import util
 from common.models import CachingModel
 
@@ -21,6 +23,13 @@ class CacheMiddleware(object):
     CachingModel.reset_cache()
 
   def process_response(self, request, response):
+    # the model cache only lives for the length of the request
+    stats = CachingModel.cache_stats()
+    if stats is not None:
+      logging.debug('model cache: %(hits)d hits, %(misses)d misses, '
+                    '%(evictions)d evictions, %(size)d entities', stats)
+    CachingModel.enable_cache(False)
+
     # don't cache anything by default
     # we'll set caching headers manually on appropriate views if they should
     # be cached anyway
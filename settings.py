@@ -340,6 +340,18 @@ IM_PLAIN_TEXT_ONLY = False
 # Truncate entry title in comments. None or 140+ means no truncation.
 IM_MAX_LENGTH_OF_ENTRY_TITLES_FOR_COMMENTS = 40
 
+# Once somebody has been notified about a comment on an entry, the IM and
+# email notifications about further comments on it in the next this many
+# seconds are held back and sent as a single digest when the time is up.
+# 0 sends every notification straight away. Digests need QUEUE_ENABLED.
+NOTIFICATION_DIGEST_WINDOW = 0
+
+# Whether every Subscription has had its delivery filled in, either because
+# it was made after delivery was added or by bin/backfill_subscription_delivery.py.
+# Until then the IM, SMS and email notifications read all of a topic's
+# subscriptions rather than only the ones that asked for them.
+SUBSCRIPTION_DELIVERY_SYNCED = False
+
 #
 # Task Queue
 #
@@ -351,6 +363,17 @@ QUEUE_ENABLED = True
 
 # The secret to use for your cron job that processes your queue
 QUEUE_VENDOR_SECRET = 'SECRET'
+
+# The number of tasks each queue processing request leases at a time
+QUEUE_BATCH_SIZE = 10
+
+# How many seconds a queue processing request keeps leasing and processing
+# tasks for, keep this well under the request deadline
+QUEUE_TIME_BUDGET = 20
+
+# Posts by actors with at least this many followers aren't written to each
+# follower's inbox, they are merged in when the inboxes are read instead
+CELEBRITY_FOLLOWER_COUNT = 5000
 #
 # Throttling Config
 #
@@ -388,6 +411,10 @@ COMMENT_QUICKLINKS_ACCESSKEYS_ENABLED = False
 
 PROFILE_DB = False
 
+# Maximum number of entities kept in the per-request model cache, the least
+# recently used ones are dropped beyond that
+REQUEST_CACHE_SIZE = 2000
+
 # Limit of avatar photo size in kilobytes
 MAX_AVATAR_PHOTO_KB = 200
 